@@ -0,0 +1,329 @@
+"""Benchmark functions.
+
+Synthetic peptide / PTM / spectra workloads and a harness that times and memory-profiles
+every pipeline stage across a grid of workload sizes.
+
+"""
+import argparse
+import json
+import platform
+import subprocess
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from pathlib import Path
+import pandas as pd
+import numpy as np
+from msms_structure_annot import hsmakers
+from msms_structure_annot import msprocess
+from msms_structure_annot import scoring
+from msms_structure_annot.paths import root, reports_dir
+
+# Workload sizes: parent sequence length, candidate sites and modifications for each PTM,
+#   peaks per spectrum and number of spectra
+QUICK_GRID = [
+    {'seq_len': 12, 'n_sites': [4], 'num_mods': [2], 'n_peaks': 500, 'n_spectra': 2},
+    {'seq_len': 25, 'n_sites': [10], 'num_mods': [5], 'n_peaks': 3500, 'n_spectra': 4},
+]
+FULL_GRID = QUICK_GRID + [
+    {'seq_len': 25, 'n_sites': [8, 4], 'num_mods': [4, 2], 'n_peaks': 3500, 'n_spectra': 4},
+    {'seq_len': 30, 'n_sites': [14], 'num_mods': [7], 'n_peaks': 10000, 'n_spectra': 4},
+    {'seq_len': 30, 'n_sites': [14, 6], 'num_mods': [5, 2], 'n_peaks': 10000, 'n_spectra': 8},
+]
+
+# Stage parameters that stay fixed across the grid
+_N_TERM_MOD = 0
+_C_TERM_MOD = 18.0027
+_PROTON_M = 1.0078
+_CHARGES = [1, 2, 3]
+_TOL = 0.01
+_UPPER_LIM = 50
+_N_SECTIONS = 800
+_SN_THR = 1.5
+
+def synth_parent_seq(seq_len, rng):
+    """Random parent peptide sequence.
+
+    Parameters
+    ----------
+    seq_len : int
+        Length of the sequence.
+    rng : np.random.Generator
+        Random number generator.
+
+    Returns
+    -------
+    str
+        Peptide sequence made of the standard amino acids.
+    """
+    residues = [aa for aa in hsmakers.aa_mws['name'] if aa not in ('B', 'J')]
+
+    return ''.join(rng.choice(residues, size = seq_len))
+
+def synth_ptms(seq_len, n_sites, num_mods, rng):
+    """Random PTM table.
+
+    Parameters
+    ----------
+    seq_len : int
+        Length of the parent sequence.
+    n_sites : list
+        Number of possible modification positions for each PTM.
+    num_mods : list
+        Number of modifications for each PTM.
+    rng : np.random.Generator
+        Random number generator.
+
+    Returns
+    -------
+    pd.DataFrame
+        PTM information dataframe like the one built in the example notebook.
+    """
+    ptms_df = pd.DataFrame({
+        'name': ['ptm{}'.format(i) for i in range(len(n_sites))],
+        'm_shift': rng.uniform(-20, 20, len(n_sites)).round(4),
+        'num_mods': list(num_mods),
+        'poss_mod_pos': [sorted(rng.choice(np.arange(1, seq_len + 1), size = n, replace = False).tolist())
+            for n in n_sites],
+        'type': ['point']*len(n_sites),
+    })
+    ptms_df.index.name = 'ptm_id'
+
+    return ptms_df.reset_index()
+
+def synth_spectra(n_peaks, n_spectra, rng, frag_df_charged = None, frac_real = 0.05):
+    """Random MS/MS spectra, optionally with some peaks placed on hypothetical ions.
+
+    Parameters
+    ----------
+    n_peaks : int
+        Number of peaks per spectrum.
+    n_spectra : int
+        Number of spectra.
+    rng : np.random.Generator
+        Random number generator.
+    frag_df_charged : pd.DataFrame, optional
+        Charged hypothetical ions to draw "real" peaks from, by default None
+    frac_real : float, optional
+        Fraction of peaks placed (with a little noise) on hypothetical ions, by default 0.05
+
+    Returns
+    -------
+    pd.DataFrame
+        Dataframe with the same columns as msprocess.import_ms_files.
+    """
+    spectra = []
+    for spec_num in range(1, n_spectra + 1):
+        mz = rng.uniform(100, 2000, n_peaks)
+        if frag_df_charged is not None and len(frag_df_charged) > 0:
+            n_real = int(frac_real*n_peaks)
+            real_mz = rng.choice(frag_df_charged['hyp_mw'].values, size = n_real)
+            mz[:n_real] = real_mz + rng.normal(0, 0.002, n_real)
+        spectra.append(pd.DataFrame({
+            'm/z': mz.round(4),
+            'orig_abundance': rng.exponential(100, n_peaks).round(2),
+            'spec_num': spec_num,
+        }))
+
+    return pd.concat(spectra, ignore_index = True)
+
+def _measure(stage_fn, *args, track_memory = True, **kwargs):
+    """Runs a stage and measures its wall time and peak (Python-allocated) memory.
+
+    tracemalloc slows the stages down a lot, so the wall time comes from an untraced run and the
+    peak memory from a second, traced run on copies of the inputs (some stages work in place).
+
+    Returns
+    -------
+    object
+        What the (untraced) stage run returned.
+    float
+        Wall time in seconds.
+    float
+        Peak memory allocated during the call in MB (NaN if not track_memory).
+    """
+    t_start = time.perf_counter()
+    result = stage_fn(*args, **kwargs)
+    wall_s = time.perf_counter() - t_start
+
+    if not track_memory:
+        return result, wall_s, np.nan
+
+    mem_args = [arg.copy() if isinstance(arg, (pd.DataFrame, pd.Series, np.ndarray)) else arg for arg in args]
+    tracemalloc.start()
+    try:
+        stage_fn(*mem_args, **kwargs)
+        _, peak_bytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return result, wall_s, peak_bytes / 1e6
+
+def _bench_workload(workload, rng, track_memory = True):
+    """Benchmarks every stage on one workload.
+
+    Returns
+    -------
+    list
+        One record per stage with the timing, memory and input/output sizes.
+    """
+    parent_seq = synth_parent_seq(workload['seq_len'], rng)
+    ptms_df = synth_ptms(workload['seq_len'], workload['n_sites'], workload['num_mods'], rng)
+    n_hss = hsmakers.count_hss(ptms_df)
+    records = []
+
+    def record(stage, stage_fn, n_in, *args, **kwargs):
+        result, wall_s, peak_mem_mb = _measure(stage_fn, *args, track_memory = track_memory, **kwargs)
+        records.append({
+            'stage': stage, **workload, 'n_hss': n_hss, 'n_in': int(n_in), 'n_out': int(len(result)),
+            'wall_s': wall_s, 'peak_mem_mb': peak_mem_mb,
+        })
+        return result
+
+    hs_df = record('gen_hss', hsmakers.gen_hss, n_hss, ptms_df)
+    frag_df = record('frag_hs', hsmakers.frag_hs, n_hss, hs_df, ptms_df, parent_seq, _N_TERM_MOD, _C_TERM_MOD)
+    frag_df_charged = record('mk_charge_df', hsmakers.mk_charge_df, len(frag_df), frag_df, _CHARGES, _PROTON_M)
+
+    ms_df = synth_spectra(workload['n_peaks'], workload['n_spectra'], rng, frag_df_charged)
+    ms_df = ms_df.sort_values(by = ['spec_num', 'm/z']).reset_index(drop = True)
+    abund_ceil = [
+        record('abund_ceiling', msprocess.abund_ceiling, len(spec['orig_abundance']),
+            spec['orig_abundance'].copy(), _UPPER_LIM)
+        for _, spec in ms_df.groupby('spec_num')
+    ]
+    ms_df['abund_ceil'] = pd.concat(abund_ceil)
+    bkgd = [
+        record('bkgd_calc_ser', msprocess.bkgd_calc_ser, len(spec['abund_ceil']), spec['abund_ceil'], _N_SECTIONS)
+        for _, spec in ms_df.groupby('spec_num')
+    ]
+    ms_df['bkgd'] = pd.concat(bkgd)
+    ms_df_sn_filter = ms_df[ms_df['abund_ceil'] > _SN_THR*ms_df['bkgd']].reset_index(drop = True)
+
+    matched_df = record('match_ions', scoring.match_ions, len(frag_df_charged)*len(ms_df_sn_filter),
+        ms_df_sn_filter, frag_df_charged, _TOL)
+    for method in ['frac', 'weights']:
+        record('score_wrapper[{}]'.format(method), scoring.score_wrapper, len(matched_df),
+            matched_df, frag_df_charged, workload['n_spectra'], score_method = method)
+
+    return records
+
+def run_benchmarks(grid = QUICK_GRID, seed = 0, repeat = 1, track_memory = True):
+    """Benchmarks every pipeline stage over a grid of synthetic workloads.
+
+    Parameters
+    ----------
+    grid : list, optional
+        Workload sizes (see QUICK_GRID), by default QUICK_GRID
+    seed : int, optional
+        Random seed for the synthetic workloads, by default 0
+    repeat : int, optional
+        Number of times to run each workload, by default 1
+    track_memory : bool, optional
+        Also measure peak memory with a second, traced run of each stage, by default True
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per stage run with wall time ("wall_s"), peak memory ("peak_mem_mb", NaN if not
+        track_memory) and input / output sizes ("n_in", "n_out").
+    """
+    records = []
+    for workload_id, workload in enumerate(grid):
+        for rep in range(repeat):
+            # Same workload for every repeat
+            rng = np.random.default_rng([seed, workload_id])
+            for rec in _bench_workload(workload, rng, track_memory):
+                records.append({'workload_id': workload_id, 'repeat': rep, **rec})
+
+    return pd.DataFrame(records)
+
+def _git_commit():
+    """Current git commit of the project (None if it can't be found)."""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output = True, text = True,
+            check = True, cwd = root).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def write_results(results_df, out_path):
+    """Writes benchmark results as JSON along with the commit and environment they came from.
+
+    Parameters
+    ----------
+    results_df : pd.DataFrame
+        Output of run_benchmarks.
+    out_path : Path
+        JSON file to write.
+    """
+    out_path.parent.mkdir(parents = True, exist_ok = True)
+    report = {
+        'commit': _git_commit(),
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'results': results_df.to_dict(orient = 'records'),
+    }
+    with open(out_path, 'w') as f:
+        json.dump(report, f, indent = 1)
+
+def read_results(results_path):
+    """Reads benchmark results written by write_results back into a dataframe."""
+    with open(results_path) as f:
+        report = json.load(f)
+
+    return pd.DataFrame(report['results']).assign(commit = report['commit'])
+
+def compare_results(base_path, new_path):
+    """Compares two benchmark result files stage by stage.
+
+    Parameters
+    ----------
+    base_path : Path
+        Baseline results (e.g. from the main branch).
+    new_path : Path
+        New results.
+
+    Returns
+    -------
+    pd.DataFrame
+        Median wall time and peak memory per (workload, stage) for both runs and their ratio (new / base).
+    """
+    keys = ['workload_id', 'stage']
+    summaries = [
+        read_results(path).groupby(keys)[['wall_s', 'peak_mem_mb']].median()
+        for path in (base_path, new_path)
+    ]
+    compared_df = summaries[0].join(summaries[1], lsuffix = '_base', rsuffix = '_new')
+    compared_df['wall_ratio'] = compared_df['wall_s_new'] / compared_df['wall_s_base']
+    compared_df['mem_ratio'] = compared_df['peak_mem_mb_new'] / compared_df['peak_mem_mb_base']
+
+    return compared_df.reset_index()
+
+def main(argv = None):
+    """Runs the benchmarks from the command line:
+
+        python -m msms_structure_annot.benchmarks [--full] [--repeat 3] [--no-memory] [--compare base.json]
+    """
+    parser = argparse.ArgumentParser(description = 'Benchmark the msms_structure_annot pipeline stages.')
+    parser.add_argument('--full', action = 'store_true', help = 'use the full size grid instead of the quick one')
+    parser.add_argument('--repeat', type = int, default = 1, help = 'runs per workload')
+    parser.add_argument('--no-memory', action = 'store_true', help = 'skip the traced peak memory runs')
+    parser.add_argument('--seed', type = int, default = 0, help = 'seed for the synthetic workloads')
+    parser.add_argument('--out', default = None,
+        help = 'results JSON file (default: reports/benchmarks/<commit>.json)')
+    parser.add_argument('--compare', default = None, help = 'earlier results JSON file to compare against')
+    args = parser.parse_args(argv)
+
+    results_df = run_benchmarks(FULL_GRID if args.full else QUICK_GRID, seed = args.seed, repeat = args.repeat,
+        track_memory = not args.no_memory)
+    out_path = Path(args.out) if args.out else reports_dir / 'benchmarks' / '{}.json'.format(_git_commit() or 'results')
+    write_results(results_df, out_path)
+    print(results_df.groupby(['workload_id', 'stage'], sort = False)[['n_in', 'wall_s', 'peak_mem_mb']].median())
+    print('Results written to {}'.format(out_path))
+
+    if args.compare:
+        print(compare_results(Path(args.compare), out_path).to_string(index = False))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,216 @@
+"""Stage cache functions.
+
+Memoizes pipeline stages (from msprocess, hsmakers, scoring, ...) on disk, keyed by a
+hash of the stage's code, the package source, and the stage inputs and parameters. The cache is bounded in size and evicts
+the least recently used results first.
+
+Example:
+    stage_cache = StageCache(reports_dir / 'stage_cache')
+    frag_hs = stage_cache.wrap(hsmakers.frag_hs)
+    frag_df = frag_hs(hs_df, ptms_df, parent_seq, N_term_mod, C_term_mod) # computed once per input
+
+"""
+import functools
+import hashlib
+import inspect
+import os
+import pickle
+from pathlib import Path, PurePath
+import pandas as pd
+import numpy as np
+
+# Values whose repr identifies them by content
+_SCALAR_TYPES = (str, bytes, bool, int, float, complex, type(None), type(Ellipsis), np.generic, PurePath)
+
+def _slot_names(cls):
+    """Names of the __slots__ attributes of a class and its bases."""
+    names = []
+    for klass in cls.__mro__:
+        slots = klass.__dict__.get('__slots__', ())
+        names.extend([slots] if isinstance(slots, str) else slots)
+
+    return [name for name in names if name not in ('__dict__', '__weakref__')]
+
+def _hash_update(h, obj):
+    """Feeds an object into a hash, by content for dataframes and arrays."""
+    if isinstance(obj, pd.DataFrame):
+        h.update(b'DataFrame')
+        _hash_update(h, obj.index)
+        for col in obj.columns:
+            _hash_update(h, col)
+            _hash_update(h, obj[col])
+    elif isinstance(obj, (pd.Series, pd.Index)):
+        h.update(type(obj).__name__.encode() + str(obj.dtype).encode())
+        _hash_update(h, obj.name)
+        try:
+            values = pd.util.hash_pandas_object(obj, index = False).values
+        except TypeError:
+            # Unhashable cells (e.g. lists of positions) are hashed by their repr
+            values = pd.util.hash_array(np.array([repr(v) for v in obj], dtype = object))
+        h.update(values.tobytes())
+    elif isinstance(obj, np.ndarray):
+        h.update(b'ndarray' + obj.dtype.str.encode() + repr(obj.shape).encode())
+        if obj.dtype == object:
+            _hash_update(h, pd.Series(obj.ravel()))
+        else:
+            h.update(np.ascontiguousarray(obj).tobytes())
+    elif isinstance(obj, (list, tuple)):
+        h.update(type(obj).__name__.encode() + str(len(obj)).encode())
+        for item in obj:
+            _hash_update(h, item)
+    elif isinstance(obj, dict):
+        h.update(b'dict' + str(len(obj)).encode())
+        for key in sorted(obj, key = repr):
+            _hash_update(h, key)
+            _hash_update(h, obj[key])
+    elif isinstance(obj, (set, frozenset)):
+        h.update(type(obj).__name__.encode() + str(len(obj)).encode())
+        for item in sorted(obj, key = repr):
+            _hash_update(h, item)
+    elif isinstance(obj, _SCALAR_TYPES):
+        h.update(type(obj).__name__.encode() + repr(obj).encode())
+    elif not callable(obj) and (hasattr(obj, '__dict__') or _slot_names(type(obj))):
+        # e.g. HypotheticalStructureSet, msprocess.SpectrumSet
+        h.update(type(obj).__module__.encode() + type(obj).__qualname__.encode())
+        attrs = {name: getattr(obj, name) for name in _slot_names(type(obj)) if hasattr(obj, name)}
+        attrs.update(getattr(obj, '__dict__', {}))
+        _hash_update(h, attrs)
+    else:
+        raise TypeError('Cannot hash a {} by content for the stage cache'.format(type(obj).__qualname__))
+
+def hash_inputs(*args, **kwargs):
+    """Content hash of a stage's inputs.
+
+    Returns
+    -------
+    str
+        Hex digest.
+    """
+    h = hashlib.blake2b(digest_size = 20)
+    _hash_update(h, list(args))
+    _hash_update(h, kwargs)
+
+    return h.hexdigest()
+
+@functools.lru_cache(maxsize = None)
+def _package_source_hash():
+    """Hash of the source of every msms_structure_annot module."""
+    h = hashlib.blake2b(digest_size = 20)
+    for module_file in sorted(Path(__file__).parent.glob('*.py')):
+        h.update(module_file.name.encode())
+        h.update(module_file.read_bytes())
+
+    return h.hexdigest()
+
+def _code_content(code):
+    """Bytecode, names and constants of a code object and the code nested in it (comprehensions,
+    lambdas, ...), without anything that changes between processes like memory addresses."""
+    consts = tuple(_code_content(const) if inspect.iscode(const) else const for const in code.co_consts)
+    return (code.co_code, code.co_names, consts)
+
+def _code_key(stage_fn):
+    """Identifies a stage function and the code it can run, so editing the function or any module of
+    the package (e.g. a helper the stage calls) invalidates its results."""
+    code = inspect.unwrap(stage_fn).__code__
+    return (stage_fn.__module__, stage_fn.__qualname__, _code_content(code), _package_source_hash())
+
+class StageCache:
+    """Size-bounded on-disk cache of stage results.
+
+    Parameters
+    ----------
+    cache_dir : Path
+        Directory the results are pickled to.
+    max_bytes : int, optional
+        Total size the cached results are kept under, by default 2 GB
+    """
+
+    def __init__(self, cache_dir, max_bytes = 2*10**9):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents = True, exist_ok = True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, stage_fn, key):
+        return self.cache_dir / '{}-{}.pkl'.format(stage_fn.__name__, key)
+
+    def call(self, stage_fn, *args, **kwargs):
+        """Returns the cached result of stage_fn(*args, **kwargs), computing and caching it if needed.
+
+        Results are read back as new objects, so stages that modify their inputs in place
+        (like msprocess.abund_ceiling) should be used through their return value.
+        """
+        key = hash_inputs(_code_key(stage_fn), *args, **kwargs)
+        cache_file = self._path(stage_fn, key)
+
+        try:
+            with open(cache_file, 'rb') as f:
+                result = pickle.load(f)
+            os.utime(cache_file) # Mark as recently used
+            self.hits += 1
+            return result
+        except FileNotFoundError:
+            pass
+        except (OSError, EOFError, pickle.UnpicklingError):
+            pass # Corrupt entry; just recompute it
+
+        self.misses += 1
+        result = stage_fn(*args, **kwargs)
+
+        # Write to a temporary file first so readers never see a partial result
+        tmp_file = cache_file.with_name(cache_file.name + '.{}.tmp'.format(os.getpid()))
+        with open(tmp_file, 'wb') as f:
+            pickle.dump(result, f, protocol = pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, cache_file)
+        self.evict()
+
+        return result
+
+    def wrap(self, stage_fn):
+        """Memoized version of a stage function."""
+        @functools.wraps(stage_fn)
+        def cached_stage(*args, **kwargs):
+            return self.call(stage_fn, *args, **kwargs)
+
+        return cached_stage
+
+    def entries(self):
+        """Cached results, least recently used first.
+
+        Returns
+        -------
+        pd.DataFrame
+            File ("path"), size in bytes ("size") and last use time ("last_used") of each result.
+        """
+        entries = []
+        for cache_file in self.cache_dir.glob('*.pkl'):
+            try:
+                stat = cache_file.stat()
+            except FileNotFoundError:
+                continue # Evicted by another process
+            entries.append({'path': cache_file, 'size': stat.st_size, 'last_used': stat.st_mtime_ns})
+
+        return pd.DataFrame(entries, columns = ['path', 'size', 'last_used']).sort_values(
+            'last_used', kind = 'stable').reset_index(drop = True)
+
+    def evict(self):
+        """Deletes the least recently used results until the cache fits in max_bytes."""
+        entries = self.entries()
+        excess = entries['size'].sum() - self.max_bytes
+        for path, size in zip(entries['path'], entries['size']):
+            if excess <= 0:
+                break
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            excess -= size
+
+    def clear(self):
+        """Deletes every cached result."""
+        for path in self.entries()['path']:
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,296 @@
+"""Command line interface.
+
+Runs the HalA2_example notebook workflow headlessly for a batch of experiments. Each
+experiment is described by a JSON config file (see EXAMPLE_CONFIG) that usually sits in
+its data directory as "config.json":
+
+    msms-annot                        # every data/**/config.json
+    msms-annot data/exp1 data/exp2    # experiment directories or config files
+    msms-annot --workers 4 --force data/exp1
+
+Every stage's output is checkpointed under reports/<exp_name>/<report_id>/checkpoints with
+a cache.StageCache, so a rerun (e.g. after an interrupted batch) picks up where it stopped.
+Checkpoints are keyed on the stage inputs (and MS files), so editing a config only reruns the
+stages it affects.
+
+"""
+import argparse
+import json
+import os
+import sys
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import pandas as pd
+from msms_structure_annot import hsmakers
+from msms_structure_annot import instrument
+from msms_structure_annot import msprocess
+from msms_structure_annot import scoring
+from msms_structure_annot.cache import StageCache
+from msms_structure_annot.paths import data_dir, reports_dir
+
+CONFIG_NAME = 'config.json'
+
+# Parameters and their defaults (None: required)
+EXAMPLE_CONFIG = {
+    'exp_name': None, # Parent directory name for reports (default: name of the data directory)
+    'data_dir': None, # Folder with the MS files (default: folder of the config file)
+    'report_id': 'report001',
+    'parent_seq': 'GTTWPCATVGVSVALCPTTKCTSQC',
+    'N_term_mod': 0,
+    'C_term_mod': 18.0027,
+    'proton_m': 1.0078,
+    'charges': [1, 2, 3],
+    'ptms': { # Same layout as ptm_dict in the example notebook
+        'name': ['dehydration'],
+        'm_shift': [-18.011],
+        'num_mods': [7],
+        'poss_mod_pos': [[2, 3, 8, 12, 18, 19, 22, 23]],
+        'type': ['point'],
+    },
+    'tol': 0.01,
+    'tol_unit': 'Da',
+    'sn_thr': 1.5,
+    'N': 800,
+    'upper_lim': 50,
+    'score_methods': ['frac', 'weights'],
+}
+_REQUIRED = ['parent_seq', 'ptms', 'tol', 'sn_thr', 'N', 'upper_lim', 'charges']
+_DEFAULTS = {key: value for key, value in EXAMPLE_CONFIG.items() if key not in _REQUIRED}
+
+def load_config(config_file):
+    """Reads an experiment config file and fills in the defaults.
+
+    Parameters
+    ----------
+    config_file : Path
+        JSON config file.
+
+    Returns
+    -------
+    dict
+        Experiment parameters, with "data_dir" as an absolute path.
+    """
+    with open(config_file) as f:
+        config = {**_DEFAULTS, **json.load(f)}
+
+    missing = [key for key in _REQUIRED if key not in config]
+    if missing:
+        raise ValueError('{}: missing parameters {}'.format(config_file, missing))
+
+    config_dir = Path(config_file).resolve().parent
+    config['data_dir'] = str(config_dir / config['data_dir']) if config['data_dir'] else str(config_dir)
+    config['exp_name'] = config['exp_name'] or Path(config['data_dir']).name
+
+    return config
+
+def find_configs(targets):
+    """Finds the config files for a list of experiment directories / config files.
+
+    Directories without a config file of their own are searched recursively.
+
+    Parameters
+    ----------
+    targets : list
+        Config files or directories.
+
+    Returns
+    -------
+    list
+        Config file paths, sorted within each directory.
+    """
+    config_files = []
+    for target in map(Path, targets):
+        if target.is_file():
+            config_files.append(target)
+        elif (target / CONFIG_NAME).is_file():
+            config_files.append(target / CONFIG_NAME)
+        elif target.is_dir():
+            config_files.extend(sorted(target.rglob(CONFIG_NAME)))
+        else:
+            raise FileNotFoundError('No config file or directory at {}'.format(target))
+
+    return config_files
+
+def _ptms_df(config):
+    """PTM dataframe from the config (same as the example notebook)."""
+    ptms_df = pd.DataFrame(config['ptms'])
+    ptms_df.index.name = 'ptm_id'
+
+    return ptms_df.reset_index()
+
+def _load_spectra(exp_data_dir, ms_files, upper_lim, N):
+    """Imports and processes an experiment's spectra (ms_files, from _ms_files_key, only keys the checkpoint)."""
+    return msprocess.process_spectra(msprocess.import_ms_files(Path(exp_data_dir)), upper_lim, N)
+
+def _charged_fragments(hs_df, ptms_df, parent_seq, N_term_mod, C_term_mod, charges, proton_m):
+    """Charged fragment ions of every hypothetical structure."""
+    return hsmakers.mk_charge_df(hsmakers.frag_hs(hs_df, ptms_df, parent_seq, N_term_mod, C_term_mod),
+        charges, proton_m)
+
+def _score_methods(matched_df, frag_df_charged, N_spec, score_methods):
+    """Scores from every scoring method, best first."""
+    return pd.concat([
+        scoring.score_wrapper(matched_df, frag_df_charged, N_spec, score_method = method)
+        for method in score_methods
+        ], ignore_index = True).sort_values(['score_method', 'score'], ascending = False)
+
+def _ms_files_key(exp_data_dir):
+    """Name, size and modification time of the MS files in a directory."""
+    return sorted(
+        (f.name, f.stat().st_size, f.stat().st_mtime_ns)
+        for f in Path(exp_data_dir).glob('ms*') if msprocess._MS_FILE_RE.match(f.name)
+    )
+
+def run_experiment(config, out_root = reports_dir, force = False, profile = False):
+    """Runs every stage of the example notebook for one experiment and writes its reports.
+
+    Writes hs_scores.csv, matched_ions.csv, hs_df.csv and ptms_df.csv (plus profile.json with
+    the stage timings if profiling) to <out_root>/<exp_name>/<report_id>.
+
+    Parameters
+    ----------
+    config : dict
+        Experiment parameters (see load_config).
+    out_root : Path, optional
+        Reports directory, by default reports_dir
+    force : bool, optional
+        Rerun every stage even if it's checkpointed, by default False
+    profile : bool, optional
+        Record stage timings and memory (see instrument), by default False
+
+    Returns
+    -------
+    dict
+        Experiment name, output folder, the stages that were loaded from checkpoints and, if
+        profiling, the per-stage summary table ("profile").
+    """
+    if profile:
+        with instrument.recording():
+            result = run_experiment(config, out_root, force)
+        instrument.dump_json(Path(result['output_folder']) / 'profile.json')
+        result['profile'] = instrument.summary_table()
+        return result
+
+    output_folder = Path(out_root) / config['exp_name'] / config['report_id']
+    stage_cache = StageCache(output_folder / 'checkpoints')
+    if force:
+        stage_cache.clear()
+    ptms_df = _ptms_df(config)
+    resumed = []
+
+    def stage(name, stage_fn, *args):
+        hits = stage_cache.hits
+        value = stage_cache.call(stage_fn, *args)
+        if stage_cache.hits > hits:
+            resumed.append(name)
+        return value
+
+    # Spectra
+    ms_df = stage('spectra', _load_spectra, config['data_dir'], _ms_files_key(config['data_dir']),
+        config['upper_lim'], config['N'])
+    ms_df_sn_filter = ms_df[ms_df['abund_ceil'] > config['sn_thr']*ms_df['bkgd']].reset_index(drop = True)
+    N_spec = ms_df['spec_num'].nunique()
+
+    # Hypothetical structures and their ions
+    hs_df = stage('hss', hsmakers.gen_hss, ptms_df)
+    frag_df_charged = stage('fragments', _charged_fragments, hs_df, ptms_df, config['parent_seq'],
+        config['N_term_mod'], config['C_term_mod'], config['charges'], config['proton_m'])
+
+    # Matching and scoring
+    matched_df = stage('matches', scoring.match_ions, ms_df_sn_filter, frag_df_charged, config['tol'],
+        config['tol_unit'])
+    scores_df = stage('scores', _score_methods, matched_df, frag_df_charged, N_spec, config['score_methods'])
+
+    # Reports
+    matched_df.sort_values(['hs_id', 'm/z', 'spec_num']).to_csv(output_folder / 'matched_ions.csv', index = False)
+    scores_df.to_csv(output_folder / 'hs_scores.csv', index = False)
+    hs_df.to_csv(output_folder / 'hs_df.csv', index = True)
+    ptms_df.to_csv(output_folder / 'ptms_df.csv', index = False)
+
+    return {'exp_name': config['exp_name'], 'output_folder': str(output_folder), 'resumed': resumed}
+
+def _run_experiment_safe(args):
+    """Runs an experiment and reports errors instead of raising them (so one bad experiment doesn't stop
+    the batch)."""
+    config_file, out_root, force, profile = args
+    try:
+        result = run_experiment(load_config(config_file), out_root, force, profile)
+        result['error'] = None
+    except Exception:
+        result = {'exp_name': str(config_file), 'output_folder': None, 'resumed': [],
+            'error': traceback.format_exc()}
+
+    return result
+
+def run_batch(config_files, out_root = reports_dir, n_workers = 1, force = False, profile = False):
+    """Runs a batch of experiments, in parallel across processes.
+
+    Parameters
+    ----------
+    config_files : list
+        Experiment config files.
+    out_root : Path, optional
+        Reports directory, by default reports_dir
+    n_workers : int, optional
+        Number of experiments run at the same time, by default 1
+    force : bool, optional
+        Rerun every stage even if it's checkpointed, by default False
+    profile : bool, optional
+        Record stage timings and memory for each experiment, by default False
+
+    Returns
+    -------
+    list
+        Result of each experiment (see run_experiment), with any error traceback in "error".
+    """
+    args = [(config_file, out_root, force, profile) for config_file in config_files]
+    if n_workers == 1 or len(args) <= 1:
+        return [_run_experiment_safe(a) for a in args]
+
+    with ProcessPoolExecutor(max_workers = n_workers) as pool:
+        return list(pool.map(_run_experiment_safe, args))
+
+def main(argv = None):
+    """Console entry point (msms-annot)."""
+    parser = argparse.ArgumentParser(prog = 'msms-annot',
+        description = 'Score hypothetical PTM structures for a batch of MS/MS experiments.')
+    parser.add_argument('targets', nargs = '*', default = [str(data_dir)],
+        help = 'experiment config files or directories (searched for {}); default: the data directory'.format(
+            CONFIG_NAME))
+    parser.add_argument('-o', '--out', default = str(reports_dir), help = 'reports directory')
+    parser.add_argument('-w', '--workers', type = int, default = os.cpu_count(),
+        help = 'experiments run at the same time (default: number of cores)')
+    parser.add_argument('-f', '--force', action = 'store_true', help = 'ignore checkpoints and rerun every stage')
+    parser.add_argument('--profile', action = 'store_true',
+        help = 'record stage timings and memory (written to profile.json with each report)')
+    parser.add_argument('--example-config', action = 'store_true', help = 'print an example config file and exit')
+    args = parser.parse_args(argv)
+
+    if args.example_config:
+        print(json.dumps({key: value for key, value in EXAMPLE_CONFIG.items() if value is not None}, indent = 4))
+        return 0
+
+    config_files = find_configs(args.targets)
+    if not config_files:
+        print('No {} files found in {}'.format(CONFIG_NAME, args.targets), file = sys.stderr)
+        return 1
+
+    results = run_batch(config_files, Path(args.out), n_workers = max(1, min(args.workers, len(config_files))),
+        force = args.force, profile = args.profile)
+    for result in results:
+        if result['error']:
+            print('FAILED {}\n{}'.format(result['exp_name'], result['error']), file = sys.stderr)
+        else:
+            resumed = ' (resumed: {})'.format(', '.join(result['resumed'])) if result['resumed'] else ''
+            print('{} -> {}{}'.format(result['exp_name'], result['output_folder'], resumed))
+            if result.get('profile') is not None:
+                print(result['profile'].to_string())
+
+    return int(any(result['error'] for result in results))
+
+if __name__ == '__main__':
+    # Run the imported module's main so the stage functions (and their checkpoint keys) belong to
+    # msms_structure_annot.cli rather than __main__, same as with the msms-annot entry point
+    from msms_structure_annot import cli
+    sys.exit(cli.main())
@@ -4,11 +4,14 @@ Generate hypothetical structures from proposed PTMs. Also fragments and
 assigns hypothetical masses.
 
 """
+import functools
 import warnings
 import itertools
-from numpy import histogram_bin_edges
+import math
 import pandas as pd
 import numpy as np
+from msms_structure_annot import scoring
+from msms_structure_annot.instrument import instrumented
 
 # Define molecular weights for polymerized amino acids
 aa_mws = pd.DataFrame({
@@ -23,145 +26,901 @@ aa_mws = pd.DataFrame({
     ]
 })
 
-def gen_hss(ptms_df):
-    """Generate hypothetical structures by marrying all combinations of all PTMs.
+# Hypothetical structure counts above this raise a warning before enumeration starts
+HSS_WARN_LIMIT = 10**6
+
+def _ptm_mod_options(ptms_df):
+    """Pulls the candidate positions and modification count for each PTM.
 
     Parameters
     ----------
     ptms_df : pd.DataFrame
-        DataFrame with the post-translational modification information contained.
-        Columns it should have: an ID "ptm_id", positions possible for modification "poss_mod_pos",
-        and total number of mods observed "num_mods".
+        PTM information dataframe.
 
     Returns
     -------
-    pd.DataFrame
-        Long-form dataframe with PTMs and PTM locations for all the hypothetical structures. 
-    """
-
-    # Iterate through each PTM and get all combinations of possible modified positions for each
-    all_mod_combs = list() # Store it by ptm_id number
-
-    for i in range(0,ptms_df.shape[0]):
-        ptm_id = ptms_df.loc[i]['ptm_id']
-        mod_poss = ptms_df.loc[i]['poss_mod_pos'] # possitible modification positions
-        mod_count = ptms_df.loc[i]['num_mods'] # Total number of modifications
+    list
+        (possible modification positions, number of modifications) for each PTM, in order.
 
+    Raises
+    ------
+    ValueError
+        If a PTM has more modifications than possible modification positions, or a range of
+        modification counts (see filter_mod_counts).
+    """
+    mod_options = []
+    for ptm_id, mod_poss, mod_count, is_ring in zip(ptms_df['ptm_id'], ptms_df['poss_mod_pos'], ptms_df['num_mods'],
+            _is_ring(ptms_df)):
+        if np.ndim(mod_count) != 0:
+            raise ValueError(
+                'PTM id {} has a range of modification counts; pick exact counts with filter_mod_counts first!'
+                .format(ptm_id)
+                )
         # Make sure the number of mod sites is less than or equal to number of mods
-        if mod_count > len(mod_poss):
+        #   (ring PTMs are checked when their pairings are enumerated)
+        if not is_ring and mod_count > len(mod_poss):
             raise ValueError(
                 'Total number of modifications for PTM id {} is larger than the number of possible locations!'
                 .format(ptm_id)
                 )
+        mod_options.append((list(mod_poss), int(mod_count)))
 
-        # Get all combinations of possible modified positions and store in dictionary
-        all_mod_combs.append([comb for comb in itertools.combinations(mod_poss, mod_count)])
+    return mod_options
 
-    # Then get all combinations of those combinations; each list item is a hypothetical structure
-    mult_ptm_all_combs = list(itertools.product(*all_mod_combs))
+def count_hss(ptms_df):
+    """Counts the hypothetical structures gen_hss would generate without enumerating them.
 
-    # Iterate through hypothetical structures list and massage into long-form dataframe
-    hs_id_col = []
-    ptm_id_col = []
-    ptm_locs_col = []
+    Parameters
+    ----------
+    ptms_df : pd.DataFrame
+        PTM information dataframe.
 
-    for hs_id, ptms in enumerate(mult_ptm_all_combs):
-        for ptm_id, ptm_locs in enumerate(ptms):
-            hs_id_col.append(hs_id)
-            ptm_id_col.append(ptm_id)
-            ptm_locs_col.append(ptm_locs)
-            #print(hs_id,ptm_id,ptm_locs)
+    Returns
+    -------
+    int
+        Exact number of hypothetical structures (product of the number of location options of each PTM).
+    """
+    return math.prod(_n_ptm_options(ptms_df))
 
-    hs_df = pd.DataFrame({'hs_id': hs_id_col, 'ptm_id': ptm_id_col, 'ptm_locs': ptm_locs_col})
-    hs_df
+def _is_ring(ptms_df):
+    """Whether each PTM is a ring (cross-link) rather than a point modification."""
+    if 'type' not in ptms_df:
+        return np.zeros(len(ptms_df), dtype = bool)
+    return np.asarray(ptms_df['type'] == 'ring')
 
-    return hs_df
+def _ring_candidate_pairs(mod_poss):
+    """Candidate (start, end) residue pairs of a ring PTM.
+
+    Parameters
+    ----------
+    mod_poss : list
+        Either candidate positions (any two of them can be linked) or candidate [start, end] pairs.
+
+    Returns
+    -------
+    tuple
+        Unique (start, end) pairs with start < end, sorted.
+    """
+    if len(mod_poss) and np.ndim(mod_poss[0]) != 0:
+        pairs = {(min(pair), max(pair)) for pair in mod_poss if pair[0] != pair[1]}
+    else:
+        pairs = set(itertools.combinations(sorted(set(mod_poss)), 2))
+
+    return tuple(sorted((int(a), int(b)) for a, b in pairs))
+
+@functools.lru_cache(maxsize = 64)
+def _ring_pairings(cand_pairs, n_rings, block_size = 20000):
+    """Enumerates the ways to place n_rings rings on the candidate pairs.
+
+    Rings may be nested or non-overlapping, but can't cross or share a residue. Each pairing
+    is generated once, with its rings in candidate order, so mirrored and reordered
+    duplicates never come up. Pairings are built one ring at a time, keeping only partial
+    pairings that the candidates left can still complete.
+
+    Parameters
+    ----------
+    cand_pairs : tuple
+        Sorted (start, end) candidate pairs from _ring_candidate_pairs.
+    n_rings : int
+        Number of rings.
+    block_size : int, optional
+        Number of partial pairings extended at once, by default 20000
+
+    Returns
+    -------
+    np.array
+        (n_pairings x 2*n_rings) array of [start_1, end_1, start_2, end_2, ...], in lexicographic
+        order of the candidate indices (read-only, it's cached).
+    """
+    starts = np.array([a for a, _ in cand_pairs], dtype = 'int64')
+    ends = np.array([b for _, b in cand_pairs], dtype = 'int64')
+    n_cands = len(cand_pairs)
+
+    pairings = np.zeros((1, 0), dtype = 'int64') # Candidate indices of the rings placed so far
+    for ring in range(n_rings):
+        n_left = n_rings - ring - 1
+        extended = []
+        for lo in range(0, len(pairings), block_size):
+            block = pairings[lo:lo + block_size]
+            # Later candidates only, leaving enough candidates for the remaining rings
+            last = block[:, -1] if ring else np.full(len(block), -1)
+            ok = np.arange(n_cands)[None, :] > last[:, None]
+            ok &= np.arange(n_cands)[None, :] < n_cands - n_left
+            for placed in block.T:
+                # Ring [a, b] and candidate [c, d] (c >= a): no shared residues, no crossing
+                a, b = starts[placed][:, None], ends[placed][:, None]
+                ok &= (starts[None, :] != a) & ((b < starts[None, :]) | (b > ends[None, :]))
+            rows, cands = np.nonzero(ok)
+            extended.append(np.hstack((block[rows], cands[:, None])))
+        pairings = np.vstack(extended) if extended else np.zeros((0, ring + 1), dtype = 'int64')
+
+    ring_locs = np.empty((len(pairings), 2*n_rings), dtype = 'int16')
+    ring_locs[:, 0::2] = starts[pairings]
+    ring_locs[:, 1::2] = ends[pairings]
+    ring_locs.setflags(write = False)
+
+    return ring_locs
+
+def _n_ptm_options(ptms_df):
+    """Number of location options (combinations of positions or ring pairings) of each PTM."""
+    return [
+        len(_ring_pairings(_ring_candidate_pairs(mod_poss), mod_count)) if is_ring
+        else math.comb(len(mod_poss), mod_count)
+        for (mod_poss, mod_count), is_ring in zip(_ptm_mod_options(ptms_df), _is_ring(ptms_df))
+    ]
 
+def _mod_count_ranges(ptms_df):
+    """Pulls the (smallest, largest) number of modifications allowed for each PTM.
 
-def _get_mass_seq(trunc_seq, hs_sub_df, ptms_df, trunc_type, parent_seq, N_term_mod, C_term_mod):
-    """Gets the mass of a sequence given its truncation and the expected PTMs for the
-    hypothetical structure.
+    "num_mods" can be an exact count or a [smallest, largest] pair (inclusive).
 
     Parameters
     ----------
-    trunc_seq : str
-        Truncated sequence AA string.
-    hs_sub_df : pd.DataFrame
-        Hypothetical structure dataframe subsetted to only include relevant hypothetical strucuture.
     ptms_df : pd.DataFrame
         PTM information dataframe.
-    trunc_type : str
-        Truncation type (C-term or N-term)
+
+    Returns
+    -------
+    list
+        (smallest, largest) number of modifications for each PTM, in order.
+
+    Raises
+    ------
+    ValueError
+        If a range is empty or allows more modifications than possible modification positions.
+    """
+    count_ranges = []
+    for ptm_id, mod_poss, mod_count in zip(ptms_df['ptm_id'], ptms_df['poss_mod_pos'], ptms_df['num_mods']):
+        lo, hi = (mod_count, mod_count) if np.ndim(mod_count) == 0 else mod_count
+        if not 0 <= lo <= hi <= len(mod_poss):
+            raise ValueError(
+                'Modification counts {}-{} for PTM id {} are not between 0 and the number of possible locations!'
+                .format(lo, hi, ptm_id)
+                )
+        count_ranges.append((int(lo), int(hi)))
+
+    return count_ranges
+
+def filter_mod_counts(ptms_df, parent_seq, N_term_mod, C_term_mod, precursor_mz, precursor_charges, proton_m, tol,
+        tol_unit = 'Da'):
+    """Finds the combinations of PTM counts whose intact mass matches the precursor, before any
+    positional enumeration.
+
+    Count combinations are built one PTM at a time, dropping partial combinations that can't
+    reach the precursor whatever counts the remaining PTMs take, so the full grid of count
+    ranges is never built. The intact mass of each combination is the same as the parent ion
+    mass frag_hs would give its structures.
+
+    Parameters
+    ----------
+    ptms_df : pd.DataFrame
+        PTM information dataframe; "num_mods" can be an exact count or an inclusive
+        [smallest, largest] range for each PTM.
     parent_seq : str
         Untruncated peptide sequence
     N_term_mod : float
         N-terminal modification mass shift.
     C_term_mod : float
         C-terminal modification mass shift.
+    precursor_mz : float
+        Precursor m/z (e.g. "precursor_mz" from msprocess.import_ms_files(..., return_meta = True)).
+    precursor_charges : int or list
+        Precursor charge, or the candidate charges if the header doesn't give one.
+    proton_m : float
+        Constant for mass of a proton.
+    tol : float
+        +/- tolerance to use for matching the precursor m/z.
+    tol_unit : str, optional
+        Either 'Da' or 'ppm', by default 'Da'
 
     Returns
+    -------
+    pd.DataFrame
+        One row per matching (count combination, charge) with the number of each PTM
+        ("num_mods", a tuple in ptms_df order), "precursor_charge", the intact mass
+        ("intact_mw"), the m/z error ("mz_error", observed - hypothetical) and the number of
+        hypothetical structures the combination has ("n_hss"). Sorted by absolute m/z error.
+    """
+    count_ranges = _mod_count_ranges(ptms_df)
+    m_shifts = ptms_df['m_shift'].values.astype('float64')
+    frag_tmpl = _frag_template(parent_seq, N_term_mod, C_term_mod)
+    parent_mw = frag_tmpl.loc[frag_tmpl['b_y_p'] == 'p', 'base_mw'].values[0]
+
+    # Largest and smallest mass shift the PTMs after each one can still add
+    shift_lo = np.array([min(lo*m, hi*m) for (lo, hi), m in zip(count_ranges, m_shifts)] + [0.0])
+    shift_hi = np.array([max(lo*m, hi*m) for (lo, hi), m in zip(count_ranges, m_shifts)] + [0.0])
+    rest_lo = np.cumsum(shift_lo[::-1])[::-1]
+    rest_hi = np.cumsum(shift_hi[::-1])[::-1]
+
+    matches = []
+    for charge in np.atleast_1d(precursor_charges):
+        # Intact masses within tolerance of the precursor (with some slack for rounding)
+        tol_mz = tol if tol_unit == 'Da' else precursor_mz*tol*1e-6
+        mass_lo = (precursor_mz - 2*tol_mz)*charge - charge*proton_m - 1e-6
+        mass_hi = (precursor_mz + 2*tol_mz)*charge - charge*proton_m + 1e-6
+
+        counts = np.zeros((1, 0), dtype = 'int64')
+        shifts = np.zeros(1)
+        for ptm_code, (lo, hi) in enumerate(count_ranges):
+            n_options = hi - lo + 1
+            counts = np.hstack((np.repeat(counts, n_options, axis = 0),
+                np.tile(np.arange(lo, hi + 1), len(counts))[:, None]))
+            shifts = np.repeat(shifts, n_options) + m_shifts[ptm_code]*counts[:, -1]
+            reachable = ((parent_mw + shifts + rest_hi[ptm_code + 1] >= mass_lo)
+                & (parent_mw + shifts + rest_lo[ptm_code + 1] <= mass_hi))
+            counts, shifts = counts[reachable], shifts[reachable]
+
+        # Exact check on the survivors, with the same masses and windows as matching
+        intact_mws = _shift_masses(np.full(len(counts), parent_mw), ptms_df, ptms_df['ptm_id'].values, counts.T)
+        hyp_mz = (intact_mws + charge*proton_m) / charge
+        lower, upper = scoring._tol_window(hyp_mz, tol, tol_unit)
+        keep = (precursor_mz >= lower) & (precursor_mz <= upper)
+        matches.append(pd.DataFrame({
+            'num_mods': [tuple(int(c) for c in combo) for combo in counts[keep]],
+            'precursor_charge': int(charge),
+            'intact_mw': intact_mws[keep],
+            'mz_error': precursor_mz - hyp_mz[keep],
+        }))
+
+    matches_df = pd.concat(matches, ignore_index = True)
+    matches_df['n_hss'] = [count_hss(with_mod_counts(ptms_df, combo)) for combo in matches_df['num_mods']]
+
+    return matches_df.sort_values('mz_error', key = np.abs, kind = 'stable').reset_index(drop = True)
+
+def with_mod_counts(ptms_df, num_mods):
+    """PTM information dataframe with exact modification counts (e.g. a row of filter_mod_counts).
+
+    Parameters
     ----------
+    ptms_df : pd.DataFrame
+        PTM information dataframe.
+    num_mods : tuple
+        Number of modifications of each PTM, in ptms_df order.
+
+    Returns
+    -------
     pd.DataFrame
-        Dataframe row with all the info for the new hypothetical ion.
+        Copy of ptms_df with "num_mods" replaced.
     """
-    # Get the hypothetical structure ID.
-    hs_id = hs_sub_df['hs_id'].values[0]
-    # Function to get the mass of a sequence given its truncation and the expected ptms[]
-    mass = 0
-    ion_len = len(trunc_seq)
-    
-    for AA in trunc_seq: #iterate through each position and add the mass of each amino acid
-            mass = mass + aa_mws[aa_mws['name'] == AA]['mw'].values[0]
-    
-    if trunc_type == 'C':
-        term_mod = N_term_mod
-        
-        #included_ptms = [x for x in ptm_locs if x <= ion_len] # get mod sites included in the truncation
-        ptm_range = (0,ion_len)
-        ion_type = 'b'
-        ion_name = ion_type + str(ion_len)
-        #print(trunc_seq, ' bion length:',len(trunc_seq), '; ptms: ', str(included_ptms))
-        
-    elif trunc_type == 'N':
-        #included_ptms = [x for x in ptm_locs if x > (len(parent_seq) - ion_len)]
-        ptm_range = ((len(parent_seq) - ion_len +1),len(parent_seq))
-        
-        if ion_len == len(parent_seq): # This is the parent ion
-            
-            term_mod = N_term_mod + C_term_mod
-            ion_type = 'p'
-            ion_name = ion_type
-            #print(trunc_seq, ' p length:',len(trunc_seq), '; ptms: ', str(included_ptms))
-            
-        else: # name the gamma ion 
-            term_mod = C_term_mod # + N_term_mod * added N_term_mod here for spectra that aren't deconvoluted
-            ion_type = 'y'
-            ion_name = ion_type + str(ion_len)
-            
-            #print(trunc_seq, ' yion length:',len(trunc_seq), '; ptms: ', str(included_ptms))
-        
-    mass = mass + term_mod # Add the terminal modification(s)
-    
-    # Iterate through PTMs based off PTM range and add PTM mass shifts for each PTM
-    for ptm_id in hs_sub_df['ptm_id'].unique():
-        # Get the shift from the ptm_id and the ptm dataframe
+    return ptms_df.assign(num_mods = [int(c) for c in num_mods])
+
+def _unrank_combinations(ranks, n, k):
+    """Finds the combinations at the given ranks of the lexicographic order of itertools.combinations.
+
+    Parameters
+    ----------
+    ranks : np.array
+        Combination ranks (0 to comb(n, k) - 1).
+    n : int
+        Number of items to choose from.
+    k : int
+        Number of items chosen.
+
+    Returns
+    -------
+    np.array
+        (len(ranks) x k) array of chosen item indices.
+    """
+    # Lookup table for the number of combinations of the remaining items
+    comb_table = np.array([[math.comb(a, b) for b in range(k + 1)] for a in range(n + 1)], dtype='int64')
+
+    ranks = np.array(ranks, dtype='int64')
+    combs = np.empty((len(ranks), k), dtype='int64')
+    cand = np.zeros(len(ranks), dtype='int64')
+
+    for j in range(k):
+        # Skip candidates until the rank falls within the combinations starting with that candidate
+        while True:
+            n_starting = comb_table[np.maximum(n - cand - 1, 0), k - j - 1]
+            skip = ranks >= n_starting
+            if not skip.any():
+                break
+            ranks[skip] -= n_starting[skip]
+            cand[skip] += 1
+        combs[:, j] = cand
+        cand = cand + 1
+
+    return combs
+
+def _rank_combinations(combs, n):
+    """Finds the rank of combinations in the lexicographic order of itertools.combinations.
+
+    Inverse of _unrank_combinations.
+
+    Parameters
+    ----------
+    combs : np.array
+        (n_combinations x k) array of chosen item indices, each row increasing.
+    n : int
+        Number of items to choose from.
+
+    Returns
+    -------
+    np.array
+        Rank of each combination.
+    """
+    combs = np.asarray(combs, dtype = 'int64')
+    k = combs.shape[1]
+    # Number of combinations that skip ahead of each candidate at each slot, cumulated over candidates
+    n_skipped = np.array([
+        [0] + list(itertools.accumulate(math.comb(n - c - 1, k - j - 1) for c in range(n)))
+        for j in range(k)
+    ], dtype = 'int64')
+
+    ranks = np.zeros(len(combs), dtype = 'int64')
+    prev = np.full(len(combs), -1, dtype = 'int64')
+    for j in range(k):
+        ranks += n_skipped[j, combs[:, j]] - n_skipped[j, prev + 1]
+        prev = combs[:, j]
+
+    return ranks
+
+class HypotheticalStructureSet:
+    """Hypothetical structures stored as a dense array of PTM locations.
+
+    Structure i holds the modified positions of PTM j in locs[i, j, :], padded with -1 up
+    to the largest number of modifications of any PTM. Ring PTMs hold the (start, end)
+    residues of each ring one after the other. Structures are looked up by hs_id in
+    constant time, and slicing a range of hs_ids returns a view that shares the location array.
+
+    Parameters
+    ----------
+    locs : np.array
+        (n_structures x n_ptms x max_sites) array of one-indexed PTM positions, -1 for unused slots.
+    hs_ids : np.array, optional
+        Hypothetical structure ID of each structure, by default 0..n_structures-1
+    ptm_ids : np.array, optional
+        PTM ID of each entry of the second axis of locs, by default 0..n_ptms-1
+    ring_ptms : np.array, optional
+        Whether each PTM is a ring, by default None (all point PTMs)
+    """
+
+    def __init__(self, locs, hs_ids = None, ptm_ids = None, ring_ptms = None):
+        self.locs = np.asarray(locs)
+        if self.locs.ndim != 3:
+            raise ValueError('PTM locations must be an (n_structures x n_ptms x max_sites) array!')
+        n_hs, n_ptms = self.locs.shape[:2]
+        self.hs_ids = np.arange(n_hs, dtype = 'int64') if hs_ids is None else np.asarray(hs_ids, dtype = 'int64')
+        self.ptm_ids = np.arange(n_ptms, dtype = 'int64') if ptm_ids is None else np.asarray(ptm_ids)
+        self.ring_ptms = np.zeros(n_ptms, dtype = bool) if ring_ptms is None else np.asarray(ring_ptms, dtype = bool)
+        if len(self.hs_ids) != n_hs or len(self.ptm_ids) != n_ptms or len(self.ring_ptms) != n_ptms:
+            raise ValueError('Number of hs_ids / ptm_ids does not match the PTM location array!')
+
+        # Consecutive hs_ids are located by offset, anything else through a hash index
+        self._start = None
+        self._index = None
+        if n_hs == 0 or np.array_equal(self.hs_ids, self.hs_ids[0] + np.arange(n_hs)):
+            self._start = int(self.hs_ids[0]) if n_hs else 0
+        else:
+            self._index = pd.Index(self.hs_ids)
+
+    @classmethod
+    def from_ptms(cls, ptms_df, start = 0, stop = None, hs_ids = None):
+        """Enumerates the hypothetical structures with hs_id in [start, stop) (same IDs as gen_hss).
+
+        Parameters
+        ----------
+        ptms_df : pd.DataFrame
+            PTM information dataframe.
+        start : int, optional
+            First hypothetical structure ID, by default 0
+        stop : int, optional
+            One past the last hypothetical structure ID (clipped to the total number of
+            structures), by default None (all of them)
+        hs_ids : list, optional
+            Specific hypothetical structure IDs to build instead of a range, by default None
+
+        Returns
+        -------
+        HypotheticalStructureSet
+        """
+        mod_options = _ptm_mod_options(ptms_df)
+        ring_ptms = _is_ring(ptms_df)
+        n_options = _n_ptm_options(ptms_df)
+        n_hss = math.prod(n_options)
+        if hs_ids is None:
+            stop = n_hss if stop is None else min(stop, n_hss)
+            hs_ids = np.arange(start, max(start, stop), dtype='int64')
+        else:
+            hs_ids = np.asarray(hs_ids, dtype = 'int64').reshape(-1)
+            if ((hs_ids < 0) | (hs_ids >= n_hss)).any():
+                raise ValueError('hs_ids must be between 0 and {}!'.format(n_hss - 1))
+        n_sites = [2*mod_count if is_ring else mod_count for (_, mod_count), is_ring in zip(mod_options, ring_ptms)]
+        locs = np.full((len(hs_ids), len(mod_options), max(n_sites, default = 0)), -1, dtype = 'int16')
+
+        # Every structure is a mixed-radix number with one digit (combination / pairing rank) per
+        #   PTM; the last PTM varies fastest just like itertools.product
+        stride = 1
+        for ptm_code in reversed(range(len(mod_options))):
+            mod_poss, mod_count = mod_options[ptm_code]
+            ranks = (hs_ids // stride) % n_options[ptm_code]
+            stride *= n_options[ptm_code]
+            if ring_ptms[ptm_code]:
+                locs[:, ptm_code, :2*mod_count] = _ring_pairings(_ring_candidate_pairs(mod_poss), mod_count)[ranks]
+            else:
+                combs = _unrank_combinations(ranks, len(mod_poss), mod_count)
+                locs[:, ptm_code, :mod_count] = np.asarray(mod_poss, dtype = 'int16')[combs]
+
+        return cls(locs, hs_ids, ptms_df['ptm_id'].values, ring_ptms)
+
+    @classmethod
+    def from_df(cls, hs_df):
+        """Builds the set from a long-form hypothetical structure dataframe (like gen_hss returns).
+
+        Parameters
+        ----------
+        hs_df : pd.DataFrame
+            Hypothetical structure dataframe.
+
+        Returns
+        -------
+        HypotheticalStructureSet
+        """
+        hs_codes, hs_ids = pd.factorize(hs_df['hs_id'])
+        ptm_codes, ptm_ids = pd.factorize(hs_df['ptm_id'])
+        # Ring locations are tuples of (start, end) pairs
+        is_ring_row = np.array([len(loc) > 0 and np.ndim(loc[0]) != 0 for loc in hs_df['ptm_locs']], dtype = bool)
+        ring_ptms = np.bincount(ptm_codes[is_ring_row], minlength = len(ptm_ids)) > 0
+        locs = [tuple(itertools.chain.from_iterable(loc)) if is_ring else loc
+            for loc, is_ring in zip(hs_df['ptm_locs'], is_ring_row)]
+        n_locs = np.fromiter((len(loc) for loc in locs), dtype = 'int64', count = len(locs))
+        pos = np.fromiter(itertools.chain.from_iterable(locs), dtype = 'int64', count = n_locs.sum())
+
+        # Slot of every position within its PTM's locations
+        slots = np.arange(len(pos)) - np.repeat(np.cumsum(n_locs) - n_locs, n_locs)
+        hs_locs = np.full((len(hs_ids), len(ptm_ids), n_locs.max(initial = 0)), -1, dtype = 'int16')
+        hs_locs[np.repeat(hs_codes, n_locs), np.repeat(ptm_codes, n_locs), slots] = pos
+
+        return cls(hs_locs, np.asarray(hs_ids), np.asarray(ptm_ids), ring_ptms)
+
+    def to_df(self):
+        """Converts the set to the long-form dataframe format of gen_hss.
+
+        Returns
+        -------
+        pd.DataFrame
+            Long-form dataframe with PTMs and PTM locations for all the hypothetical structures.
+        """
+        n_hs, n_ptms = self.locs.shape[:2]
+        ptm_locs = [self._loc_tuple(row, is_ring) for row, is_ring
+            in zip(self.locs.reshape(n_hs*n_ptms, -1).tolist(), np.tile(self.ring_ptms, n_hs))]
+
+        return pd.DataFrame({
+            'hs_id': np.repeat(self.hs_ids, n_ptms),
+            'ptm_id': np.tile(self.ptm_ids, n_hs),
+            'ptm_locs': ptm_locs,
+        })
+
+    @staticmethod
+    def _loc_tuple(row, is_ring):
+        """Location tuple of one PTM: positions, or (start, end) pairs for rings."""
+        pos = tuple(p for p in row if p >= 0)
+        return tuple(zip(pos[0::2], pos[1::2])) if is_ring else pos
+
+    def __len__(self):
+        return len(self.hs_ids)
+
+    def __repr__(self):
+        return '<HypotheticalStructureSet: {} structures x {} PTMs>'.format(len(self), len(self.ptm_ids))
+
+    def index_of(self, hs_id):
+        """Row of locs holding a hypothetical structure.
+
+        Raises
+        ------
+        KeyError
+            If the hs_id isn't in the set.
+        """
+        if self._index is not None:
+            return self._index.get_loc(hs_id)
+        i = hs_id - self._start
+        if not 0 <= i < len(self):
+            raise KeyError(hs_id)
+        return int(i)
+
+    def __getitem__(self, key):
+        """PTM locations of one hs_id, or the sub-set for a slice of hs_ids.
+
+        set[hs_id] returns the (n_ptms x max_sites) location array of that structure; set[start:stop]
+        returns the structures with start <= hs_id < stop (a view sharing the locations when the
+        hs_ids are sorted).
+        """
+        if not isinstance(key, slice):
+            return self.locs[self.index_of(key)]
+
+        if key.step not in (None, 1):
+            raise ValueError('hs_id slices do not support a step!')
+        if self._start is not None or np.all(np.diff(self.hs_ids) > 0):
+            lo = 0 if key.start is None else np.searchsorted(self.hs_ids, key.start)
+            hi = len(self) if key.stop is None else np.searchsorted(self.hs_ids, key.stop)
+            return HypotheticalStructureSet(self.locs[lo:hi], self.hs_ids[lo:hi], self.ptm_ids, self.ring_ptms)
+
+        in_range = np.ones(len(self), dtype = bool)
+        if key.start is not None:
+            in_range &= self.hs_ids >= key.start
+        if key.stop is not None:
+            in_range &= self.hs_ids < key.stop
+        return HypotheticalStructureSet(self.locs[in_range], self.hs_ids[in_range], self.ptm_ids, self.ring_ptms)
+
+    def ptm_locs(self, hs_id):
+        """PTM location tuples of one hypothetical structure (one per PTM, as in the ptm_locs column)."""
+        return [self._loc_tuple(row, is_ring) for row, is_ring in zip(self[hs_id].tolist(), self.ring_ptms)]
+
+    def pos_counts(self, ptm_code, seq_len):
+        """Cumulative PTM position counts of every structure for one PTM.
+
+        Parameters
+        ----------
+        ptm_code : int
+            Index of the PTM (along the second axis of locs).
+        seq_len : int
+            Length of the parent sequence.
+
+        Returns
+        -------
+        np.array
+            (n_structures x seq_len+2) array where column c holds the number of modified positions < c
+            (see _ptm_pos_counts). Rings are counted at their start residue.
+        """
+        sites = slice(0, None, 2) if self.ring_ptms[ptm_code] else slice(None)
+        pos = self.locs[:, ptm_code, sites].astype('int64')
+        rows = np.broadcast_to(np.arange(len(self))[:, None], pos.shape)
+        # Padding and positions outside of the sequence never fall inside a fragment
+        in_seq = (pos >= 0) & (pos <= seq_len)
+        pos_hist = np.bincount(rows[in_seq]*(seq_len + 1) + pos[in_seq], minlength = len(self)*(seq_len + 1))
+
+        counts = np.zeros((len(self), seq_len + 2), dtype='int64')
+        np.cumsum(pos_hist.reshape(len(self), seq_len + 1), axis=1, out=counts[:, 1:])
+
+        return counts
+
+    def ring_cuts(self, seq_len):
+        """Which backbone cuts of every structure fall inside a ring.
+
+        Each ring [start, end] covers the cuts start..end-1 (cut c separates residue c from
+        c+1); ring coverage is added up as +1 / -1 steps at the ends of those intervals.
+
+        Parameters
+        ----------
+        seq_len : int
+            Length of the parent sequence.
+
+        Returns
+        -------
+        np.array
+            (n_structures x seq_len+1) boolean array, True where cut c is inside a ring.
+        """
+        steps = np.zeros((len(self), seq_len + 2), dtype = 'int64')
+        rows = np.arange(len(self))[:, None]
+        for ptm_code in np.flatnonzero(self.ring_ptms):
+            starts = self.locs[:, ptm_code, 0::2].astype('int64')
+            ends = self.locs[:, ptm_code, 1::2].astype('int64')
+            # Padding ends up at -1 on both sides and cancels out
+            np.add.at(steps, (np.broadcast_to(rows, starts.shape), np.clip(starts, 0, seq_len + 1)), 1)
+            np.add.at(steps, (np.broadcast_to(rows, ends.shape), np.clip(ends, 0, seq_len + 1)), -1)
+
+        return np.cumsum(steps, axis = 1)[:, :seq_len + 1] > 0
+
+
+def gen_hss_range(ptms_df, start, stop):
+    """Generate the hypothetical structures with hs_id in [start, stop).
+
+    Any range can be computed on its own; the IDs and PTM locations are identical to the
+    corresponding rows of gen_hss.
+
+    Parameters
+    ----------
+    ptms_df : pd.DataFrame
+        PTM information dataframe.
+    start : int
+        First hypothetical structure ID.
+    stop : int
+        One past the last hypothetical structure ID (clipped to the total number of structures).
+
+    Returns
+    -------
+    pd.DataFrame
+        Long-form dataframe with PTMs and PTM locations for the hypothetical structures in the range.
+    """
+    return HypotheticalStructureSet.from_ptms(ptms_df, start, stop).to_df()
+
+def iter_hss(ptms_df, chunk_size = 10000):
+    """Lazily generate hypothetical structures in chunks of consecutive hs_ids.
+
+    Parameters
+    ----------
+    ptms_df : pd.DataFrame
+        PTM information dataframe.
+    chunk_size : int, optional
+        Number of hypothetical structures per chunk, by default 10000
+
+    Yields
+    ------
+    pd.DataFrame
+        Long-form hypothetical structure dataframe for the next chunk of hs_ids.
+    """
+    n_hss = count_hss(ptms_df)
+    for start in range(0, n_hss, chunk_size):
+        yield gen_hss_range(ptms_df, start, start + chunk_size)
+
+@instrumented
+def gen_hss(ptms_df, max_hss = None):
+    """Generate hypothetical structures by marrying all combinations of all PTMs.
+
+    Parameters
+    ----------
+    ptms_df : pd.DataFrame
+        DataFrame with the post-translational modification information contained.
+        Columns it should have: an ID "ptm_id", positions possible for modification "poss_mod_pos",
+        and total number of mods observed "num_mods".
+    max_hss : int, optional
+        Refuse to enumerate more hypothetical structures than this, by default None (no limit).
+        A warning is raised for anything above HSS_WARN_LIMIT either way.
+
+    Returns
+    -------
+    pd.DataFrame
+        Long-form dataframe with PTMs and PTM locations for all the hypothetical structures.
+
+    Raises
+    ------
+    ValueError
+        If the number of hypothetical structures is larger than max_hss.
+    """
+    # Check the size of the combinatorial space before building any of it
+    n_hss = count_hss(ptms_df)
+    if max_hss is not None and n_hss > max_hss:
+        raise ValueError(
+            '{} hypothetical structures exceeds the limit of {}! Use iter_hss to enumerate them in chunks.'
+            .format(n_hss, max_hss)
+            )
+    if n_hss > HSS_WARN_LIMIT:
+        warnings.warn(
+            'Enumerating {} hypothetical structures; consider iter_hss to enumerate them in chunks.'
+            .format(n_hss)
+        )
+
+    return gen_hss_range(ptms_df, 0, n_hss)
+
+
+def _encode_seq(parent_seq):
+    """Encodes a peptide sequence as an array of polymerized residue masses.
+
+    Parameters
+    ----------
+    parent_seq : str
+        Peptide AA sequence.
+
+    Returns
+    -------
+    np.array
+        Residue mass for each position of the sequence.
+    """
+    mw_lookup = dict(zip(aa_mws['name'], aa_mws['mw']))
+    unknown = sorted(set(parent_seq) - set(mw_lookup))
+    if unknown:
+        raise ValueError('Unknown amino acid(s) {} in the parent sequence!'.format(unknown))
+
+    return np.array([mw_lookup[AA] for AA in parent_seq], dtype='float64')
+
+
+def _frag_template(parent_seq, N_term_mod, C_term_mod):
+    """Builds the fragment layout shared by every hypothetical structure of a parent sequence.
+
+    Fragments are ordered b-ions from the shortest up, then the parent ion, then y-ions from
+    the longest down. Residue masses are summed starting from the N-term side of each
+    fragment, so they are bit-identical to adding up the residues one at a time.
+
+    Parameters
+    ----------
+    parent_seq : str
+        Untruncated peptide sequence
+    N_term_mod : float
+        N-terminal modification mass shift.
+    C_term_mod : float
+        C-terminal modification mass shift.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per fragment with its sequence, length, ion type, name, unmodified mass
+        ("base_mw"), the inclusive range of PTM positions it picks up ("pos_lo", "pos_hi") and
+        the backbone cut it comes from ("cut", 0 for the parent ion).
+    """
+    res_mws = _encode_seq(parent_seq)
+    seq_len = len(parent_seq)
+
+    # Residue sums of every prefix (b-ions) and every suffix (parent and y-ions)
+    prefix_mws = np.cumsum(res_mws)
+    suffix_mws = np.zeros(seq_len)
+    for i in range(seq_len):
+        suffix_mws[:i + 1] += res_mws[i]
+
+    b_lens = np.arange(1, seq_len)
+    y_lens = np.arange(seq_len, 0, -1) # The full-length "y-ion" is the parent ion
+    ion_lens = np.concatenate((b_lens, y_lens))
+    b_y_p = np.array(['b']*len(b_lens) + ['p'] + ['y']*(seq_len - 1), dtype=object)
+
+    term_mods = np.full(len(ion_lens), C_term_mod, dtype='float64')
+    term_mods[b_y_p == 'b'] = N_term_mod
+    term_mods[b_y_p == 'p'] = N_term_mod + C_term_mod
+
+    frag_tmpl = pd.DataFrame({
+        'seq': [parent_seq[:n] for n in b_lens] + [parent_seq[-n:] for n in y_lens],
+        'ion_len': ion_lens,
+        'b_y_p': b_y_p,
+        'ion_name': [t if t == 'p' else t + str(n) for t, n in zip(b_y_p, ion_lens)],
+        'base_mw': np.concatenate((prefix_mws[:-1], suffix_mws)) + term_mods,
+        # b-ions pick up PTMs at positions 0..len, y-ions (and the parent) the last len positions
+        'pos_lo': np.where(b_y_p == 'b', 0, seq_len - ion_lens + 1),
+        'pos_hi': np.where(b_y_p == 'b', ion_lens, seq_len),
+        # b_n and y_(len-n) both come from the cut between residues n and n+1
+        'cut': np.where(b_y_p == 'b', ion_lens, seq_len - ion_lens),
+    })
+
+    return frag_tmpl
+
+
+def _ptm_pos_counts(locs, hs_codes, n_hs, seq_len):
+    """Cumulative PTM position counts for a batch of hypothetical structures.
+
+    Parameters
+    ----------
+    locs : iterable
+        PTM location tuples, one per row of the long-form hypothetical structure dataframe.
+    hs_codes : np.array
+        Integer code (0..n_hs-1) of the hypothetical structure each entry of locs belongs to.
+    n_hs : int
+        Number of hypothetical structures.
+    seq_len : int
+        Length of the parent sequence.
+
+    Returns
+    -------
+    np.array
+        (n_hs x seq_len+2) array where column c holds the number of modified positions < c,
+        so the number of PTMs in the inclusive range [lo, hi] is counts[:, hi+1] - counts[:, lo].
+    """
+    locs = list(locs)
+    n_locs = np.fromiter((len(loc) for loc in locs), dtype='int64', count=len(locs))
+    pos = np.fromiter(itertools.chain.from_iterable(locs), dtype='int64', count=n_locs.sum())
+    rows = np.repeat(hs_codes, n_locs)
+
+    # Positions outside of the sequence never fall inside a fragment
+    in_seq = (pos >= 0) & (pos <= seq_len)
+    pos_hist = np.zeros((n_hs, seq_len + 1), dtype='int64')
+    np.add.at(pos_hist, (rows[in_seq], pos[in_seq]), 1)
+
+    counts = np.zeros((n_hs, seq_len + 2), dtype='int64')
+    np.cumsum(pos_hist, axis=1, out=counts[:, 1:])
+
+    return counts
+
+
+def _frag_ptm_counts(hs_df, frag_tmpl, seq_len):
+    """Counts how many of each PTM falls in every fragment of every hypothetical structure.
+
+    Parameters
+    ----------
+    hs_df : pd.DataFrame or HypotheticalStructureSet
+        Hypothetical structures.
+    frag_tmpl : pd.DataFrame
+        Fragment layout from _frag_template.
+    seq_len : int
+        Length of the parent sequence.
+
+    Returns
+    -------
+    np.array
+        Hypothetical structure IDs (in order of first appearance in hs_df).
+    np.array
+        PTM IDs (in order of first appearance in hs_df).
+    np.array
+        (n_ptms x n_hs x n_fragments) array of PTM counts.
+    """
+    pos_lo = frag_tmpl['pos_lo'].values
+    pos_hi = frag_tmpl['pos_hi'].values
+
+    hs_df = _as_ring_aware(hs_df)
+    if isinstance(hs_df, HypotheticalStructureSet):
+        hs_ids, ptm_ids = hs_df.hs_ids, hs_df.ptm_ids
+        ptm_pos_counts = lambda ptm_code: hs_df.pos_counts(ptm_code, seq_len)
+    else:
+        hs_codes, hs_ids = pd.factorize(hs_df['hs_id'])
+        ptm_codes, ptm_ids = pd.factorize(hs_df['ptm_id'])
+        ptm_pos_counts = lambda ptm_code: _ptm_pos_counts(hs_df['ptm_locs'].values[ptm_codes == ptm_code],
+            hs_codes[ptm_codes == ptm_code], len(hs_ids), seq_len)
+
+    counts = np.zeros((len(ptm_ids), len(hs_ids), len(frag_tmpl)), dtype = 'int64')
+    for ptm_code in range(len(ptm_ids)):
+        pos_counts = ptm_pos_counts(ptm_code)
+        counts[ptm_code] = pos_counts[:, pos_hi + 1] - pos_counts[:, pos_lo]
+
+    return np.asarray(hs_ids), np.asarray(ptm_ids), counts
+
+def _as_ring_aware(hs_df):
+    """Hypothetical structure dataframes with ring PTMs are converted to a HypotheticalStructureSet."""
+    if isinstance(hs_df, HypotheticalStructureSet):
+        return hs_df
+    if any(len(loc) > 0 and np.ndim(loc[0]) != 0 for loc in hs_df['ptm_locs']):
+        return HypotheticalStructureSet.from_df(hs_df)
+    return hs_df
+
+def _frag_present(hs_df, frag_tmpl, seq_len):
+    """Which fragments of every hypothetical structure can be formed.
+
+    Fragments from a cut inside a ring don't appear, since the ring holds the two sides together.
+
+    Parameters
+    ----------
+    hs_df : pd.DataFrame or HypotheticalStructureSet
+        Hypothetical structures.
+    frag_tmpl : pd.DataFrame
+        Fragment layout from _frag_template.
+    seq_len : int
+        Length of the parent sequence.
+
+    Returns
+    -------
+    np.array or None
+        (n_hs x n_fragments) boolean array, or None if there are no ring PTMs (every fragment
+        is formed).
+    """
+    hs_df = _as_ring_aware(hs_df)
+    if not isinstance(hs_df, HypotheticalStructureSet) or not hs_df.ring_ptms.any():
+        return None
+
+    return ~hs_df.ring_cuts(seq_len)[:, frag_tmpl['cut'].values]
+
+def _shift_masses(base_mws, ptms_df, ptm_ids, counts):
+    """Adds PTM mass shifts to unmodified fragment masses.
+
+    Parameters
+    ----------
+    base_mws : np.array
+        Unmodified fragment masses (broadcastable against counts[0]).
+    ptms_df : pd.DataFrame
+        PTM information dataframe.
+    ptm_ids : np.array
+        PTM ID of each entry of the first axis of counts.
+    counts : np.array
+        Number of each PTM in each fragment.
+
+    Returns
+    -------
+    np.array
+        Shifted fragment masses.
+    """
+    masses = base_mws
+    # Shift masses by the number of each PTM included in each fragment (always in the same order)
+    for ptm_id, ptm_counts in zip(ptm_ids, counts):
         ptm_shift = ptms_df[ptms_df['ptm_id'] == ptm_id]['m_shift'].values[0]
-        # count the numbers of PTM in the fragment
-        ptm_locs = hs_sub_df[hs_sub_df['ptm_id'] == ptm_id]['ptm_locs'].values[0]
-        num_included_ptms = len([x for x in ptm_locs if (x >= ptm_range[0] and x <= ptm_range[1])])
-        # Shift mass by number of PTMs and the according mass shift
-        mass = mass + ptm_shift*num_included_ptms
-
-    hyp_ion_row = {
-        'hs_id': hs_id, 'seq': trunc_seq, 'hyp_mw': mass, 'ion_name': ion_name, 
-        'human_name': ion_name, 'b_y_p': ion_type
-    }
-    
-    return hyp_ion_row
+        masses = masses + ptm_shift*ptm_counts
 
-def frag_hs(hs_df, ptms_df, parent_seq, N_term_mod, C_term_mod):
-    """Fragments parental sequence for each hypothetical structure from N-term and C-term.
-    Uses the PTM locations to define the masses for each fragment. 
+    return np.broadcast_to(masses, np.shape(counts)[1:]).copy()
+
+def _frag_mass_matrix(hs_df, ptms_df, frag_tmpl, seq_len):
+    """Calculates the masses of every fragment of every hypothetical structure in one batch.
 
     Parameters
     ----------
@@ -169,6 +928,56 @@ def frag_hs(hs_df, ptms_df, parent_seq, N_term_mod, C_term_mod):
         Hypothetical structure dataframe.
     ptms_df : pd.DataFrame
         PTM information dataframe.
+    frag_tmpl : pd.DataFrame
+        Fragment layout from _frag_template.
+    seq_len : int
+        Length of the parent sequence.
+
+    Returns
+    -------
+    np.array
+        Hypothetical structure IDs (in order of first appearance in hs_df).
+    np.array
+        (n_hs x n_fragments) array of fragment masses, NaN for fragments from a cut inside a ring.
+    """
+    hs_df = _as_ring_aware(hs_df)
+    hs_ids, ptm_ids, counts = _frag_ptm_counts(hs_df, frag_tmpl, seq_len)
+    masses = _shift_masses(frag_tmpl['base_mw'].values, ptms_df, ptm_ids, counts)
+    present = _frag_present(hs_df, frag_tmpl, seq_len)
+    if present is not None:
+        masses[~present] = np.nan
+
+    return hs_ids, masses
+
+def _warn_ptm_bounds(hs_df, parent_seq):
+    """Throws a warning if PTMs are specified outside the bounds of the parent peptide sequence"""
+    hs_df = _as_ring_aware(hs_df)
+    if isinstance(hs_df, HypotheticalStructureSet):
+        max_ptm_locs = pd.Series(hs_df.locs.max(axis = (1, 2), initial = 0), index = hs_df.hs_ids)
+    else:
+        row_max_locs = pd.Series([max(locs, default = 0) for locs in hs_df['ptm_locs']], index = hs_df.index)
+        max_ptm_locs = row_max_locs.groupby(hs_df['hs_id'], sort = False).max()
+    for hs_id, max_ptm_loc in max_ptm_locs[max_ptm_locs > len(parent_seq)].items():
+        warnings.warn(
+            'PTM location of {} is larger than the length of the parent peptide in HS id {}'
+            .format(max_ptm_loc, hs_id)
+        )
+
+@instrumented
+def frag_hs(hs_df, ptms_df, parent_seq, N_term_mod, C_term_mod):
+    """Fragments parental sequence for each hypothetical structure from N-term and C-term.
+    Uses the PTM locations to define the masses for each fragment.
+
+    The parent sequence is encoded once; masses for every structure are then built from
+    cumulative residue sums plus per-PTM position counts in a single batched operation.
+    Fragments from a cut inside a ring PTM are left out.
+
+    Parameters
+    ----------
+    hs_df : pd.DataFrame or HypotheticalStructureSet
+        Hypothetical structures.
+    ptms_df : pd.DataFrame
+        PTM information dataframe.
     parent_seq : str
         Untruncated peptide sequence
     N_term_mod : float
@@ -183,71 +992,172 @@ def frag_hs(hs_df, ptms_df, parent_seq, N_term_mod, C_term_mod):
     """
 
     columns = ['hs_id', 'seq', 'hyp_mw', 'ion_name', 'human_name', 'b_y_p']
-    frag_df = pd.DataFrame(columns= columns)
+    if len(hs_df) == 0:
+        return pd.DataFrame(columns= columns)
 
-    # Iterate through each hypothetical sequence and specify the mass
-    for hs_id in hs_df['hs_id'].unique():
+    hs_df = _as_ring_aware(hs_df)
+    _warn_ptm_bounds(hs_df, parent_seq)
 
-        # Pull PTM locations from hs_df
-        hs_sub_df = hs_df[hs_df['hs_id'] == hs_id]
+    frag_tmpl = _frag_template(parent_seq, N_term_mod, C_term_mod)
+    hs_ids, masses = _frag_mass_matrix(hs_df, ptms_df, frag_tmpl, len(parent_seq))
+
+    # Unroll the (structures x fragments) mass array into one row per fragment
+    n_hs = len(hs_ids)
+    frag_df = pd.DataFrame({
+        'hs_id': np.repeat(hs_ids, len(frag_tmpl)),
+        'seq': np.tile(frag_tmpl['seq'].values, n_hs),
+        'hyp_mw': masses.ravel(),
+        'ion_name': np.tile(frag_tmpl['ion_name'].values, n_hs),
+        'human_name': np.tile(frag_tmpl['ion_name'].values, n_hs),
+        'b_y_p': np.tile(frag_tmpl['b_y_p'].values, n_hs),
+    }, columns = columns)
+
+    # Fragments held together by a ring
+    formed = np.isfinite(masses.ravel())
+    if not formed.all():
+        frag_df = frag_df[formed].reset_index(drop = True)
 
-        # Throw a warning if PTMs are specified outside the bounds of the parent peptide sequence
-        max_ptm_loc = np.max(hs_sub_df['ptm_locs'].values[0])
-        if max_ptm_loc > len(parent_seq):
-            warnings.warn(
-                'PTM location of {} is larger than the length of the parent peptide in HS id {}'
-                .format(max_ptm_loc, hs_id)
-            )
-        
-        # Truncate from the C-term
-        for i in range(1,len(parent_seq)):
-            trunc_seq = parent_seq[:i]
-            new_row = _get_mass_seq(trunc_seq, hs_sub_df, ptms_df, 'C', parent_seq, N_term_mod, C_term_mod)
-            
-            frag_df = frag_df.append(new_row, ignore_index=True)
-        
-        # Truncate from the N-term
-        for i in range(0,len(parent_seq)):
-            trunc_seq = parent_seq[i:]        
-            new_row = _get_mass_seq(trunc_seq, hs_sub_df, ptms_df, 'N', parent_seq, N_term_mod, C_term_mod)
-            
-            frag_df = frag_df.append(new_row, ignore_index=True)
-        
     return frag_df
 
 
-def _add_charge(frag_df,charge_N, proton_m):
-    """Returns dataframe with charged ions m/z values.
+@instrumented
+def frag_signatures(hs_df, ptms_df, parent_seq, N_term_mod, C_term_mod):
+    """Fragments hypothetical structures into unique fragment signatures.
+
+    A fragment's mass only depends on its ion type, its length and how many of each PTM it
+    holds, so most fragments are shared between hypothetical structures. Each unique
+    (fragment, PTM count vector) signature is listed once, plus a mapping from every
+    structure's fragments to their signatures. Charging, matching and scoring can then run
+    once per signature (see scoring.score_signatures).
 
     Parameters
     ----------
-    frag_df : pd.DataFrame
-        Fragmented ion dataframe.
-    charge_N : int
-        Number of charges to add
-    proton_m: float
-        Mass of a proton constant
-    
+    hs_df : pd.DataFrame or HypotheticalStructureSet
+        Hypothetical structures.
+    ptms_df : pd.DataFrame
+        PTM information dataframe.
+    parent_seq : str
+        Untruncated peptide sequence
+    N_term_mod : float
+        N-terminal modification mass shift.
+    C_term_mod : float
+        C-terminal modification mass shift.
+
     Returns
+    -------
+    sig_df : pd.DataFrame
+        One row per signature ("sig_id") with the same columns as frag_hs (minus "hs_id"), the
+        ion length and the number of each PTM ("ptm<ptm_id>_count").
+    hs_ids : np.array
+        Hypothetical structure IDs.
+    hs_sigs : np.array
+        (n_hs x n_fragments) array with the signature ID of each fragment of each structure,
+        fragments in the same order as frag_hs (-1 for fragments from a cut inside a ring).
+    """
+    _warn_ptm_bounds(hs_df, parent_seq)
+
+    frag_tmpl = _frag_template(parent_seq, N_term_mod, C_term_mod)
+    hs_df = _as_ring_aware(hs_df)
+    hs_ids, ptm_ids, counts = _frag_ptm_counts(hs_df, frag_tmpl, len(parent_seq))
+    n_frags = len(frag_tmpl)
+
+    # Pack (fragment, PTM counts) into a single integer key and keep the unique ones
+    radices = counts.max(axis = (1, 2), initial = 0) + 1
+    keys = np.broadcast_to(np.arange(n_frags, dtype = 'int64'), counts.shape[1:])
+    for ptm_counts, radix in zip(counts, radices):
+        keys = keys*radix + ptm_counts
+    present = _frag_present(hs_df, frag_tmpl, len(parent_seq))
+    if present is None:
+        sig_keys, hs_sigs = np.unique(keys, return_inverse = True)
+        hs_sigs = hs_sigs.reshape(keys.shape).astype('int32')
+    else:
+        sig_keys, present_sigs = np.unique(keys[present], return_inverse = True)
+        hs_sigs = np.full(keys.shape, -1, dtype = 'int32')
+        hs_sigs[present] = present_sigs
+
+    # Unpack the signatures again
+    sig_counts = []
+    for radix in radices[::-1]:
+        sig_counts.append(sig_keys % radix)
+        sig_keys = sig_keys // radix
+    sig_counts = np.array(sig_counts[::-1], dtype = 'int64').reshape(len(ptm_ids), -1)
+    sig_frags = frag_tmpl.iloc[sig_keys].reset_index(drop = True)
+
+    sig_df = pd.DataFrame({
+        'sig_id': np.arange(len(sig_frags)),
+        'seq': sig_frags['seq'],
+        'hyp_mw': _shift_masses(sig_frags['base_mw'].values, ptms_df, ptm_ids, sig_counts),
+        'ion_name': sig_frags['ion_name'],
+        'human_name': sig_frags['ion_name'],
+        'b_y_p': sig_frags['b_y_p'],
+        'ion_len': sig_frags['ion_len'],
+        **{'ptm{}_count'.format(ptm_id): ptm_counts for ptm_id, ptm_counts in zip(ptm_ids, sig_counts)},
+    })
+
+    return sig_df, hs_ids, hs_sigs
+
+
+def _charged_ion_names(names, charge, is_parent):
+    """LaTeX ion names (e.g. "$b_{12}^{+2}$") for one charge state.
+
+    Parameters
     ----------
-    pd.DataFrame
-        Dataframe with charges added to m/z values.
+    names : list
+        Uncharged ion names (e.g. "b12", "p").
+    charge : int
+        Number of charges (0 for the deconvoluted mass).
+    is_parent : list
+        Whether each ion is the parent ion.
+
+    Returns
+    -------
+    list
+        Ion names formatted so they display nicely when plotted.
     """
+    ion_names = []
+    for name, parent in zip(names, is_parent):
+        # Parental ions don't get a subscript
+        ion_name = name[0] + ('' if parent else '_') + '{' + name[1:] + '}'
+        if charge:
+            ion_name = ion_name + '^' + '{+' + str(charge) + '}'
+        ion_names.append('$' + ion_name + '$')
 
-    charge_df = frag_df.copy()
-    charge_df['charge'] = charge_N
-    charge_df['hyp_mw'] = (charge_df['hyp_mw'] + charge_N*proton_m) / charge_N
-    charge_df['human_name'] = charge_df['human_name'] + '+' + str(charge_N)
-    charge_df['ion_name'] = charge_df['ion_name'] + '^' + '{+'+ str(charge_N)+'}'
+    return ion_names
 
-    return charge_df
+def _expand_labels(name_codes, label_lists):
+    """Categorical labels for the charge-major rows of mk_charge_df.
 
+    Parameters
+    ----------
+    name_codes : np.array
+        Code of each (uncharged) fragment into the per-charge label lists.
+    label_lists : list
+        Labels of every code for each charge state, in row order.
+
+    Returns
+    -------
+    pd.Categorical
+        One label per (charge state, fragment) row.
+    """
+    n_codes = len(label_lists[0]) if label_lists else 0
+    row_codes = np.concatenate([name_codes + i*n_codes for i in range(len(label_lists))])
+    # Different (name, charge) pairs could still render the same label
+    cat_codes, categories = pd.factorize(np.array(sum(label_lists, []), dtype = object))
+
+    return pd.Categorical.from_codes(cat_codes[row_codes], categories)
+
+@instrumented
 def mk_charge_df(frag_df, charges, proton_m):
     """Makes charged versions of fragmented ions. 
     
     Charges the values provided in charges list. Also changes the ion name so it plots well
     as a label.
 
+    The m/z values of every charge state are computed in one (charges x fragments) broadcast.
+    "ion_name" and "human_name" are categoricals: the label strings are only rendered once
+    per distinct ion and charge, and plotting / exporting reads them through the category
+    codes (use .astype(str) where plain strings are needed).
+
     Parameters
     ----------
     frag_df : pd.DataFrame
@@ -260,23 +1170,107 @@ def mk_charge_df(frag_df, charges, proton_m):
     Returns
     -------
     pd.DataFrame
-        Fragmented dataframe with charged versions appended.
+        Fragmented dataframe with charged versions appended (charge 0 is the deconvoluted mass).
+    """
+    # Everything that is uncharged is a deconvoluted mass
+    all_charges = [0] + list(charges)
+    n_states = len(all_charges)
+
+    hyp_mw = frag_df['hyp_mw'].values.astype('float64')
+    charged_mw = np.empty((n_states, len(frag_df)), dtype = 'float64')
+    charged_mw[0] = hyp_mw
+    for i, charge_N in enumerate(all_charges[1:], start = 1):
+        charged_mw[i] = (hyp_mw + charge_N*proton_m) / charge_N
+
+    # Labels only depend on the ion name, whether it's the parent and the charge
+    is_parent = (frag_df['b_y_p'] == 'p').values
+    name_codes, name_uniques = pd.factorize(frag_df['ion_name'].astype(str).values)
+    label_codes, label_keys = pd.factorize(name_codes*2 + is_parent)
+    label_names = [name_uniques[key // 2] for key in label_keys]
+    label_parents = [bool(key % 2) for key in label_keys]
+    ion_labels = [_charged_ion_names(label_names, N, label_parents) for N in all_charges]
+
+    human_codes, human_uniques = pd.factorize(frag_df['human_name'].astype(str).values)
+    human_labels = [[name + '+' + str(N) if N else name for name in human_uniques] for N in all_charges]
+
+    frag_df_charged = pd.DataFrame({
+        frag_df.index.name or 'index': np.tile(frag_df.index.values, n_states),
+        **{col: np.tile(frag_df[col].values, n_states) for col in frag_df.columns},
+    })
+    frag_df_charged['hyp_mw'] = charged_mw.ravel()
+    frag_df_charged['ion_name'] = _expand_labels(label_codes, ion_labels)
+    frag_df_charged['human_name'] = _expand_labels(human_codes, human_labels)
+    frag_df_charged['charge'] = np.repeat(np.array(all_charges, dtype = 'int64'), len(frag_df))
+
+    return frag_df_charged
+
+def _match_charged_masses(spectra_df, frag_tmpl, masses, charges, proton_m, tol, tol_unit = 'Da', hs_ids = None,
+        mz_index = None):
+    """Matches the charged ions of a batch of fragment masses against the spectra without building
+    the full charged fragment dataframe.
+
+    The ions are the same (and in the same order) as frag_hs followed by mk_charge_df, but their
+    m/z values are kept as one flat array and only the matched ions get dataframe rows.
+
+    Parameters
+    ----------
+    spectra_df : pd.DataFrame
+        Dataframe with all the (s/n filtered) ms/ms spectra provided.
+    frag_tmpl : pd.DataFrame
+        Fragment layout from _frag_template.
+    masses : np.array
+        (n_hs x n_fragments) array of fragment masses (NaN for fragments that don't form).
+    charges : list
+        List of integer numbers of hydrogens to add.
+    proton_m : float
+        Constant for mass of a proton.
+    tol : float
+        +/- tolerance to use for matching m/z values.
+    tol_unit : str, optional
+        Either 'Da' or 'ppm', by default 'Da'
+    hs_ids : np.array, optional
+        Hypothetical structure ID of each row of masses, by default None (no "hs_id" column)
+    mz_index : tuple, optional
+        Sorted observed m/z index from scoring._mz_index, by default None (built from spectra_df)
+
+    Returns
+    -------
+    matched_df : pd.DataFrame
+        Matched ions with the mk_charge_df columns ("hs_id", "seq", "hyp_mw", "ion_name",
+        "human_name", "b_y_p", "charge"), the ion length ("ion_len") and the spectra columns,
+        like match_ions.
+    hyp_pos : np.array
+        Position of each matched ion in the flat (charge state x structure x fragment) ion array.
     """
-    # Add additional column for charge state; Everything that is uncharged is a deconvoluted mass
-    new_frag_df = frag_df.copy()
-    new_frag_df['charge'] = 0
-    # Add brackets on name
-    new_frag_df['ion_name'] = new_frag_df['ion_name'].apply((lambda x: x[0] + '_' + '{' + x[1:] + '}')) 
-
-    # Create list of charged dfs and concatenate them
-    charged_dfs = [_add_charge(new_frag_df, N, proton_m) for N in charges]
-    frag_df_charged = pd.concat([new_frag_df] + charged_dfs).reset_index()
-
-    # Do some formatting on the name so it displays nicely when plotted
-    frag_df_charged['ion_name'] = frag_df_charged['ion_name'].apply((lambda x: '$' + x + '$'))
-    # Some shenanigans to fix the parental ion names
-    frag_df_charged.loc[frag_df_charged['b_y_p'] == 'p', 'ion_name'] = frag_df_charged.loc[
-        frag_df_charged['b_y_p'] == 'p', 'ion_name'
-        ].apply((lambda x: x[:2] + x[3:]))
-
-    return frag_df_charged
\ No newline at end of file
+    all_charges = [0] + list(charges)
+    n_hs, n_frags = masses.shape
+
+    # Deconvoluted masses plus every charge state, in the same order as mk_charge_df
+    ions_mz = np.stack([masses] + [(masses + charge_N*proton_m) / charge_N for charge_N in charges]).ravel()
+    if mz_index is None:
+        mz_index = scoring._mz_index(spectra_df)
+    hyp_pos, obs_pos = scoring._match_pairs(mz_index, ions_mz, tol, tol_unit)
+
+    # Labels of every (charge state, fragment) pair, like mk_charge_df
+    names = list(frag_tmpl['ion_name'])
+    is_parent = list(frag_tmpl['b_y_p'] == 'p')
+    ion_labels = sum([_charged_ion_names(names, N, is_parent) for N in all_charges], [])
+    human_labels = [name + '+' + str(N) if N else name for N in all_charges for name in names]
+    frag_pos = hyp_pos % n_frags
+    state_pos = hyp_pos // (n_frags*n_hs)
+    label_codes = state_pos*n_frags + frag_pos
+
+    ions_df = pd.DataFrame({
+        'seq': frag_tmpl['seq'].values[frag_pos],
+        'hyp_mw': ions_mz[hyp_pos],
+        'ion_name': pd.Categorical.from_codes(label_codes, ion_labels),
+        'human_name': pd.Categorical.from_codes(label_codes, human_labels),
+        'b_y_p': frag_tmpl['b_y_p'].values[frag_pos],
+        'ion_len': frag_tmpl['ion_len'].values[frag_pos],
+        'charge': np.array(all_charges, dtype = 'int64')[state_pos],
+    })
+    if hs_ids is not None:
+        ions_df.insert(0, 'hs_id', np.asarray(hs_ids)[(hyp_pos // n_frags) % n_hs])
+    matched_df = pd.concat([ions_df, spectra_df.iloc[obs_pos].reset_index(drop = True)], sort = False, axis = 1)
+
+    return matched_df, hyp_pos
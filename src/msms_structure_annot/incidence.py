@@ -0,0 +1,134 @@
+"""Incidence matrix scoring functions.
+
+Scores hypothetical structures with sparse linear algebra instead of a matched ion
+dataframe. The fragment table is turned into a (structures x unique fragment m/z)
+incidence matrix once; the spectra are turned into an observed weight for every unique
+fragment m/z with a single tolerance join. Scores are then one sparse matrix-vector
+product, so the structures can be rescored cheaply whenever the spectra or weights change:
+
+    incidence = IncidenceMatrix(frag_df_charged)
+    scores_df = incidence.score(ms_df_sn_filter, tol, N_spec, score_method = 'weights')
+
+"""
+import pandas as pd
+import numpy as np
+from scipy import sparse
+from msms_structure_annot import scoring
+
+class IncidenceMatrix:
+    """Sparse (structures x unique fragment m/z) incidence matrix of a fragment table.
+
+    Entry [i, u] is the number of ions of hypothetical structure i with the u-th unique m/z.
+
+    Parameters
+    ----------
+    all_ions_df : pd.DataFrame
+        Dataframe of all hypothetical fragment ions (e.g. from mk_charge_df).
+    """
+
+    def __init__(self, all_ions_df):
+        hs_codes, hs_ids = pd.factorize(all_ions_df['hs_id'])
+        self.hs_ids = np.asarray(hs_ids).astype(int)
+        self.n_ions = np.bincount(hs_codes, minlength = len(hs_ids))
+
+        # Fragments shared between structures (and charge states landing on the same m/z) get one column
+        self.unique_mz, mz_codes = np.unique(all_ions_df['hyp_mw'].values.astype('float64'), return_inverse = True)
+        self.matrix = sparse.csr_matrix(
+            (np.ones(len(hs_codes)), (hs_codes, mz_codes)), shape = (len(self.hs_ids), len(self.unique_mz)))
+
+    def __repr__(self):
+        return '<IncidenceMatrix: {} structures x {} unique m/z, {} entries>'.format(
+            *self.matrix.shape, self.matrix.nnz)
+
+    def peak_weights(self, spectra_df, tol, score_method = 'frac', tol_unit = 'Da'):
+        """Observed weight of every unique fragment m/z in every spectrum.
+
+        Every unique m/z is matched against the peaks once; the weight of a unique m/z in a
+        spectrum is the summed weight of its matched peaks (1 per peak for "frac",
+        _magic_weights_calc for "weights").
+
+        Scorers are given the matched peaks with their "hyp_mw", so only scorers that depend on
+        the observed peak and its m/z (like "frac" and "weights") can be used here.
+
+        Parameters
+        ----------
+        spectra_df : pd.DataFrame
+            Dataframe with all the (s/n filtered) ms/ms spectra provided.
+        tol : float
+            +/- tolerance to use for matching m/z values.
+        score_method : str, optional
+            Scoring method to be used (any key of scoring.SCORERS), by default 'frac'
+        tol_unit : str, optional
+            Either 'Da' or 'ppm', by default 'Da'
+
+        Returns
+        -------
+        np.array
+            (n_unique_mz x n_spectra) array of weights.
+        np.array
+            Spectrum number of each column.
+
+        Raises
+        ------
+        ValueError
+            If scoring method provided is not a valid method.
+        """
+        if score_method not in scoring.SCORERS:
+            raise ValueError('{method} is not a supported scoring metric'.format(method = score_method))
+
+        mz_pos, obs_pos = scoring._match_pairs(scoring._mz_index(spectra_df), self.unique_mz, tol, tol_unit)
+        spec_codes, spec_nums = pd.factorize(spectra_df['spec_num'], sort = True)
+
+        matched_df = pd.concat([
+            pd.DataFrame({'hyp_mw': self.unique_mz[mz_pos]}),
+            spectra_df.iloc[obs_pos].reset_index(drop = True)
+            ], sort = False, axis = 1)
+        ion_weights = np.asarray(scoring.SCORERS[score_method](matched_df), dtype = 'float64')
+
+        weights = np.bincount(mz_pos*len(spec_nums) + spec_codes[obs_pos], weights = ion_weights,
+            minlength = len(self.unique_mz)*len(spec_nums))
+
+        return weights.reshape(len(self.unique_mz), len(spec_nums)), np.asarray(spec_nums)
+
+    def spectrum_scores(self, weights):
+        """Summed matched weights of every structure in every spectrum.
+
+        Parameters
+        ----------
+        weights : np.array
+            (n_unique_mz x n_spectra) weights from peak_weights (or a single weight vector).
+
+        Returns
+        -------
+        np.array
+            (n_structures x n_spectra) array (or one value per structure for a weight vector).
+        """
+        return self.matrix @ weights
+
+    def score(self, spectra_df, tol, N_spectra, score_method = 'frac', tol_unit = 'Da'):
+        """Scores every hypothetical structure (same scores as match_ions followed by score_wrapper).
+
+        Parameters
+        ----------
+        spectra_df : pd.DataFrame
+            Dataframe with all the (s/n filtered) ms/ms spectra provided.
+        tol : float
+            +/- tolerance to use for matching m/z values.
+        N_spectra : int
+            Number of spectra provided.
+        score_method : str, optional
+            Scoring method to be used, by default 'frac'
+        tol_unit : str, optional
+            Either 'Da' or 'ppm', by default 'Da'
+
+        Returns
+        -------
+        pd.DataFrame
+            Dataframe with scores for all the hypothetical structures
+        """
+        weights, _ = self.peak_weights(spectra_df, tol, score_method, tol_unit)
+        sum_weights = self.spectrum_scores(weights.sum(axis = 1))
+
+        return pd.DataFrame({
+            'hs_id': self.hs_ids, 'score': sum_weights / (self.n_ions*N_spectra), 'score_method': score_method
+        })
@@ -0,0 +1,153 @@
+"""Instrumentation functions.
+
+Opt-in timing and memory records for the msprocess, hsmakers, scoring and plotters entry
+points. Nothing is recorded (and the overhead is a flag check) until it's turned on:
+
+    from msms_structure_annot import instrument
+    with instrument.recording():
+        ... run the notebook steps ...
+    instrument.summary_table()            # one row per stage
+    instrument.dump_json(output_folder / 'profile.json')
+
+Records are kept per process; calls made in worker processes aren't recorded.
+
+"""
+import contextlib
+import functools
+import inspect
+import json
+import time
+import tracemalloc
+import pandas as pd
+import numpy as np
+
+_state = {
+    'enabled': False,
+    'track_memory': True,
+    'records': [],
+    'depth': 0,
+}
+
+def enable(track_memory = True):
+    """Starts recording instrumented calls.
+
+    Parameters
+    ----------
+    track_memory : bool, optional
+        Also record the peak memory of each outermost call with tracemalloc (slows calls down),
+        by default True
+    """
+    _state['enabled'] = True
+    _state['track_memory'] = track_memory
+
+def disable():
+    """Stops recording instrumented calls (records are kept)."""
+    _state['enabled'] = False
+
+def reset():
+    """Deletes all the records."""
+    _state['records'] = []
+
+def is_enabled():
+    """Whether instrumented calls are being recorded."""
+    return _state['enabled']
+
+@contextlib.contextmanager
+def recording(track_memory = True):
+    """Records instrumented calls made inside the with block (starting from no records).
+
+    Yields
+    ------
+    list
+        The records, filled in as calls are made.
+    """
+    was_enabled, had_memory = _state['enabled'], _state['track_memory']
+    reset()
+    enable(track_memory)
+    try:
+        yield _state['records']
+    finally:
+        _state['enabled'], _state['track_memory'] = was_enabled, had_memory
+
+def _size(obj):
+    """Number of rows / items of stage inputs and outputs (None for scalars and the like)."""
+    if isinstance(obj, (pd.DataFrame, pd.Series, np.ndarray, list)) or hasattr(obj, 'hs_ids'):
+        return len(obj)
+    if isinstance(obj, tuple):
+        return [_size(item) for item in obj]
+    return None
+
+def instrumented(stage_fn):
+    """Decorator that records the wall time, peak memory and input / output sizes of a stage.
+
+    Input sizes are keyed by parameter name (e.g. "spectra_df", "hs_frag_df"), so the record
+    says how many peaks, fragments, structures, ... went in and how many rows came out.
+    """
+    signature = inspect.signature(stage_fn)
+    stage = '{}.{}'.format(stage_fn.__module__.rsplit('.', 1)[-1], stage_fn.__name__)
+
+    @functools.wraps(stage_fn)
+    def wrapper(*args, **kwargs):
+        if not _state['enabled']:
+            return stage_fn(*args, **kwargs)
+
+        bound = signature.bind_partial(*args, **kwargs)
+        in_sizes = {name: _size(value) for name, value in bound.arguments.items() if _size(value) is not None}
+
+        # Peak memory is only measured for the outermost instrumented call
+        depth = _state['depth']
+        track_memory = _state['track_memory'] and depth == 0 and not tracemalloc.is_tracing()
+        if track_memory:
+            tracemalloc.start()
+        _state['depth'] = depth + 1
+        t_start = time.perf_counter()
+        try:
+            result = stage_fn(*args, **kwargs)
+        finally:
+            wall_s = time.perf_counter() - t_start
+            _state['depth'] = depth
+            peak_mem_mb = None
+            if track_memory:
+                peak_mem_mb = tracemalloc.get_traced_memory()[1] / 1e6
+                tracemalloc.stop()
+
+        _state['records'].append({
+            'stage': stage, 'depth': depth, 'wall_s': wall_s, 'peak_mem_mb': peak_mem_mb,
+            'in_sizes': in_sizes, 'out_size': _size(result),
+        })
+
+        return result
+
+    return wrapper
+
+def records_df():
+    """All the records as a dataframe, one row per call in call-completion order."""
+    return pd.DataFrame(_state['records'],
+        columns = ['stage', 'depth', 'wall_s', 'peak_mem_mb', 'in_sizes', 'out_size'])
+
+def summary_table():
+    """Per-stage summary of the records.
+
+    Returns
+    -------
+    pd.DataFrame
+        Number of calls, total and mean wall time, largest peak memory and the total number of
+        output rows for each stage, slowest first. Calls made from inside another instrumented
+        stage (depth > 0) are also counted in their caller's time.
+    """
+    calls_df = records_df()
+    calls_df['out_rows'] = [size if isinstance(size, int) else np.nan for size in calls_df['out_size']]
+    summary_df = calls_df.groupby('stage').agg(
+        calls = ('wall_s', 'size'),
+        total_s = ('wall_s', 'sum'),
+        mean_s = ('wall_s', 'mean'),
+        peak_mem_mb = ('peak_mem_mb', 'max'),
+        out_rows = ('out_rows', 'sum'),
+    )
+
+    return summary_df.sort_values('total_s', ascending = False)
+
+def dump_json(out_path):
+    """Writes the records to a JSON file (e.g. next to a report)."""
+    with open(out_path, 'w') as f:
+        json.dump(_state['records'], f, indent = 1, default = str)
@@ -3,48 +3,203 @@
 All the mass-spec processing code is here
 
 """
+import os
+import tempfile
+import warnings
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import re
 import numpy as np
+from msms_structure_annot.instrument import instrumented
 
-def import_ms_files(ms_files_dir):
+# MS file names look like ms1.txt, ms2.csv, ...
+_MS_FILE_RE = re.compile(r'^ms(\d+)\.')
+# Header line, e.g. "#MS Peaks One: + Product Ion (rt: 4.241 min) (1194.5400 -> **) (sample.d)"
+_MS_HEADER_RE = re.compile(
+    r'\(rt: (?P<rt>[\d.]+) min\)\s*\((?P<precursor_mz>[\d.]+)'
+    # Optional precursor charge, e.g. "1194.5400 [z=2] -> **" or "1194.5400 (2+) -> **"
+    r'(?:\s*[\[(]?(?:z\s*=\s*)?(?P<precursor_charge>\d+)\+?[\])]?)?'
+    r'\s*->[^)]*\)(?:\s*\((?P<source_file>[^()]*)\))?'
+)
+_META_COLS = ['rt', 'precursor_mz', 'precursor_charge', 'source_file']
+
+def _cache_path(ms_file):
+    """Path of the binary cache file that sits next to an MS file (hidden so it isn't picked up as one)"""
+    return ms_file.parent / ('.' + ms_file.name + '.npz')
+
+def read_ms_header(ms_file):
+    """Reads the spectrum metadata from the header line of an MS file.
+
+    Parameters
+    ----------
+    ms_file : Path
+        Path to the ms/ms file.
+
+    Returns
+    -------
+    dict
+        Retention time in minutes ("rt"), precursor m/z ("precursor_mz"), precursor charge
+        ("precursor_charge") and the source data file ("source_file"). Values are None when
+        they aren't in the header.
+    """
+    with open(ms_file, encoding = 'utf-8-sig') as f:
+        header = f.readline()
+
+    meta = dict.fromkeys(_META_COLS)
+    match = _MS_HEADER_RE.search(header)
+    if match:
+        meta['rt'] = float(match['rt'])
+        meta['precursor_mz'] = float(match['precursor_mz'])
+        if match['precursor_charge']:
+            meta['precursor_charge'] = int(match['precursor_charge'])
+        meta['source_file'] = match['source_file']
+
+    return meta
+
+def _parse_ms_file(ms_file):
+    """Parses the peaks and header of an MS file.
+
+    Parameters
+    ----------
+    ms_file : Path
+        Path to the ms/ms file.
+
+    Returns
+    -------
+    dict
+        "m/z" and "orig_abundance" arrays plus the header metadata.
+    """
+    # Import the csv file (tab separated works too)
+    peaks = pd.read_csv(ms_file, skiprows = [0,1], delimiter = '\t', header = 0,
+        names = ['m/z','orig_abundance'], index_col = False)
+
+    parsed = read_ms_header(ms_file)
+    parsed['m/z'] = peaks['m/z'].values.astype('float64')
+    parsed['orig_abundance'] = peaks['orig_abundance'].values.astype('float64')
+
+    return parsed
+
+def _load_ms_file(ms_file, use_cache = True):
+    """Loads an MS file from its binary cache if it's still fresh, otherwise parses it and
+    (re)writes the cache.
+
+    The cache is keyed on the size and modification time of the MS file.
+
+    Parameters
+    ----------
+    ms_file : Path
+        Path to the ms/ms file.
+    use_cache : bool, optional
+        Whether to read and write the binary cache, by default True
+
+    Returns
+    -------
+    dict
+        "m/z" and "orig_abundance" arrays plus the header metadata.
+    """
+    stat = os.stat(ms_file)
+    key = np.array([stat.st_size, stat.st_mtime_ns], dtype = 'int64')
+    cache_file = _cache_path(ms_file)
+
+    if use_cache and cache_file.exists():
+        try:
+            with np.load(cache_file, allow_pickle = False) as cached:
+                if np.array_equal(cached['key'], key):
+                    # Missing header values are stored as NaN / empty strings
+                    parsed = {col: cached[col].item() for col in _META_COLS}
+                    parsed = {col: None if val in ('', None) or val != val else val for col, val in parsed.items()}
+                    if parsed['precursor_charge'] is not None:
+                        parsed['precursor_charge'] = int(parsed['precursor_charge'])
+                    parsed['m/z'] = cached['mz']
+                    parsed['orig_abundance'] = cached['orig_abundance']
+                    return parsed
+        except (OSError, ValueError, KeyError):
+            pass # Unreadable cache; just parse the file again
+
+    parsed = _parse_ms_file(ms_file)
+
+    if use_cache:
+        meta = {col: np.array(np.nan if parsed[col] is None else parsed[col]) for col in ['rt', 'precursor_mz', 'precursor_charge']}
+        tmp_file = None
+        try:
+            # Unique temp file per writer, since several processes can import the same directory at once
+            with tempfile.NamedTemporaryFile(dir = cache_file.parent, prefix = cache_file.name + '.',
+                    suffix = '.tmp', delete = False) as f:
+                tmp_file = f.name
+                np.savez(f, key = key, mz = parsed['m/z'], orig_abundance = parsed['orig_abundance'],
+                    source_file = np.array(parsed['source_file'] or ''), **meta)
+            os.replace(tmp_file, cache_file)
+        except OSError as e:
+            warnings.warn('Could not write MS file cache {}: {}'.format(cache_file, e))
+            if tmp_file is not None and os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+    return parsed
+
+@instrumented
+def import_ms_files(ms_files_dir, use_cache = True, n_workers = None, return_meta = False):
     """MS file importer
 
     Imports a series of msms files in csv or tab-separated format into a single dataframe.
     Files should be numbered ms1.csv, ms2.csv, ms3.csv.
     Columns of the tab-separated file should be: m/z | abundance
 
+    Files are parsed in parallel and a binary cache (".<file name>.npz") is written next to
+    each one, so later imports skip the text parsing until the file changes.
+
     Parameters
     ----------
     ms_files_dir : Path
         Path to directory with the ms/ms files in it.
+    use_cache : bool, optional
+        Whether to read and write the binary cache files, by default True
+    n_workers : int, optional
+        Number of threads parsing files, by default None (chosen by ThreadPoolExecutor)
+    return_meta : bool, optional
+        Also return the per-spectrum metadata parsed from the file headers, by default False
 
     Returns
     ----------
     ms_df : pd.DataFrame
         Dataframe with all msms data concatenated
+    meta_df : pd.DataFrame
+        Only if return_meta; one row per spectrum with the retention time ("rt"), precursor
+        m/z ("precursor_mz"), precursor charge ("precursor_charge", None if the header doesn't
+        give one) and source data file ("source_file").
     """
 
     assert ms_files_dir.exists(), 'No directory found at that path!'
 
     # Import all msms files in the directory
-    ms_files = list(ms_files_dir.glob('ms*'))
+    ms_files = {
+        int(_MS_FILE_RE.match(f.name)[1]): f for f in ms_files_dir.glob('ms*') if _MS_FILE_RE.match(f.name)
+    }
     assert len(ms_files) > 0, 'No MS files found! Did you specify the names as "ms[0-9].csv"?'
+    spec_nums = sorted(ms_files)
 
-    # Iterate through ms files and import them into a dataframe
-    ms_df = pd.DataFrame(columns = ['m/z', 'orig_abundance', 'spec_num'])
+    with ThreadPoolExecutor(max_workers = n_workers) as pool:
+        parsed = list(pool.map(lambda spec_num: _load_ms_file(ms_files[spec_num], use_cache), spec_nums))
 
-    for ms_file in ms_files:
-        spec_num = int(re.search(r'ms[\d+].', str(ms_file))[0][2:-1]) # extract the number in the ms file
-        # Import the csv file (tab separated works too)
-        new_ms = pd.read_csv(ms_file, skiprows = [0,1], delimiter = '\t', header = 0, 
-            names = ['m/z','orig_abundance'], index_col = False)
-        new_ms['spec_num'] = spec_num
-        ms_df = ms_df.append(new_ms, ignore_index = True)
-    
-    return ms_df
+    # Concatenate all the spectra into a single dataframe
+    ms_df = pd.DataFrame({
+        'm/z': np.concatenate([p['m/z'] for p in parsed]),
+        'orig_abundance': np.concatenate([p['orig_abundance'] for p in parsed]),
+        'spec_num': np.repeat(spec_nums, [len(p['m/z']) for p in parsed]),
+    })
+
+    if not return_meta:
+        return ms_df
+
+    meta_df = pd.DataFrame({
+        'spec_num': spec_nums,
+        **{col: [p[col] for p in parsed] for col in _META_COLS},
+        'file': [ms_files[spec_num].name for spec_num in spec_nums],
+    })
+
+    return ms_df, meta_df
 
 # Change abundances such that they cap out at a given abundance value
+@instrumented
 def abund_ceiling(abundances, upper_lim):
     """Set an abundance ceiling value
 
@@ -67,12 +222,87 @@ def abund_ceiling(abundances, upper_lim):
     
     return abundances
 
-def bkgd_calc_ser(abundances, N):
+def _section_bkgd(abundances, spec_codes, N):
+    """Section-based background values for any number of spectra in one vectorized pass.
+
+    Each spectrum's points are split into N sections (like np.array_split) and laid out in a
+    NaN-padded (spectra x sections x points) array. Each section's window of itself and its
+    two neighbours is then sorted once and the median pulled out of it.
+
+    Parameters
+    ----------
+    abundances : np.array
+        Ceilinged abundances, each spectrum's points in m/z order.
+    spec_codes : np.array
+        Integer spectrum code (0..n_spectra-1) of each point.
+    N : int
+        Number of sections to split each spectrum into.
+
+    Returns
+    -------
+    np.array
+        Background value for each abundance point.
+    """
+    abundances = np.asarray(abundances, dtype = 'float64')
+    spec_codes = np.asarray(spec_codes, dtype = 'int64')
+    n_specs = spec_codes.max() + 1 if len(spec_codes) else 0
+
+    # Position of each point within its own spectrum
+    spec_lens = np.bincount(spec_codes, minlength = n_specs)
+    spec_starts = np.cumsum(spec_lens) - spec_lens
+    pos = np.arange(len(spec_codes)) - spec_starts[spec_codes]
+
+    # Section and slot within the section, with the first (len % N) sections one point longer
+    sec_len, n_long = np.divmod(spec_lens[spec_codes], N)
+    long_span = n_long*(sec_len + 1)
+    in_long = pos < long_span
+    sec = np.where(in_long, pos // (sec_len + 1), n_long + (pos - long_span) // np.maximum(sec_len, 1))
+    slot = np.where(in_long, pos % (sec_len + 1), (pos - long_span) % np.maximum(sec_len, 1))
+
+    # Pad a section on either end so the first and last sections only see one neighbour
+    max_slots = slot.max() + 1 if len(slot) else 1
+    sections = np.full((n_specs, N + 2, max_slots), np.nan)
+    sections[spec_codes, sec + 1, slot] = abundances
+    windows = np.concatenate((sections[:, :-2], sections[:, 1:-1], sections[:, 2:]), axis = 2)
+
+    # Median of each window; NaN padding sorts to the end
+    windows.sort(axis = 2)
+    n_vals = (~np.isnan(windows)).sum(axis = 2)
+    lower_mid = np.take_along_axis(windows, np.maximum((n_vals - 1) // 2, 0)[..., None], axis = 2)[..., 0]
+    upper_mid = np.take_along_axis(windows, np.maximum(n_vals // 2, 0)[..., None], axis = 2)[..., 0]
+    medians = np.where(n_vals % 2 == 1, lower_mid, (lower_mid + upper_mid) / 2)
+
+    return medians[spec_codes, sec]
+
+def _rolling_bkgd(abundances, N):
+    """Rolling-window median background for a single spectrum.
+
+    The window spans the number of points in three sections and is centred on each point.
+
+    Parameters
+    ----------
+    abundances : pd.Series
+        Ceilinged abundances in m/z order.
+    N : int
+        Number of sections the window size is derived from.
+
+    Returns
+    -------
+    np.array
+        Background value for each abundance point.
+    """
+    window = max(1, 3*len(abundances) // N)
+    rolled = pd.Series(np.asarray(abundances, dtype = 'float64')).rolling(window, center = True, min_periods = 1)
+
+    return rolled.median().values
+
+@instrumented
+def bkgd_calc_ser(abundances, N, method = 'sections'):
     """Background abundance value calculator.
 
     Sections off the m/z axis into N different sections.
-    Calculates the "background" value (threshold to be used for signal) 
-    from the average of a given section and its two neighboring sections.
+    Calculates the "background" value (threshold to be used for signal)
+    from the median of a given section and its two neighboring sections.
 
     Parameters
     ----------
@@ -80,30 +310,312 @@ def bkgd_calc_ser(abundances, N):
         Ceilinged abundances.
     N : int
         Number of sections to split into when calculating background.
+    method : str, optional
+        'sections' for the section-based background, or 'rolling' for a rolling median over
+        a window the size of three sections, by default 'sections'
 
     Returns
     -------
     bkgd
         Background value for each abundance point.
+
+    Raises
+    ------
+    ValueError
+        If the background method is not supported.
     """
+    if method == 'sections':
+        bkgd_vals = _section_bkgd(abundances.values, np.zeros(len(abundances), dtype = 'int64'), N)
+    elif method == 'rolling':
+        bkgd_vals = _rolling_bkgd(abundances, N)
+    else:
+        raise ValueError('{method} is not a supported background method'.format(method = method))
+
+    bkgd = pd.Series(data = bkgd_vals, index = abundances.index.values, dtype = 'float64')
+
+    return bkgd
+
+@instrumented
+def bkgd_calc(ms_df, N, abund_col = 'abund_ceil', method = 'sections'):
+    """Background abundance values for all spectra at once.
+
+    Same result as applying bkgd_calc_ser to each spectrum, but the section-based background
+    of every spectrum is calculated in a single vectorized pass.
+
+    Parameters
+    ----------
+    ms_df : pd.DataFrame
+        Dataframe with all the spectra, sorted by m/z within each spectrum.
+    N : int
+        Number of sections to split each spectrum into when calculating background.
+    abund_col : str, optional
+        Abundance column to calculate the background from, by default 'abund_ceil'
+    method : str, optional
+        'sections' or 'rolling' (see bkgd_calc_ser), by default 'sections'
+
+    Returns
+    -------
+    pd.Series
+        Background value for each row of ms_df.
+    """
+    if method != 'sections':
+        return ms_df.groupby('spec_num')[abund_col].transform(bkgd_calc_ser, N, method).rename('bkgd')
+
+    spec_codes, _ = pd.factorize(ms_df['spec_num'])
+    # Points need to be grouped by spectrum (keeping their order) to be split into sections
+    grouped = np.argsort(spec_codes, kind = 'stable')
+    bkgd_vals = np.empty(len(ms_df))
+    bkgd_vals[grouped] = _section_bkgd(ms_df[abund_col].values[grouped], spec_codes[grouped], N)
+
+    return pd.Series(bkgd_vals, index = ms_df.index, name = 'bkgd')
+
+@instrumented
+def process_spectra(ms_df, upper_lim, N, bkgd_method = 'sections'):
+    """Sorts spectra, applies the abundance ceiling and calculates background values.
+
+    Parameters
+    ----------
+    ms_df : pd.DataFrame
+        Dataframe with all msms data (from import_ms_files).
+    upper_lim : float
+        Multiplier of the mean abundance value to set the ceiling at.
+    N : int
+        Number of sections to split each spectrum into when calculating background.
+    bkgd_method : str, optional
+        Background calculation method (see bkgd_calc_ser), by default 'sections'
+
+    Returns
+    -------
+    pd.DataFrame
+        Sorted spectra with "abund_ceil" and "bkgd" columns added.
+    """
+    # Make sure everything is sorted before running background calculations
+    ms_df = ms_df.sort_values(by = ['spec_num', 'm/z'])
+
+    # First apply abundance ceiling to each spectra file
+    ms_df['abund_ceil'] = ms_df.groupby('spec_num')['orig_abundance'].transform(
+        lambda x: abund_ceiling(x.copy(), upper_lim))
+    # Then calculate the background signal within each section
+    ms_df['bkgd'] = bkgd_calc(ms_df, N, method = bkgd_method)
+
+    return ms_df
+
+class Spectrum:
+    """One spectrum of a SpectrumSet, as m/z-sorted arrays.
+
+    For an unfiltered SpectrumSet the arrays are views into the set's arrays (nothing is copied).
+
+    Parameters
+    ----------
+    spec_num : int
+        Spectrum number.
+    mz, orig_abundance, abund_ceil, bkgd : np.array
+        Peak arrays (abund_ceil and bkgd are None until the spectra are processed).
+    """
+    __slots__ = ('spec_num', 'mz', 'orig_abundance', 'abund_ceil', 'bkgd')
+
+    def __init__(self, spec_num, mz, orig_abundance, abund_ceil = None, bkgd = None):
+        self.spec_num = spec_num
+        self.mz = mz
+        self.orig_abundance = orig_abundance
+        self.abund_ceil = abund_ceil
+        self.bkgd = bkgd
+
+    def __len__(self):
+        return len(self.mz)
+
+    def __repr__(self):
+        return '<Spectrum {}: {} peaks>'.format(self.spec_num, len(self))
+
+    def to_df(self):
+        """The spectrum in the long-form format of process_spectra."""
+        return _peaks_df(self.mz, self.orig_abundance, np.full(len(self), self.spec_num), self.abund_ceil, self.bkgd)
+
+def _peaks_df(mz, orig_abundance, spec_nums, abund_ceil, bkgd):
+    """Long-form spectra dataframe, with the processed columns only if they've been calculated."""
+    peaks_df = pd.DataFrame({'m/z': mz, 'orig_abundance': orig_abundance, 'spec_num': spec_nums})
+    if abund_ceil is not None:
+        peaks_df['abund_ceil'] = abund_ceil
+    if bkgd is not None:
+        peaks_df['bkgd'] = bkgd
+
+    return peaks_df
+
+class SpectrumSet:
+    """Spectra stored as contiguous, m/z-sorted peak arrays.
+
+    The peaks of spectrum i are positions offsets[i]:offsets[i+1] of every peak array, so each
+    spectrum can be handed out as a view without copying anything. An S/N-filtered set shares
+    the arrays of the set it was filtered from and only keeps the positions of the peaks that
+    passed ("keep"); its peaks are gathered when they're asked for.
+
+        spectra = SpectrumSet.from_df(import_ms_files(ms_files_dir)).process(upper_lim, N)
+        ms_df_sn_filter = spectra.sn_filter(sn_thr).to_df()
+
+    Parameters
+    ----------
+    spec_nums : np.array
+        Spectrum numbers, in order.
+    offsets : np.array
+        Start position of each spectrum in the peak arrays, plus the total number of peaks.
+    mz, orig_abundance : np.array
+        Peak m/z values and abundances, sorted by m/z within each spectrum.
+    abund_ceil, bkgd : np.array, optional
+        Ceilinged abundances and background values, by default None (not processed yet)
+    keep : np.array, optional
+        Sorted positions of the peaks in the set, by default None (all of them)
+    """
+    __slots__ = ('spec_nums', 'offsets', 'mz', 'orig_abundance', 'abund_ceil', 'bkgd', 'keep')
+
+    def __init__(self, spec_nums, offsets, mz, orig_abundance, abund_ceil = None, bkgd = None, keep = None):
+        self.spec_nums = np.asarray(spec_nums)
+        self.offsets = np.asarray(offsets, dtype = 'int64')
+        self.mz = mz
+        self.orig_abundance = orig_abundance
+        self.abund_ceil = abund_ceil
+        self.bkgd = bkgd
+        self.keep = keep
+        if len(self.offsets) != len(self.spec_nums) + 1 or self.offsets[-1] != len(mz):
+            raise ValueError('Spectrum offsets do not match the peak arrays!')
+
+    @classmethod
+    def from_df(cls, ms_df):
+        """Builds the set from a long-form spectra dataframe (like import_ms_files or process_spectra return).
+
+        Parameters
+        ----------
+        ms_df : pd.DataFrame
+            Dataframe with "m/z", "orig_abundance" and "spec_num" columns, and optionally
+            "abund_ceil" and "bkgd".
+
+        Returns
+        -------
+        SpectrumSet
+        """
+        order = np.lexsort((ms_df['m/z'].values, ms_df['spec_num'].values))
+        spec_col = ms_df['spec_num'].values[order]
+        spec_nums, starts = np.unique(spec_col, return_index = True)
+        peak_arrays = {col: np.ascontiguousarray(ms_df[col].values[order], dtype = 'float64')
+            for col in ['m/z', 'orig_abundance', 'abund_ceil', 'bkgd'] if col in ms_df}
+
+        return cls(spec_nums, np.append(starts, len(order)), peak_arrays['m/z'], peak_arrays['orig_abundance'],
+            peak_arrays.get('abund_ceil'), peak_arrays.get('bkgd'))
+
+    def __len__(self):
+        return len(self.spec_nums)
+
+    def __repr__(self):
+        return '<SpectrumSet: {} spectra, {} peaks>'.format(len(self), self.n_peaks)
+
+    @property
+    def n_peaks(self):
+        """Number of peaks in the set."""
+        return len(self.mz) if self.keep is None else len(self.keep)
+
+    @property
+    def processed(self):
+        """Whether ceilinged abundances and backgrounds have been calculated."""
+        return self.abund_ceil is not None and self.bkgd is not None
+
+    def _spec_index(self, spec_num):
+        i = np.searchsorted(self.spec_nums, spec_num)
+        if i == len(self) or self.spec_nums[i] != spec_num:
+            raise KeyError(spec_num)
+        return i
+
+    def spectrum(self, spec_num):
+        """One spectrum (views into the peak arrays unless the set is filtered).
+
+        Raises
+        ------
+        KeyError
+            If there's no spectrum with that number.
+        """
+        i = self._spec_index(spec_num)
+        lo, hi = self.offsets[i], self.offsets[i + 1]
+        if self.keep is None:
+            peaks = slice(lo, hi)
+        else:
+            peaks = self.keep[np.searchsorted(self.keep, lo):np.searchsorted(self.keep, hi)]
+        pick = lambda values: None if values is None else values[peaks]
+
+        return Spectrum(self.spec_nums[i], self.mz[peaks], self.orig_abundance[peaks], pick(self.abund_ceil),
+            pick(self.bkgd))
+
+    def __getitem__(self, spec_num):
+        return self.spectrum(spec_num)
+
+    def __iter__(self):
+        return (self.spectrum(spec_num) for spec_num in self.spec_nums)
+
+    def process(self, upper_lim, N, bkgd_method = 'sections'):
+        """Applies the abundance ceiling and calculates background values (like process_spectra).
+
+        The m/z and original abundance arrays are shared with the new set.
+
+        Parameters
+        ----------
+        upper_lim : float
+            Multiplier of the mean abundance value to set the ceiling at.
+        N : int
+            Number of sections to split each spectrum into when calculating background.
+        bkgd_method : str, optional
+            Background calculation method (see bkgd_calc_ser), by default 'sections'
+
+        Returns
+        -------
+        SpectrumSet
+            Processed set (unfiltered).
+        """
+        spec_lens = np.diff(self.offsets)
+        abund_ceil = np.empty(len(self.mz))
+        for lo, hi in zip(self.offsets[:-1], self.offsets[1:]):
+            # abund_ceiling works in place, so it gets a copy
+            abund_ceil[lo:hi] = abund_ceiling(pd.Series(self.orig_abundance[lo:hi], copy = True), upper_lim).values
+
+        if bkgd_method == 'sections':
+            bkgd = _section_bkgd(abund_ceil, np.repeat(np.arange(len(self)), spec_lens), N)
+        elif bkgd_method == 'rolling':
+            bkgd = np.concatenate([np.empty(0)] + [_rolling_bkgd(abund_ceil[lo:hi], N)
+                for lo, hi in zip(self.offsets[:-1], self.offsets[1:])])
+        else:
+            raise ValueError('{method} is not a supported background method'.format(method = bkgd_method))
+
+        return SpectrumSet(self.spec_nums, self.offsets, self.mz, self.orig_abundance, abund_ceil, bkgd)
+
+    def sn_filter(self, sn_thr):
+        """Peaks with a ceilinged abundance above sn_thr x background, without copying the peak arrays.
+
+        Parameters
+        ----------
+        sn_thr : float
+            Signal-to-noise threshold.
+
+        Returns
+        -------
+        SpectrumSet
+            Filtered set sharing this set's arrays.
+        """
+        if not self.processed:
+            raise ValueError('Spectra need to be processed before they can be S/N filtered!')
+        passed = np.flatnonzero(self.abund_ceil > sn_thr*self.bkgd)
+        keep = passed if self.keep is None else np.intersect1d(self.keep, passed, assume_unique = True)
+
+        return SpectrumSet(self.spec_nums, self.offsets, self.mz, self.orig_abundance, self.abund_ceil, self.bkgd,
+            keep)
+
+    def to_df(self):
+        """The spectra in the long-form format of process_spectra (sorted, with a fresh index).
+
+        Returns
+        -------
+        pd.DataFrame
+            One row per peak with "m/z", "orig_abundance", "spec_num" and, once processed,
+            "abund_ceil" and "bkgd".
+        """
+        spec_col = np.repeat(self.spec_nums, np.diff(self.offsets))
+        peaks = slice(None) if self.keep is None else self.keep
+        pick = lambda values: None if values is None else values[peaks]
 
-    # Split indices into sections
-    sections = np.array_split(abundances.index.values, N)
-
-    bkgd = pd.Series(data = None, index = abundances.index.values, dtype = 'float64')
-
-    # Iterate through each section and calculate background noise value based on algorithm above
-    #   Edge cases are required fro the first and last sections
-    for i in range(len(sections)):
-        # Get indices of appropriate m/z signals for each section's calculation
-        if i == 0: # If it's the first section, dont use the previous section in the calculation
-            idxs = np.concatenate((sections[i],sections[i+1]))
-        elif i == (len(sections)-1): # If its the last section... don't use the following section
-            idxs = np.concatenate((sections[i-1],sections[i]))
-        else: # Otherwise calculate background signal based on previous section, current section, and following section
-            idxs = np.concatenate((sections[i-1],sections[i],sections[i+1]))
-        
-        bkgd_sig = np.median(abundances.loc[idxs]) # take the mean of the abundance values in the given window
-        bkgd.loc[sections[i]] = bkgd_sig
-
-    return bkgd
\ No newline at end of file
+        return _peaks_df(self.mz[peaks], self.orig_abundance[peaks], spec_col[peaks], pick(self.abund_ceil),
+            pick(self.bkgd))
@@ -0,0 +1,276 @@
+"""Pipeline runner functions.
+
+Runs the fragment -> charge -> match -> score stages over chunks of hypothetical
+structures, either serially or across a pool of worker processes.
+
+"""
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import pandas as pd
+import numpy as np
+from msms_structure_annot import hsmakers
+from msms_structure_annot import scoring
+
+# Spectra shared with a worker process (set up by _init_worker)
+_worker_spectra = None
+_worker_shms = []
+
+def _share_spectra(spectra_df):
+    """Copies each spectra column into its own shared memory block.
+
+    Parameters
+    ----------
+    spectra_df : pd.DataFrame
+        Dataframe with the processed ms/ms spectra (numeric columns only).
+
+    Returns
+    -------
+    list
+        Shared memory blocks (keep them open until the workers are done).
+    list
+        (column name, dtype, shape, shared memory name) for each column, used to attach to the blocks.
+    """
+    shms = []
+    layout = []
+    for col in spectra_df.columns:
+        values = np.ascontiguousarray(spectra_df[col].values)
+        shm = shared_memory.SharedMemory(create = True, size = max(values.nbytes, 1))
+        np.ndarray(values.shape, dtype = values.dtype, buffer = shm.buf)[:] = values
+        shms.append(shm)
+        layout.append((col, values.dtype.str, values.shape, shm.name))
+
+    return shms, layout
+
+def _init_worker(layout):
+    """Attaches a worker process to the shared spectra columns."""
+    global _worker_spectra
+    cols = {}
+    for col, dtype, shape, shm_name in layout:
+        shm = shared_memory.SharedMemory(name = shm_name)
+        _worker_shms.append(shm)
+        cols[col] = np.ndarray(shape, dtype = dtype, buffer = shm.buf)
+    _worker_spectra = pd.DataFrame(cols, copy = False)
+
+def _chunk_ions(ptms_df, start, stop, parent_seq, N_term_mod, C_term_mod, charges, proton_m):
+    """Charged fragment ions of the hypothetical structures in [start, stop) (the spectra independent stages)."""
+    hss = hsmakers.HypotheticalStructureSet.from_ptms(ptms_df, start, stop)
+    frag_df = hsmakers.frag_hs(hss, ptms_df, parent_seq, N_term_mod, C_term_mod)
+
+    return hsmakers.mk_charge_df(frag_df, charges, proton_m)
+
+def score_chunk(spectra_df, ptms_df, start, stop, parent_seq, N_term_mod, C_term_mod, charges, proton_m, tol,
+        N_spectra, score_methods = ('frac', 'weights'), tol_unit = 'Da', stage_cache = None):
+    """Generates, fragments, charges, matches and scores the hypothetical structures in [start, stop).
+
+    Parameters
+    ----------
+    spectra_df : pd.DataFrame
+        Dataframe with all the (s/n filtered) ms/ms spectra provided.
+    ptms_df : pd.DataFrame
+        PTM information dataframe.
+    start : int
+        First hypothetical structure ID.
+    stop : int
+        One past the last hypothetical structure ID.
+    parent_seq : str
+        Untruncated peptide sequence
+    N_term_mod : float
+        N-terminal modification mass shift.
+    C_term_mod : float
+        C-terminal modification mass shift.
+    charges : list
+        List of integer numbers of hydrogens to add.
+    proton_m : float
+        Constant for mass of a proton.
+    tol : float
+        +/- tolerance to use for matching m/z values.
+    N_spectra : int
+        Number of spectra provided.
+    score_methods : tuple, optional
+        Scoring methods to be used, by default ('frac', 'weights')
+    tol_unit : str, optional
+        Either 'Da' or 'ppm', by default 'Da'
+    stage_cache : cache.StageCache, optional
+        Cache for the chunk's charged fragment ions, by default None (always computed)
+
+    Returns
+    -------
+    list
+        Score dataframe for each scoring method.
+    """
+    ion_args = (ptms_df, start, stop, parent_seq, N_term_mod, C_term_mod, charges, proton_m)
+    if stage_cache is None:
+        frag_df_charged = _chunk_ions(*ion_args)
+    else:
+        frag_df_charged = stage_cache.call(_chunk_ions, *ion_args)
+    matched_df = scoring.match_ions(spectra_df, frag_df_charged, tol, tol_unit)
+
+    return [scoring.score_wrapper(matched_df, frag_df_charged, N_spectra, score_method = method)
+        for method in score_methods]
+
+def _score_chunk_worker(args):
+    """Scores a chunk against the spectra shared with this worker."""
+    return score_chunk(_worker_spectra, *args)
+
+def run_pipeline(spectra_df, ptms_df, parent_seq, N_term_mod, C_term_mod, charges, proton_m, tol, N_spectra,
+        score_methods = ('frac', 'weights'), chunk_size = 10000, n_workers = 1, tol_unit = 'Da', stage_cache = None):
+    """Scores every hypothetical structure, chunk by chunk, optionally in parallel.
+
+    The hs_id space is split into chunks that are scored independently (see score_chunk). With
+    more than one worker the chunks run in a process pool and the processed spectra are shared
+    with the workers through shared memory instead of being pickled to each of them. Chunk
+    results are merged in hs_id order, so the scores are identical for any number of workers.
+
+    With a stage_cache, each chunk's charged fragment ions are cached on disk, so rerunning with
+    only the spectra, tol or scoring methods changed skips the fragmentation.
+
+    Parameters
+    ----------
+    spectra_df : pd.DataFrame
+        Dataframe with all the (s/n filtered) ms/ms spectra provided.
+    ptms_df : pd.DataFrame
+        PTM information dataframe.
+    parent_seq : str
+        Untruncated peptide sequence
+    N_term_mod : float
+        N-terminal modification mass shift.
+    C_term_mod : float
+        C-terminal modification mass shift.
+    charges : list
+        List of integer numbers of hydrogens to add.
+    proton_m : float
+        Constant for mass of a proton.
+    tol : float
+        +/- tolerance to use for matching m/z values.
+    N_spectra : int
+        Number of spectra provided.
+    score_methods : tuple, optional
+        Scoring methods to be used, by default ('frac', 'weights')
+    chunk_size : int, optional
+        Number of hypothetical structures per chunk, by default 10000
+    n_workers : int, optional
+        Number of worker processes, by default 1 (run serially in this process)
+    tol_unit : str, optional
+        Either 'Da' or 'ppm', by default 'Da'
+    stage_cache : cache.StageCache, optional
+        Cache for the charged fragment ions of each chunk, by default None
+
+    Returns
+    -------
+    pd.DataFrame
+        Scores for all the hypothetical structures and scoring methods (like concatenated
+        score_wrapper outputs).
+    """
+    n_hss = hsmakers.count_hss(ptms_df)
+    chunk_args = [
+        (ptms_df, start, min(start + chunk_size, n_hss), parent_seq, N_term_mod, C_term_mod, charges, proton_m,
+            tol, N_spectra, tuple(score_methods), tol_unit, stage_cache)
+        for start in range(0, n_hss, chunk_size)
+    ]
+
+    if n_workers == 1 or len(chunk_args) <= 1:
+        chunk_scores = [score_chunk(spectra_df, *args) for args in chunk_args]
+    else:
+        spectra_df = spectra_df.select_dtypes('number')
+        shms, layout = _share_spectra(spectra_df)
+        try:
+            with ProcessPoolExecutor(max_workers = n_workers, initializer = _init_worker,
+                    initargs = (layout,)) as pool:
+                chunk_scores = list(pool.map(_score_chunk_worker, chunk_args))
+        finally:
+            for shm in shms:
+                shm.close()
+                shm.unlink()
+
+    # Merge the chunks for each scoring method in hs_id order
+    scores_df = pd.concat(
+        [chunk[i] for i in range(len(score_methods)) for chunk in chunk_scores], ignore_index = True)
+
+    return scores_df
+
+def score_library(spectra_df, peptides, N_term_mod, C_term_mod, charges, proton_m, tol, N_spectra,
+        score_methods = ('frac', 'weights'), tol_unit = 'Da'):
+    """Scores the hypothetical structures of several candidate peptides against the same spectra.
+
+    The observed m/z values are sorted once and every candidate's fragment m/z values are built
+    as plain arrays and matched against them, so each extra candidate only costs its own
+    fragments. Scores are identical to running the notebook pipeline once per
+    candidate. Use search.match_hs_ids for the matched ions of specific structures.
+
+    Parameters
+    ----------
+    spectra_df : pd.DataFrame
+        Dataframe with all the (s/n filtered) ms/ms spectra provided.
+    peptides : list or dict
+        (parent sequence, PTM information dataframe) pair for each candidate peptide. With a
+        list the peptide IDs are the positions, with a dict they are the keys.
+    N_term_mod : float
+        N-terminal modification mass shift.
+    C_term_mod : float
+        C-terminal modification mass shift.
+    charges : list
+        List of integer numbers of hydrogens to add.
+    proton_m : float
+        Constant for mass of a proton.
+    tol : float
+        +/- tolerance to use for matching m/z values.
+    N_spectra : int
+        Number of spectra provided.
+    score_methods : tuple, optional
+        Scoring methods to be used, by default ('frac', 'weights')
+    tol_unit : str, optional
+        Either 'Da' or 'ppm', by default 'Da'
+
+    Returns
+    -------
+    pd.DataFrame
+        Combined ranking with "peptide_id", "parent_seq", "hs_id", "score", "score_method" and
+        "rank" (1 = best within each scoring method), sorted by scoring method and rank.
+    """
+    for score_method in score_methods:
+        if score_method not in scoring.SCORERS:
+            raise ValueError('{method} is not a supported scoring metric'.format(method = score_method))
+    peptide_items = list(peptides.items() if isinstance(peptides, dict) else enumerate(peptides))
+    n_states = len(charges) + 1
+    mz_index = scoring._mz_index(spectra_df)
+
+    # Every candidate's charged fragment m/z values, matched against the same sorted spectra
+    matched_dfs = []
+    matched_codes = []
+    structs = {'peptide_id': [], 'parent_seq': [], 'hs_id': [], 'n_ions': []}
+    n_structs = 0
+    for peptide_id, (parent_seq, ptms_df) in peptide_items:
+        frag_tmpl = hsmakers._frag_template(parent_seq, N_term_mod, C_term_mod)
+        hss = hsmakers.HypotheticalStructureSet.from_ptms(ptms_df)
+        hs_ids, masses = hsmakers._frag_mass_matrix(hss, ptms_df, frag_tmpl, len(parent_seq))
+
+        matched_df, hyp_pos = hsmakers._match_charged_masses(spectra_df, frag_tmpl, masses, charges, proton_m,
+            tol, tol_unit, hs_ids = hs_ids, mz_index = mz_index)
+        matched_df.insert(0, 'peptide_id', peptide_id)
+        matched_dfs.append(matched_df)
+        matched_codes.append(n_structs + (hyp_pos // len(frag_tmpl)) % len(hs_ids))
+
+        structs['peptide_id'].append(np.full(len(hs_ids), peptide_id, dtype = object))
+        structs['parent_seq'].append(np.full(len(hs_ids), parent_seq, dtype = object))
+        structs['hs_id'].append(np.asarray(hs_ids))
+        structs['n_ions'].append(np.isfinite(masses).sum(axis = 1)*n_states) # Ring-broken fragments don't count
+        n_structs += len(hs_ids)
+    matched_df = pd.concat(matched_dfs, ignore_index = True)
+    matched_codes = np.concatenate(matched_codes)
+    structs = {col: np.concatenate(values) for col, values in structs.items()}
+
+    scores_dfs = []
+    for method in score_methods:
+        ion_weights = np.asarray(scoring.SCORERS[method](matched_df), dtype = 'float64')
+        scores_df = pd.DataFrame({
+            'peptide_id': structs['peptide_id'],
+            'parent_seq': structs['parent_seq'],
+            'hs_id': structs['hs_id'].astype(int),
+            'score': scoring._sum_scores(matched_codes, ion_weights, structs['n_ions'], N_spectra),
+            'score_method': method,
+        })
+        scores_df = scores_df.sort_values('score', ascending = False, kind = 'stable')
+        scores_df['rank'] = np.arange(1, len(scores_df) + 1)
+        scores_dfs.append(scores_df)
+
+    return pd.concat(scores_dfs, ignore_index = True)
@@ -4,12 +4,16 @@ Useful plotting functions are here.
 
 """
 
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
 import seaborn as sns
 import matplotlib.pyplot as plt
 import matplotlib as mpl
+from matplotlib.collections import LineCollection
 import pandas as pd
 import numpy as np
 from adjustText import adjust_text
+from msms_structure_annot.instrument import instrumented
 
 # Set matplotlib parameters
 mpl.rcParams['figure.dpi']=150
@@ -29,9 +33,91 @@ def _label_point(x, y, val, label_size, ax):
         annots.append(annot)
     adjust_text(annots)
 
+def _peak_lines(ax, mz_vals, abunds, **line_kwargs):
+    """Draws a vertical line for every peak as a single LineCollection."""
+    segments = np.zeros((len(mz_vals), 2, 2))
+    segments[:, :, 0] = np.asarray(mz_vals, dtype = 'float64')[:, None]
+    segments[:, 1, 1] = abunds
+    lines = LineCollection(segments, **line_kwargs)
+    ax.add_collection(lines, autolim = False)
 
+    return lines
+
+def _fast_label_layout(x, y, vals, label_size, ax, max_labels = None):
+    """Places labels greedily, largest abundance first, without an iterative overlap solver.
+
+    Every label is drawn once and measured with the figure's renderer. The x axis is cut into
+    bins a tenth of the widest label wide. Each label goes right above its peak, or is bumped
+    up until the bins it spans are free at that height; labels that would leave the axes are
+    removed. The layout is deterministic and takes one pass over the labels.
+
+    Parameters
+    ----------
+    x, y : np.array
+        Label positions (m/z and abundance of the peaks).
+    vals : list
+        Label text.
+    label_size : float
+        Font size of the labels.
+    ax : matplotlib.axes.Axes
+        Axes to label (with its final limits set).
+    max_labels : int, optional
+        Only label this many of the most abundant peaks, by default None (all of them)
+
+    Returns
+    -------
+    list
+        The text objects that were placed.
+    """
+    x = np.asarray(x, dtype = 'float64')
+    y = np.asarray(y, dtype = 'float64')
+    vals = [str(val) for val in vals]
+    order = np.argsort(-y, kind = 'stable')[:max_labels]
+    if len(order) == 0:
+        return []
+
+    # Measure the rendered labels (one pixel of padding) and convert their sizes to data units
+    texts = [ax.text(x[i], y[i], vals[i], fontsize = label_size, ha = 'center', va = 'bottom') for i in order]
+    renderer = ax.figure.canvas.get_renderer()
+    extents = np.array([(box.width + 1, box.height + 1)
+        for box in (text.get_window_extent(renderer) for text in texts)])
+    (x_lo, x_hi), (y_lo, y_hi) = ax.get_xlim(), ax.get_ylim()
+    widths = extents[:, 0]*(x_hi - x_lo)/ax.bbox.width
+    heights = extents[:, 1]*(y_hi - y_lo)/ax.bbox.height
+
+    # Highest occupied label top in each x bin
+    bin_width = max(widths.max() / 10, (x_hi - x_lo) / 1e4)
+    n_bins = int(np.ceil((x_hi - x_lo) / bin_width)) + 1
+    bin_tops = np.full(n_bins, -np.inf)
+    peak_bins = np.clip(((x - x_lo) // bin_width).astype(int), 0, n_bins - 1)
+    # Labels shouldn't cover the labelled peaks either
+    np.maximum.at(bin_tops, peak_bins, y)
+
+    annots = []
+    leaders = []
+    for i, text, width, height in zip(order, texts, widths, heights):
+        lo = int(np.clip((x[i] - width/2 - x_lo) // bin_width, 0, n_bins - 1))
+        hi = int(np.clip((x[i] + width/2 - x_lo) // bin_width, 0, n_bins - 1)) + 1
+        base = max(y[i], bin_tops[lo:hi].max())
+        if base + height > y_hi:
+            text.remove() # No room left above this peak
+            continue
+        bin_tops[lo:hi] = base + height
+        text.set_y(base)
+        annots.append(text)
+        if base > y[i]:
+            leaders.append([(x[i], y[i]), (x[i], base)])
+
+    if leaders:
+        ax.add_collection(LineCollection(leaders, linewidth = 0.5, color = 'grey', linestyle = ':'), autolim = False)
+
+    return annots
+
+
+@instrumented
 def label_spectra_plot(ms_df, matched_df, ms_file_nums, hs_id, xlims = [(0,2000)], ylims= [(0,1e5)],
-                        auto_yscale = True, annot_sn_lim = 0, label_size = 10):
+                        auto_yscale = True, annot_sn_lim = 0, label_size = 10, label_layout = 'adjust',
+                        max_labels = None):
     """Vertical line plotting function for mass spec data. 
     
     Plots a vertical line at each m/z value with the height according to the abundance. Also
@@ -59,6 +145,12 @@ def label_spectra_plot(ms_df, matched_df, ms_file_nums, hs_id, xlims = [(0,2000)
         Signal to noise limit to exclude annotations below.
     label_size : float
         Size of annotation labels.
+    label_layout : str
+        'adjust' to untangle the labels with adjust_text, or 'fast' for a one-pass greedy
+        layout (see _fast_label_layout), by default 'adjust'
+    max_labels : int
+        Only label this many of the most abundant matched ions in each spectrum, by default None
+        (all of them)
 
     Returns
     -----------
@@ -67,6 +159,9 @@ def label_spectra_plot(ms_df, matched_df, ms_file_nums, hs_id, xlims = [(0,2000)
     np.array
         Array of axes being plotted.
     """
+    if label_layout not in ('adjust', 'fast'):
+        raise ValueError('{layout} is not a supported label layout'.format(layout = label_layout))
+
     # Make the plot
     N_plots = len(ms_file_nums)
     
@@ -92,18 +187,23 @@ def label_spectra_plot(ms_df, matched_df, ms_file_nums, hs_id, xlims = [(0,2000)
         ylims_processed = ylims
 
 
+    # Split the spectra and this structure's matches by spectrum once
+    spectra_groups = ms_df.groupby('spec_num').indices
+    hs_matched_df = matched_df[matched_df['hs_id'] == hs_id]
+    matched_groups = hs_matched_df.groupby('spec_num').indices
+
     # Iterate through each spectrum and plot and label
     for ms_file, ax, xlim, ylim in zip(ms_file_nums, axs, xlims_processed, ylims_processed):
         # Get the observed masses / abundances for a single spectrum
-        sub_df = ms_df[ms_df['spec_num'] == ms_file]
+        sub_df = ms_df.iloc[spectra_groups.get(ms_file, [])]
 
         # Get the masses that match both the spectra masses and the hypothetical structure masses
-        sub_matched_df = matched_df[(matched_df['spec_num'] == ms_file) & (matched_df['hs_id'] == hs_id)]
+        sub_matched_df = hs_matched_df.iloc[matched_groups.get(ms_file, [])]
 
         # Plot the original spectrum as vertical lines at each point
         mz_vals = sub_df['m/z'].values
         abunds = sub_df['orig_abundance'].values # Using original abundances here (could use ceilings too)
-        ax.vlines(x = mz_vals, ymin = 0, ymax=abunds, linewidth = 1, color = 'k')
+        _peak_lines(ax, mz_vals, abunds, linewidth = 1, color = 'k')
 
         # Define axes limits
         # Scale y value to the largest abundance value if autoscale is true
@@ -135,14 +235,101 @@ def label_spectra_plot(ms_df, matched_df, ms_file_nums, hs_id, xlims = [(0,2000)
             # Add color generation code here
 
             # Plot vertical lines
-            ax.vlines(x = mz_vals, ymin = 0, ymax=abunds, linewidth = 1)
+            _peak_lines(ax, mz_vals, abunds, linewidth = 1, color = 'C0')
             # Plot some dots on top too
             ax.scatter(x = mz_vals, y=abunds, s = 5)
             # Label all the points
-            _label_point(x = trunc_labels_df['m/z'], y = trunc_labels_df['orig_abundance'], 
-                val = trunc_labels_df['ion_name'], label_size = label_size, ax = ax)
+            if label_layout == 'fast':
+                _fast_label_layout(mz_vals, abunds, trunc_labels_df['ion_name'], label_size, ax, max_labels)
+            else:
+                labelled_df = trunc_labels_df
+                if max_labels is not None:
+                    labelled_df = trunc_labels_df.loc[trunc_labels_df['orig_abundance'].sort_values(
+                        ascending = False, kind = 'stable').index[:max_labels]]
+                _label_point(x = labelled_df['m/z'], y = labelled_df['orig_abundance'],
+                    val = labelled_df['ion_name'], label_size = label_size, ax = ax)
 
         
         
 
-    return(fig, axs)
\ No newline at end of file
+    return(fig, axs)
+
+# Spectra shared with the figure export workers
+_export_spectra = {}
+
+def _init_export_worker(ms_df):
+    """Keeps the spectra in the worker so they're only sent once per worker."""
+    _export_spectra['ms_df'] = ms_df
+
+def _export_figure(args):
+    """Renders one structure's labelled spectra and saves them to a file."""
+    hs_matched_df, ms_file_nums, hs_id, out_path, dpi, plot_kwargs = args
+    fig, _ = label_spectra_plot(_export_spectra['ms_df'], hs_matched_df, ms_file_nums, hs_id, **plot_kwargs)
+    fig.savefig(out_path, dpi = dpi)
+    plt.close(fig)
+
+    return out_path
+
+def export_top_spectra_plots(ms_df, matched_df, scores_df, output_folder, top_n = 10, ms_file_nums = None,
+        score_method = None, n_workers = None, file_format = 'pdf', dpi = 300, **plot_kwargs):
+    """Saves label_spectra_plot figures for the top scoring hypothetical structures, in a process pool.
+
+    Figures use the fast label layout unless label_layout is passed, and are saved as
+    <output_folder>/hs<hs_id>_matched_ions.<file_format>.
+
+    Parameters
+    ----------
+    ms_df : pd.DataFrame
+        Dataframe with all the mass spectra m/z values and their abundances.
+    matched_df : pd.DataFrame
+        Dataframe with the m/z values that matched hypothetical structures.
+    scores_df : pd.DataFrame
+        Hypothetical structure scores (from score_wrapper).
+    output_folder : Path
+        Folder to save the figures to.
+    top_n : int, optional
+        Number of structures to plot, by default 10
+    ms_file_nums : list, optional
+        Spectra to plot, by default None (all of them)
+    score_method : str, optional
+        Scoring method to rank by, by default None (the first one in scores_df)
+    n_workers : int, optional
+        Number of worker processes, by default None (one per CPU); 1 renders in this process
+    file_format : str, optional
+        Figure file format, by default 'pdf'
+    dpi : int, optional
+        Figure resolution, by default 300
+    **plot_kwargs
+        Other label_spectra_plot arguments (xlims, ylims, annot_sn_lim, max_labels, ...).
+
+    Returns
+    -------
+    list
+        Paths of the saved figures, best structure first.
+    """
+    output_folder = Path(output_folder)
+    output_folder.mkdir(parents = True, exist_ok = True)
+    if ms_file_nums is None:
+        ms_file_nums = list(np.unique(ms_df['spec_num']))
+    if score_method is None:
+        score_method = scores_df['score_method'].iloc[0]
+    plot_kwargs.setdefault('label_layout', 'fast')
+
+    method_scores_df = scores_df[scores_df['score_method'] == score_method]
+    top_hs_ids = method_scores_df.sort_values(['score', 'hs_id'], ascending = [False, True], kind = 'stable')[
+        'hs_id'].head(top_n).tolist()
+
+    # Only send each worker the matches of the structure it's plotting
+    matched_groups = matched_df[matched_df['hs_id'].isin(top_hs_ids)].groupby('hs_id')
+    tasks = [(
+        matched_groups.get_group(hs_id) if hs_id in matched_groups.groups else matched_df.iloc[:0],
+        ms_file_nums, hs_id, output_folder / 'hs{}_matched_ions.{}'.format(hs_id, file_format), dpi, plot_kwargs,
+    ) for hs_id in top_hs_ids]
+
+    ms_df = ms_df[ms_df['spec_num'].isin(ms_file_nums)]
+    if n_workers == 1:
+        _init_export_worker(ms_df)
+        return [_export_figure(task) for task in tasks]
+
+    with ProcessPoolExecutor(max_workers = n_workers, initializer = _init_export_worker, initargs = (ms_df,)) as pool:
+        return list(pool.map(_export_figure, tasks))
@@ -2,10 +2,108 @@
 """
 import pandas as pd
 import numpy as np
+from msms_structure_annot.instrument import instrumented
 
-def match_ions(spectra_df, hs_frag_df, tol):
+def _mz_index(spectra_df):
+    """Sorts the observed m/z values once so they can be range-queried with a binary search.
+
+    Parameters
+    ----------
+    spectra_df : pd.DataFrame
+        Dataframe with all the ms/ms spectra provided.
+
+    Returns
+    -------
+    np.array
+        Row positions of spectra_df in m/z order.
+    np.array
+        Sorted m/z values.
+    """
+    mz = spectra_df['m/z'].values.astype('float64')
+    order = np.argsort(mz, kind = 'stable')
+
+    return order, mz[order]
+
+def _tol_window(hyp_mz, tol, tol_unit = 'Da'):
+    """Lower and upper m/z bounds of the matching window around hypothetical ions.
+
+    Parameters
+    ----------
+    hyp_mz : np.array
+        Hypothetical ion m/z values.
+    tol : float
+        +/- tolerance to use for matching m/z values.
+    tol_unit : str, optional
+        Either 'Da' (absolute tolerance) or 'ppm' (relative tolerance), by default 'Da'
+
+    Returns
+    -------
+    np.array
+        Lower bounds of the windows.
+    np.array
+        Upper bounds of the windows.
+
+    Raises
+    ------
+    ValueError
+        If the tolerance unit is not 'Da' or 'ppm'.
+    """
+    if tol_unit == 'Da':
+        abs_tol = tol
+    elif tol_unit == 'ppm':
+        abs_tol = hyp_mz*tol*1e-6
+    else:
+        raise ValueError('{unit} is not a supported tolerance unit'.format(unit = tol_unit))
+
+    return hyp_mz - abs_tol, hyp_mz + abs_tol
+
+def _match_pairs(mz_index, hyp_mz, tol, tol_unit = 'Da'):
+    """Finds every observed peak within tolerance of every hypothetical ion.
+
+    Parameters
+    ----------
+    mz_index : tuple
+        Sorted observed m/z index from _mz_index.
+    hyp_mz : np.array
+        Hypothetical ion m/z values.
+    tol : float
+        +/- tolerance to use for matching m/z values.
+    tol_unit : str, optional
+        Either 'Da' or 'ppm', by default 'Da'
+
+    Returns
+    -------
+    np.array
+        Position of the hypothetical ion for each match.
+    np.array
+        Row position of the observed peak for each match. Matches are ordered by hypothetical
+        ion, then by observed peak row.
+    """
+    order, sorted_mz = mz_index
+    lower, upper = _tol_window(np.asarray(hyp_mz, dtype = 'float64'), tol, tol_unit)
+
+    # Every window is a contiguous run of the sorted m/z values (bounds are inclusive)
+    left = np.searchsorted(sorted_mz, lower, side = 'left')
+    right = np.searchsorted(sorted_mz, upper, side = 'right')
+    n_matches = np.maximum(right - left, 0)
+
+    # Expand the runs into one (hypothetical ion, observed peak) pair per match
+    hyp_pos = np.repeat(np.arange(len(n_matches)), n_matches)
+    run_starts = np.cumsum(n_matches) - n_matches
+    sorted_pos = np.repeat(left - run_starts, n_matches) + np.arange(n_matches.sum())
+    obs_pos = order[sorted_pos]
+
+    pair_order = np.lexsort((obs_pos, hyp_pos))
+
+    return hyp_pos[pair_order], obs_pos[pair_order]
+
+@instrumented
+def match_ions(spectra_df, hs_frag_df, tol, tol_unit = 'Da'):
     """Matches observed ions to a hypothetical structure ions with the provided tolerance.
 
+    Observed m/z values are sorted once and each hypothetical ion's window is found with a
+    binary search, so every peak that falls in a window is matched.
+
     Parameters
     ----------
     spectra_df : pd.DataFrame
@@ -14,65 +112,70 @@ def match_ions(spectra_df, hs_frag_df, tol):
         Dataframe with all the fragments and masses for hypothetical structures.
     tol : float
         +/- tolerance to use for matching m/z values.
+    tol_unit : str, optional
+        Either 'Da' (absolute tolerance) or 'ppm' (relative to the hypothetical m/z), by default 'Da'
 
     Returns
     -------
     pd.DataFrame
         Dataframe with all the observed ions that matched hypothetical structures.
     """
-    # Create a couple empty lists to store indices of matched ions between hypothetical and observed
-    hs_ion_idxs = []
-    obs_ion_idxs = []
-
-    # iterate through all potential ions and check if they're observed (with a tolerance), record indices of each df if they match
-    for hs_ion_idx, row in hs_frag_df.iterrows():
-        mw = row['hyp_mw']
-        # Get all matched ions for the given hypothetical ion
-        matched_ions = spectra_df[(spectra_df['m/z'] >= mw - tol) & (spectra_df['m/z'] <= mw + tol)]
-        
-        if matched_ions.empty is not True:
-            for obs_ion_idx in matched_ions.index.values:
-                hs_ion_idxs.append(hs_ion_idx)
-                obs_ion_idxs.append(obs_ion_idx)
-    
-    # Pull out the indices of each that matched and merge into a new df
-    matched_hs_ions = hs_frag_df.loc[hs_ion_idxs].reset_index(drop = True)
-    matched_obs_ions = spectra_df.loc[obs_ion_idxs].reset_index(drop = True)
+    hs_ion_pos, obs_ion_pos = _match_pairs(_mz_index(spectra_df), hs_frag_df['hyp_mw'].values, tol, tol_unit)
+
+    # Pull out the rows of each that matched and merge into a new df
+    matched_hs_ions = hs_frag_df.iloc[hs_ion_pos].reset_index(drop = True)
+    matched_obs_ions = spectra_df.iloc[obs_ion_pos].reset_index(drop = True)
     matched_df = pd.concat([matched_hs_ions,matched_obs_ions ], sort = False, axis= 1)
     
     return matched_df
 
 ## Scoring functions
 
+# Registered scoring methods by name; add new ones with the register_scorer decorator
+SCORERS = {}
 
-def _frac_scorer(matched_hs_ions_df, all_hyp_ions_df, N_spectra):
-    """Fraction ion observed scorer.
+def register_scorer(score_method):
+    """Registers an ion weighting function as a scoring method usable by score_wrapper.
 
-    Provides a score based off of the fraction of hypothetical ions that were observed
-    for a given hypothetical structure.
+    Scorers are vectorized: they take the matched ions dataframe and return an array with one
+    weight per matched ion. The score of a hypothetical structure is then the sum of the weights
+    of its matched ions divided by (number of hypothetical ions x number of spectra).
 
     Parameters
     ----------
-    matched_hs_ions_df : pd.DataFrame
-        Dataframe of observed ions that matched a specific hypothetical structure
-    all_hyp_ions_df : pd.DataFrame
-        Dataframe of all possible ions for a given hypothetical structure.
-    N_spectra : int
-        Number of spectra provided.
+    score_method : str
+        Name used to refer to this scoring metric.
 
     Returns
     -------
-    float
-        Score for a given hypothetical structure.
+    function
+        Decorator that registers the scorer and returns it unchanged.
     """
+    def decorator(scorer):
+        SCORERS[score_method] = scorer
+        return scorer
 
-    # Calculate the number of matched ions observed and total possible
-    N_matched_hs_ions = matched_hs_ions_df.shape[0]
-    N_tot_hyp_ions = all_hyp_ions_df.shape[0]
-    
-    score = N_matched_hs_ions / (N_tot_hyp_ions*N_spectra)
+    return decorator
 
-    return score
+@register_scorer('frac')
+def _frac_scorer(matched_ions_df):
+    """Fraction ion observed scorer.
+
+    Every matched ion counts once, so the score is the fraction of hypothetical ions
+    that were observed for a given hypothetical structure.
+
+    Parameters
+    ----------
+    matched_ions_df : pd.DataFrame
+        Dataframe of observed ions that matched hypothetical ions.
+
+    Returns
+    -------
+    np.array
+        Weight of each matched ion.
+    """
+
+    return np.ones(matched_ions_df.shape[0])
 
 def _magic_weights_calc(abund, bkgd):
     """Magical coefficient generating function that takes the abundance and the background value
@@ -93,19 +196,24 @@ def _magic_weights_calc(abund, bkgd):
 
     # Divide abundances by background to get normalized abundances
     normed_abund = abund / bkgd
+    x = np.asarray(normed_abund, dtype = 'float64')
 
     # Calculate the weight coeffsicients based on the normalized abundance values for each ion
-    coeffs = normed_abund.copy()
-    coeffs[coeffs < 4] = 0
-    coeffs[(coeffs >=4) & (coeffs <= 5)] = 6.4*(coeffs[(coeffs >=4) & (coeffs <=5)]/10)**3
-    coeffs[(coeffs >5) & (coeffs <= 6.25)] = coeffs[(coeffs >5) & (coeffs <=6.25)]/6.25
-    coeffs[(coeffs >6.25) & (coeffs <= 8)] = np.sqrt((coeffs[(coeffs >6.25) & (coeffs <=8)])/6.25)
-    coeffs[(coeffs >8) & (coeffs <= 9.5)] = 0.5656854*(coeffs[(coeffs >8) & (coeffs <= 9.5)])**(1/3)
-    coeffs[coeffs >9.5] = 1.2
-    
+    #   (values that fall in no bin, i.e. NaN, are passed through)
+    with np.errstate(invalid = 'ignore'):
+        coeffs = np.select(
+            [x < 4, x <= 5, x <= 6.25, x <= 8, x <= 9.5, x > 9.5],
+            [0, 6.4*(x/10)**3, x/6.25, np.sqrt(x/6.25), 0.5656854*x**(1/3), 1.2],
+            default = x
+        )
+
+    if isinstance(normed_abund, pd.Series):
+        coeffs = pd.Series(coeffs, index = normed_abund.index, name = normed_abund.name)
+
     return coeffs
 
-def _magic_weights_scorer(matched_hs_ions_df, all_hyp_ions_df, N_spectra):
+@register_scorer('weights')
+def _magic_weights_scorer(matched_ions_df):
     """Weights scoring method
 
     Calculates weights for observed m/z values based off of their normalized abundances. Taken from
@@ -113,34 +221,50 @@ def _magic_weights_scorer(matched_hs_ions_df, all_hyp_ions_df, N_spectra):
 
     Parameters
     ----------
-    matched_hs_ions_df : pd.DataFrame
-        Dataframe of observed ions that matched a specific hypothetical structure
-    all_hyp_ions_df : pd.DataFrame
-        Dataframe of all possible ions for a given hypothetical structure.
-    N_spectra : int
-        Number of spectra provided.
+    matched_ions_df : pd.DataFrame
+        Dataframe of observed ions that matched hypothetical ions.
 
     Returns
     -------
-    float   
-        Score for a given hypothetical structure.
+    np.array
+        Weight of each matched ion.
     """
 
-    # First calculate the magical coefficients for the observed ions
-    abund = matched_hs_ions_df['abund_ceil']
-    bk = matched_hs_ions_df['bkgd']
+    # Calculate the magical coefficients for the observed ions
+    abund = matched_ions_df['abund_ceil'].values
+    bk = matched_ions_df['bkgd'].values
 
-    # Sum the magical weighted coefficients for observed ions
-    sum_weights = _magic_weights_calc(abund,bk).sum()
-    N_tot_hyp_ions = all_hyp_ions_df.shape[0]
-    
-    score = sum_weights / (N_tot_hyp_ions*N_spectra)
+    return _magic_weights_calc(abund, bk)
+
+def _sum_scores(matched_codes, ion_weights, n_ions, N_spectra):
+    """Reduces matched ion weights to one score per hypothetical structure.
+
+    Parameters
+    ----------
+    matched_codes : np.array
+        Hypothetical structure code (0..n_hs-1) of each matched ion.
+    ion_weights : np.array
+        Weight of each matched ion.
+    n_ions : np.array
+        Number of hypothetical ions for each hypothetical structure.
+    N_spectra : int
+        Number of spectra provided.
+
+    Returns
+    -------
+    np.array
+        Score for each hypothetical structure.
+    """
+    sum_weights = np.bincount(matched_codes, weights = ion_weights, minlength = len(n_ions))
 
-    return score
+    return sum_weights / (n_ions*N_spectra)
 
+@instrumented
 def score_wrapper(matched_ions_df, all_ions_df, N_spectra, score_method = 'frac'):
     """Wrapper function for scoring methods
 
+    All hypothetical structures are scored at once with grouped sums over integer hs codes.
+
     Parameters
     ----------
     matched_ions_df : pd.DataFrame
@@ -150,7 +274,7 @@ def score_wrapper(matched_ions_df, all_ions_df, N_spectra, score_method = 'frac'
     N_spectra : int
         Number of spectra provided.
     score_method : str, optional
-        Scoring method to be used, by default 'frac'
+        Scoring method to be used (any key of SCORERS), by default 'frac'
 
     Returns
     -------
@@ -163,34 +287,292 @@ def score_wrapper(matched_ions_df, all_ions_df, N_spectra, score_method = 'frac'
         If scoring method provided is not a valid method.
     """
 
-    # Create an empty score dataframe
-    scores_df = pd.DataFrame({'hs_id': [], 'score': [], 'score_method': []})
-    scores_df['hs_id'] = scores_df['hs_id'].astype(int)
-    score_name = score_method # name used to refer to this scoring metric
+    if score_method not in SCORERS:
+        raise ValueError('{method} is not a supported scoring metric'.format(method = score_method))
+    scorer = SCORERS[score_method]
 
-    # Create empty lists to store hypothetical structure IDs and scores
-    hs_ids = []
-    scores = []
+    # Give each hypothetical structure an integer code and count its ions
+    hs_codes, hs_ids = pd.factorize(all_ions_df['hs_id'])
+    n_ions = np.bincount(hs_codes, minlength = len(hs_ids))
 
-    if score_method == 'frac':
-        scorer = _frac_scorer
-    elif score_method == 'weights':
-        scorer = _magic_weights_scorer
-    else:
+    # Matched ions from structures that aren't in all_ions_df don't count towards anything
+    matched_codes = pd.Index(hs_ids).get_indexer(matched_ions_df['hs_id'])
+    in_hss = matched_codes >= 0
+    ion_weights = np.asarray(scorer(matched_ions_df), dtype = 'float64')
+
+    scores = _sum_scores(matched_codes[in_hss], ion_weights[in_hss], n_ions, N_spectra)
+
+    scores_df = pd.DataFrame({
+        'hs_id': np.asarray(hs_ids).astype(int), 'score': scores, 'score_method': score_method
+    })
+
+    return scores_df
+
+@instrumented
+def score_signatures(matched_sig_df, sig_df_charged, hs_ids, hs_sigs, N_spectra, score_method = 'frac'):
+    """Scores hypothetical structures from matched fragment signatures.
+
+    Weights are summed once per signature and then fanned back out to every structure
+    that contains the signature.
+
+    Parameters
+    ----------
+    matched_sig_df : pd.DataFrame
+        Observed ions that matched charged signatures (match_ions on sig_df_charged).
+    sig_df_charged : pd.DataFrame
+        Charged signatures (mk_charge_df on the sig_df from hsmakers.frag_signatures).
+    hs_ids : np.array
+        Hypothetical structure IDs from hsmakers.frag_signatures.
+    hs_sigs : np.array
+        Structure-to-signature mapping from hsmakers.frag_signatures (-1 for fragments that
+        aren't formed).
+    N_spectra : int
+        Number of spectra provided.
+    score_method : str, optional
+        Scoring method to be used (any key of SCORERS), by default 'frac'
+
+    Returns
+    -------
+    pd.DataFrame
+        Dataframe with scores for all the hypothetical structures
+
+    Raises
+    ------
+    ValueError
+        If scoring method provided is not a valid method.
+    """
+    if score_method not in SCORERS:
         raise ValueError('{method} is not a supported scoring metric'.format(method = score_method))
 
-    # Iterate through each hypothetical structure and score it
-    for hs_id in all_ions_df['hs_id'].unique():
-        # Get all the matched ions and all possible ions for the hypothetical structure
-        matched_hs_ions_df = matched_ions_df[matched_ions_df['hs_id'] == hs_id]
-        all_hyp_ions_df = all_ions_df[all_ions_df['hs_id'] == hs_id]
-        # Pass it to the scoring function
-        score  = scorer(matched_hs_ions_df, all_hyp_ions_df, N_spectra)
-        
-        hs_ids.append(hs_id)
-        scores.append(score)
-
-    df = pd.DataFrame({'hs_id': hs_ids, 'score': scores, 'score_method': [score_name]*len(hs_ids)})
-    scores_df = scores_df.append(df)
-    
-    return scores_df
\ No newline at end of file
+    n_sigs = max(hs_sigs.max(initial = -1), sig_df_charged['sig_id'].max()) + 1
+    sig_ion_counts = np.bincount(sig_df_charged['sig_id'], minlength = n_sigs)
+    ion_weights = np.asarray(SCORERS[score_method](matched_sig_df), dtype = 'float64')
+    sig_weights = np.bincount(matched_sig_df['sig_id'], weights = ion_weights, minlength = n_sigs)
+
+    # Fan the signature sums back out to the structures (-1 picks up the trailing zero)
+    sig_weights = np.append(sig_weights, 0.0)
+    sig_ion_counts = np.append(sig_ion_counts, 0)
+    scores = sig_weights[hs_sigs].sum(axis = 1) / (sig_ion_counts[hs_sigs].sum(axis = 1)*N_spectra)
+
+    scores_df = pd.DataFrame({
+        'hs_id': np.asarray(hs_ids).astype(int), 'score': scores, 'score_method': score_method
+    })
+
+    return scores_df
+
+def expand_signature_matches(matched_sig_df, hs_ids, hs_sigs, select_hs_ids = None):
+    """Expands matched signatures back into matched ions for specific hypothetical structures.
+
+    Parameters
+    ----------
+    matched_sig_df : pd.DataFrame
+        Observed ions that matched charged signatures.
+    hs_ids : np.array
+        Hypothetical structure IDs from hsmakers.frag_signatures.
+    hs_sigs : np.array
+        Structure-to-signature mapping from hsmakers.frag_signatures.
+    select_hs_ids : list, optional
+        Hypothetical structures to expand, by default None (all of them)
+
+    Returns
+    -------
+    pd.DataFrame
+        Matched ions with an "hs_id" column, like the output of match_ions (e.g. for label_spectra_plot).
+    """
+    hs_pos = np.arange(len(hs_ids)) if select_hs_ids is None else pd.Index(hs_ids).get_indexer(select_hs_ids)
+    hs_pos = hs_pos[hs_pos >= 0]
+
+    hs_sig_pairs = pd.DataFrame({
+        'hs_id': np.repeat(np.asarray(hs_ids)[hs_pos], hs_sigs.shape[1]),
+        'sig_id': hs_sigs[hs_pos].ravel(),
+    }).drop_duplicates()
+    matched_df = hs_sig_pairs.merge(matched_sig_df, on = 'sig_id', how = 'inner', sort = False)
+
+    return matched_df.sort_values('hs_id', kind = 'stable').reset_index(drop = True)
+
+class ScoreState:
+    """Running scores that spectra can be added to or removed from one at a time.
+
+    Keeps the number of matched ions and the summed ion weights of every hypothetical
+    structure for each spectrum, so adding (or removing) a spectrum only costs matching
+    that spectrum's peaks and updating the running totals.
+
+    Parameters
+    ----------
+    all_ions_df : pd.DataFrame
+        Dataframe of all hypothetical fragment ions (e.g. from mk_charge_df).
+    tol : float
+        +/- tolerance to use for matching m/z values.
+    tol_unit : str, optional
+        Either 'Da' or 'ppm', by default 'Da'
+    score_methods : tuple, optional
+        Scoring methods to keep track of (any keys of SCORERS), by default ('frac', 'weights')
+    """
+
+    def __init__(self, all_ions_df, tol, tol_unit = 'Da', score_methods = ('frac', 'weights')):
+        for score_method in score_methods:
+            if score_method not in SCORERS:
+                raise ValueError('{method} is not a supported scoring metric'.format(method = score_method))
+        _tol_window(np.zeros(1), tol, tol_unit) # Check the tolerance unit
+
+        self.all_ions_df = all_ions_df
+        self.tol = tol
+        self.tol_unit = tol_unit
+        self.score_methods = tuple(score_methods)
+
+        hs_codes, hs_ids = pd.factorize(all_ions_df['hs_id'])
+        self.hs_ids = np.asarray(hs_ids).astype(int)
+        self.n_ions = np.bincount(hs_codes, minlength = len(hs_ids))
+        self._hs_index = pd.Index(self.hs_ids)
+
+        # Hypothetical m/z values sorted once so each new spectrum's peaks can be looked up
+        self._hyp_mz = all_ions_df['hyp_mw'].values.astype('float64')
+        self._hyp_order = np.argsort(self._hyp_mz, kind = 'stable')
+        self._sorted_hyp_mz = self._hyp_mz[self._hyp_order]
+
+        self.match_counts = {}
+        self.weight_sums = {}
+        self._totals = {method: np.zeros(len(self.hs_ids)) for method in self.score_methods}
+
+    @property
+    def spec_nums(self):
+        """Spectra currently folded into the scores."""
+        return list(self.weight_sums)
+
+    @property
+    def N_spectra(self):
+        """Number of spectra currently folded into the scores."""
+        return len(self.weight_sums)
+
+    def match_spectrum(self, spectrum_df):
+        """Matches one spectrum's peaks to the hypothetical ions.
+
+        Each peak's window is looked up in the sorted hypothetical m/z values, so the cost
+        scales with the size of the spectrum. Matches are the same (and in the same order) as
+        match_ions.
+
+        Parameters
+        ----------
+        spectrum_df : pd.DataFrame
+            Processed, s/n filtered peaks of a single spectrum.
+
+        Returns
+        -------
+        pd.DataFrame
+            Matched ions, like match_ions.
+        """
+        obs_mz = spectrum_df['m/z'].values.astype('float64')
+
+        # Candidate hypothetical ions in a slightly widened window around each peak...
+        if self.tol_unit == 'Da':
+            lower, upper = obs_mz - 2*self.tol, obs_mz + 2*self.tol
+        else:
+            rel_tol = 2*self.tol*1e-6
+            lower, upper = obs_mz / (1 + rel_tol), obs_mz / max(1 - rel_tol, 1e-12)
+        left = np.searchsorted(self._sorted_hyp_mz, lower, side = 'left')
+        right = np.searchsorted(self._sorted_hyp_mz, upper, side = 'right')
+        n_cands = right - left
+        obs_pos = np.repeat(np.arange(len(obs_mz)), n_cands)
+        run_starts = np.cumsum(n_cands) - n_cands
+        hyp_pos = self._hyp_order[np.repeat(left - run_starts, n_cands) + np.arange(n_cands.sum())]
+
+        # ...then exactly the windows match_ions uses
+        hyp_lower, hyp_upper = _tol_window(self._hyp_mz[hyp_pos], self.tol, self.tol_unit)
+        in_window = (obs_mz[obs_pos] >= hyp_lower) & (obs_mz[obs_pos] <= hyp_upper)
+        hyp_pos, obs_pos = hyp_pos[in_window], obs_pos[in_window]
+        pair_order = np.lexsort((obs_pos, hyp_pos))
+        hyp_pos, obs_pos = hyp_pos[pair_order], obs_pos[pair_order]
+
+        matched_hs_ions = self.all_ions_df.iloc[hyp_pos].reset_index(drop = True)
+        matched_obs_ions = spectrum_df.iloc[obs_pos].reset_index(drop = True)
+
+        return pd.concat([matched_hs_ions, matched_obs_ions], sort = False, axis = 1)
+
+    def add_matches(self, spec_num, matched_spec_df):
+        """Folds the already matched ions of one spectrum into the scores.
+
+        Parameters
+        ----------
+        spec_num : int
+            Spectrum number.
+        matched_spec_df : pd.DataFrame
+            Matched ions of that spectrum only (e.g. match_ions output for one spec_num).
+
+        Raises
+        ------
+        ValueError
+            If the spectrum was already added.
+        """
+        if spec_num in self.weight_sums:
+            raise ValueError('Spectrum {} has already been added!'.format(spec_num))
+
+        matched_codes = self._hs_index.get_indexer(matched_spec_df['hs_id'])
+        in_hss = matched_codes >= 0
+        # Only the structures this spectrum matched are touched, so the cost doesn't grow with the library
+        spec_codes, code_pos = np.unique(matched_codes[in_hss], return_inverse = True)
+        self.match_counts[spec_num] = (spec_codes, np.bincount(code_pos, minlength = len(spec_codes)))
+
+        spec_sums = {}
+        for method in self.score_methods:
+            ion_weights = np.asarray(SCORERS[method](matched_spec_df), dtype = 'float64')
+            spec_sums[method] = np.bincount(code_pos, weights = ion_weights[in_hss], minlength = len(spec_codes))
+            np.add.at(self._totals[method], spec_codes, spec_sums[method])
+        self.weight_sums[spec_num] = spec_sums
+
+    def add_spectrum(self, spec_num, spectrum_df):
+        """Matches a new spectrum and folds it into the scores.
+
+        Parameters
+        ----------
+        spec_num : int
+            Spectrum number.
+        spectrum_df : pd.DataFrame
+            Processed, s/n filtered peaks of that spectrum.
+
+        Returns
+        -------
+        pd.DataFrame
+            The spectrum's matched ions (e.g. for plotting).
+        """
+        matched_spec_df = self.match_spectrum(spectrum_df)
+        self.add_matches(spec_num, matched_spec_df)
+
+        return matched_spec_df
+
+    def remove_spectrum(self, spec_num):
+        """Subtracts a spectrum's contribution from the scores.
+
+        Raises
+        ------
+        KeyError
+            If the spectrum was never added.
+        """
+        spec_sums = self.weight_sums.pop(spec_num)
+        spec_codes, _ = self.match_counts.pop(spec_num)
+        for method in self.score_methods:
+            np.subtract.at(self._totals[method], spec_codes, spec_sums[method])
+
+        if not self.weight_sums:
+            # Don't carry rounding residue over once every spectrum is gone
+            for method in self.score_methods:
+                self._totals[method][:] = 0
+
+    def scores(self, score_method = 'frac'):
+        """Current scores, in the same format as score_wrapper.
+
+        Parameters
+        ----------
+        score_method : str, optional
+            One of the tracked scoring methods, by default 'frac'
+
+        Returns
+        -------
+        pd.DataFrame
+            Dataframe with scores for all the hypothetical structures
+        """
+        if score_method not in self._totals:
+            raise ValueError('{method} is not a tracked scoring metric'.format(method = score_method))
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            scores = self._totals[score_method] / (self.n_ions*self.N_spectra)
+
+        return pd.DataFrame({'hs_id': self.hs_ids, 'score': scores, 'score_method': score_method})
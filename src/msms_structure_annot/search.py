@@ -0,0 +1,382 @@
+"""Hypothetical structure search functions.
+
+Finds the top scoring hypothetical structures without enumerating every one of them.
+
+"""
+import heapq
+import itertools
+import math
+import pandas as pd
+import numpy as np
+from msms_structure_annot import hsmakers
+from msms_structure_annot import scoring
+
+# Scores closer than this are treated as ties while searching (exact scores are recomputed at the end)
+_TIE_TOL = 1e-9
+
+def _frag_contrib_table(spectra_df, ptms_df, frag_tmpl, charges, proton_m, tol, tol_unit, score_method):
+    """Summed matched ion weights of every fragment for every possible PTM count vector.
+
+    Parameters
+    ----------
+    spectra_df : pd.DataFrame
+        Dataframe with all the ms/ms spectra provided.
+    ptms_df : pd.DataFrame
+        PTM information dataframe.
+    frag_tmpl : pd.DataFrame
+        Fragment layout from hsmakers._frag_template.
+    charges : list
+        List of integer numbers of hydrogens to add.
+    proton_m : float
+        Constant for mass of a proton.
+    tol : float
+        +/- tolerance to use for matching m/z values.
+    tol_unit : str
+        Either 'Da' or 'ppm'.
+    score_method : str
+        Scoring method to be used (any key of scoring.SCORERS).
+
+    Returns
+    -------
+    np.array
+        (n_fragments x (num_mods+1) x ... ) array; entry [f, c_0, c_1, ...] is the weight fragment f
+        contributes (over the deconvoluted mass and all charges) when it holds c_p of PTM p.
+    """
+    n_mods = list(ptms_df['num_mods'])
+    count_vecs = np.array(list(itertools.product(*[range(k + 1) for k in n_mods])), dtype = 'int64')
+    count_vecs = count_vecs.reshape(-1, len(n_mods))
+
+    # Masses are built the same way (and in the same order) as hsmakers._frag_mass_matrix
+    masses = np.repeat(frag_tmpl['base_mw'].values[:, None], len(count_vecs), axis = 1)
+    for p, ptm_shift in enumerate(ptms_df['m_shift']):
+        masses = masses + ptm_shift*count_vecs[:, p]
+
+    # Each count vector is matched like a structure with those counts in every fragment
+    matched_df, hyp_pos = hsmakers._match_charged_masses(spectra_df, frag_tmpl, masses.T, charges, proton_m, tol,
+        tol_unit)
+    ion_weights = np.asarray(scoring.SCORERS[score_method](matched_df), dtype = 'float64')
+
+    n_ions = len(frag_tmpl)*len(count_vecs)
+    contrib = np.bincount(hyp_pos % n_ions, weights = ion_weights, minlength = n_ions).reshape(masses.T.shape).T
+
+    return contrib.reshape([len(frag_tmpl)] + [k + 1 for k in n_mods])
+
+def _charged_hs_ions(hs_ids, ptms_df, parent_seq, N_term_mod, C_term_mod, charges, proton_m):
+    """Charged fragment ions of specific hypothetical structures (like mk_charge_df on their frag_hs rows)."""
+    hss = hsmakers.HypotheticalStructureSet.from_ptms(ptms_df, hs_ids = hs_ids)
+    frag_df = hsmakers.frag_hs(hss, ptms_df, parent_seq, N_term_mod, C_term_mod)
+
+    return hsmakers.mk_charge_df(frag_df, charges, proton_m)
+
+def _score_hs_ids(hs_ids, spectra_df, ptms_df, parent_seq, N_term_mod, C_term_mod, charges, proton_m,
+        tol, N_spectra, score_method, tol_unit):
+    """Scores specific hypothetical structures with the regular fragment / match / score pipeline."""
+    frag_df_charged = _charged_hs_ions(hs_ids, ptms_df, parent_seq, N_term_mod, C_term_mod, charges, proton_m)
+    matched_df = scoring.match_ions(spectra_df, frag_df_charged, tol, tol_unit)
+
+    return scoring.score_wrapper(matched_df, frag_df_charged, N_spectra, score_method = score_method)
+
+def match_hs_ids(hs_ids, spectra_df, ptms_df, parent_seq, N_term_mod, C_term_mod, charges, proton_m, tol,
+        tol_unit = 'Da'):
+    """Matched ions of specific hypothetical structures only (e.g. the top scoring ones, for reports and
+    label_spectra_plot).
+
+    Parameters
+    ----------
+    hs_ids : list
+        Hypothetical structure IDs (as numbered by gen_hss).
+    spectra_df : pd.DataFrame
+        Dataframe with all the (s/n filtered) ms/ms spectra provided.
+    ptms_df : pd.DataFrame
+        PTM information dataframe.
+    parent_seq : str
+        Untruncated peptide sequence
+    N_term_mod : float
+        N-terminal modification mass shift.
+    C_term_mod : float
+        C-terminal modification mass shift.
+    charges : list
+        List of integer numbers of hydrogens to add.
+    proton_m : float
+        Constant for mass of a proton.
+    tol : float
+        +/- tolerance to use for matching m/z values.
+    tol_unit : str, optional
+        Either 'Da' or 'ppm', by default 'Da'
+
+    Returns
+    -------
+    pd.DataFrame
+        Same rows as match_ions on every structure, restricted to hs_ids.
+    """
+    frag_df_charged = _charged_hs_ions(hs_ids, ptms_df, parent_seq, N_term_mod, C_term_mod, charges, proton_m)
+
+    return scoring.match_ions(spectra_df, frag_df_charged, tol, tol_unit)
+
+def stream_topk_hss(spectra_df, ptms_df, parent_seq, N_term_mod, C_term_mod, charges, proton_m, tol, N_spectra,
+        k = 10, score_method = 'frac', chunk_size = 10000, tol_unit = 'Da'):
+    """Finds the top k scoring hypothetical structures by streaming over chunks of structures.
+
+    Each chunk's fragment m/z values are built as a plain array, matched against the spectra and
+    reduced to one score per structure straight away; only the best k structures seen so far are
+    kept in a heap. No matched ion dataframe with the full fragment and peak rows is built (use
+    match_hs_ids for the structures that get reported or plotted), so memory is bounded by the
+    chunk size. Scorers are given the matched ions with the same columns as match_ions on
+    mk_charge_df output. Works for any PTMs and scoring method, unlike topk_hss, and scores are
+    identical to score_wrapper.
+
+    Parameters
+    ----------
+    spectra_df : pd.DataFrame
+        Dataframe with all the (s/n filtered) ms/ms spectra provided.
+    ptms_df : pd.DataFrame
+        PTM information dataframe.
+    parent_seq : str
+        Untruncated peptide sequence
+    N_term_mod : float
+        N-terminal modification mass shift.
+    C_term_mod : float
+        C-terminal modification mass shift.
+    charges : list
+        List of integer numbers of hydrogens to add.
+    proton_m : float
+        Constant for mass of a proton.
+    tol : float
+        +/- tolerance to use for matching m/z values.
+    N_spectra : int
+        Number of spectra provided.
+    k : int, optional
+        Number of structures to return, by default 10
+    score_method : str, optional
+        Scoring method to be used (any key of scoring.SCORERS), by default 'frac'
+    chunk_size : int, optional
+        Number of hypothetical structures per chunk, by default 10000
+    tol_unit : str, optional
+        Either 'Da' or 'ppm', by default 'Da'
+
+    Returns
+    -------
+    pd.DataFrame
+        Scores of the top k hypothetical structures, sorted by score (ties by hs_id).
+
+    Raises
+    ------
+    ValueError
+        If scoring method provided is not a valid method.
+    """
+    if score_method not in scoring.SCORERS:
+        raise ValueError('{method} is not a supported scoring metric'.format(method = score_method))
+
+    frag_tmpl = hsmakers._frag_template(parent_seq, N_term_mod, C_term_mod)
+    n_frags = len(frag_tmpl)
+    ion_charges = np.array([0] + list(charges), dtype = 'int64')
+    mz_index = scoring._mz_index(spectra_df)
+    spectra_df = spectra_df.reset_index(drop = True)
+
+    top_heap = [] # (score, -hs_id) of the best k so far
+    for start in range(0, hsmakers.count_hss(ptms_df), chunk_size):
+        hss = hsmakers.HypotheticalStructureSet.from_ptms(ptms_df, start, start + chunk_size)
+        hs_ids, masses = hsmakers._frag_mass_matrix(hss, ptms_df, frag_tmpl, len(parent_seq))
+
+        matched_df, hyp_pos = hsmakers._match_charged_masses(spectra_df, frag_tmpl, masses, charges, proton_m,
+            tol, tol_unit, hs_ids = hs_ids, mz_index = mz_index)
+        hs_codes = (hyp_pos // n_frags) % len(hs_ids)
+        ion_weights = np.asarray(scoring.SCORERS[score_method](matched_df), dtype = 'float64')
+
+        # Fragments from a cut inside a ring have NaN masses and never match
+        n_ions = np.isfinite(masses).sum(axis = 1)*len(ion_charges)
+        scores = scoring._sum_scores(hs_codes, ion_weights, n_ions, N_spectra)
+
+        # Only the chunk's own top k can make it into the overall top k
+        for i in np.lexsort((hs_ids, -scores))[:k]:
+            entry = (scores[i], -int(hs_ids[i]))
+            if len(top_heap) < k:
+                heapq.heappush(top_heap, entry)
+            elif entry > top_heap[0]:
+                heapq.heapreplace(top_heap, entry)
+
+    top = sorted(top_heap, reverse = True)
+
+    return pd.DataFrame({
+        'hs_id': np.array([-neg_hs_id for _, neg_hs_id in top], dtype = int),
+        'score': np.array([score for score, _ in top], dtype = 'float64'),
+        'score_method': score_method,
+    })
+
+def topk_hss(spectra_df, ptms_df, parent_seq, N_term_mod, C_term_mod, charges, proton_m, tol, N_spectra,
+        k = 10, score_method = 'frac', tol_unit = 'Da'):
+    """Finds the top k scoring hypothetical structures with a branch-and-bound search.
+
+    Modification sites are assigned one at a time in sequence order. Once every site that could
+    change a fragment's PTM counts is assigned, that fragment's contribution to the score is
+    fixed. Partial assignments whose fixed contributions plus the best possible contribution of
+    the remaining fragments cannot reach the current top k are pruned, so the full hypothetical
+    structure space is never enumerated. The structures found are rescored with score_wrapper, so
+    IDs and scores are identical to scoring every structure from gen_hss.
+
+    The search only works for point PTMs, whose sites can be decided one at a time, and with
+    scorers that don't depend on "hs_id"; use stream_topk_hss otherwise.
+
+    Parameters
+    ----------
+    spectra_df : pd.DataFrame
+        Dataframe with all the (s/n filtered) ms/ms spectra provided.
+    ptms_df : pd.DataFrame
+        PTM information dataframe (point PTMs only).
+    parent_seq : str
+        Untruncated peptide sequence
+    N_term_mod : float
+        N-terminal modification mass shift.
+    C_term_mod : float
+        C-terminal modification mass shift.
+    charges : list
+        List of integer numbers of hydrogens to add.
+    proton_m : float
+        Constant for mass of a proton.
+    tol : float
+        +/- tolerance to use for matching m/z values.
+    N_spectra : int
+        Number of spectra provided.
+    k : int, optional
+        Number of structures to return, by default 10
+    score_method : str, optional
+        Scoring method to be used (any key of scoring.SCORERS), by default 'frac'
+    tol_unit : str, optional
+        Either 'Da' or 'ppm', by default 'Da'
+
+    Returns
+    -------
+    pd.DataFrame
+        Scores of the top k hypothetical structures, sorted by score (ties by hs_id).
+
+    Raises
+    ------
+    ValueError
+        If scoring method provided is not a valid method or any of the PTMs aren't point modifications.
+    """
+    if score_method not in scoring.SCORERS:
+        raise ValueError('{method} is not a supported scoring metric'.format(method = score_method))
+    if 'type' in ptms_df and (ptms_df['type'] != 'point').any():
+        raise ValueError('topk_hss only supports point PTMs; use stream_topk_hss for ring PTMs')
+
+    mod_options = hsmakers._ptm_mod_options(ptms_df)
+    n_ptms = len(mod_options)
+    n_mods = np.array([mod_count for _, mod_count in mod_options], dtype = 'int64')
+    seq_len = len(parent_seq)
+
+    frag_tmpl = hsmakers._frag_template(parent_seq, N_term_mod, C_term_mod)
+    contrib = _frag_contrib_table(spectra_df, ptms_df, frag_tmpl, charges, proton_m, tol, tol_unit, score_method)
+    n_frags = len(frag_tmpl)
+    norm = n_frags*(len(charges) + 1)*N_spectra
+
+    # One include/exclude decision per (PTM, candidate position), made in sequence order
+    decisions = sorted(
+        (pos, p, j) for p, (mod_poss, _) in enumerate(mod_options) for j, pos in enumerate(mod_poss))
+    dec_pos = np.array([pos for pos, _, _ in decisions], dtype = 'float64')
+    dec_ptm = np.array([p for _, p, _ in decisions], dtype = 'int64')
+    n_dec = len(decisions)
+    # Candidates of the same PTM still undecided after each decision
+    n_later = np.array([(dec_ptm[d + 1:] == dec_ptm[d]).sum() for d in range(n_dec)], dtype = 'int64')
+
+    # Decisions inside / outside of each fragment's PTM range, by PTM
+    in_idxs = []
+    out_idxs = []
+    fix_depth = np.zeros(n_frags, dtype = 'int64')
+    for lo, hi in zip(frag_tmpl['pos_lo'], frag_tmpl['pos_hi']):
+        in_range = (dec_pos >= lo) & (dec_pos <= hi) & (dec_pos <= seq_len)
+        in_idxs.append([np.flatnonzero(in_range & (dec_ptm == p)) for p in range(n_ptms)])
+        out_idxs.append([np.flatnonzero(~in_range & (dec_ptm == p)) for p in range(n_ptms)])
+    # A fragment's counts are fixed once either all of its inside or all of its outside decisions are made
+    for f in range(n_frags):
+        fix_depth[f] = max([
+            min(in_idxs[f][p][-1] if len(in_idxs[f][p]) else -1, out_idxs[f][p][-1] if len(out_idxs[f][p]) else -1) + 1
+            for p in range(n_ptms)
+        ], default = 0)
+    frags_fixed_at = [np.flatnonzero(fix_depth == d) for d in range(n_dec + 1)]
+
+    # Cheap bound for unfixed fragments: their best contribution over any PTM counts
+    frag_max = contrib.reshape(n_frags, -1).max(axis = 1)
+    unfixed_max = np.array([frag_max[fix_depth > d].sum() for d in range(n_dec + 1)])
+
+    chosen = np.zeros(n_dec, dtype = bool)
+    n_incl = np.zeros(n_ptms, dtype = 'int64')
+    top_heap = [] # (approximate score, -hs_id) of the best k so far
+    candidates = [] # (approximate score, hs_id) that could make the top k
+
+    def fixed_counts(f, depth):
+        counts = []
+        for p in range(n_ptms):
+            if len(in_idxs[f][p]) == 0 or in_idxs[f][p][-1] < depth:
+                counts.append(chosen[in_idxs[f][p]].sum())
+            else:
+                counts.append(n_mods[p] - chosen[out_idxs[f][p]].sum())
+        return tuple(counts)
+
+    def box_bound(depth):
+        bound = 0
+        for f in np.flatnonzero(fix_depth > depth):
+            box = []
+            for p in range(n_ptms):
+                n_left = n_mods[p] - n_incl[p]
+                ins = in_idxs[f][p]
+                outs = out_idxs[f][p]
+                n_in = chosen[ins[ins < depth]].sum()
+                n_in_open = (ins >= depth).sum()
+                n_out_open = (outs >= depth).sum()
+                box.append(slice(n_in + max(0, n_left - n_out_open), n_in + min(n_left, n_in_open) + 1))
+            bound += contrib[(f, *box)].max()
+        return bound
+
+    def threshold():
+        return top_heap[0][0] - _TIE_TOL if len(top_heap) == k else -np.inf
+
+    def leaf(score):
+        if score < threshold():
+            return
+        # Rank each PTM's chosen positions and combine them like gen_hss_range numbers structures
+        hs_id = 0
+        for p, (mod_poss, mod_count) in enumerate(mod_options):
+            comb = sorted(j for (_, dp, j), c in zip(decisions, chosen) if c and dp == p)
+            rank = hsmakers._rank_combinations(np.array([comb], dtype = 'int64').reshape(1, mod_count), len(mod_poss))
+            hs_id = hs_id*math.comb(len(mod_poss), mod_count) + int(rank[0])
+        candidates.append((score, hs_id))
+        heapq.heappush(top_heap, (score, -hs_id))
+        if len(top_heap) > k:
+            heapq.heappop(top_heap)
+
+    def search(depth, fixed_sum):
+        # Add the fragments that became fixed with the last decision
+        for f in frags_fixed_at[depth]:
+            fixed_sum += contrib[(f, *fixed_counts(f, depth))]
+
+        if depth == n_dec:
+            leaf(fixed_sum / norm)
+            return
+        if (fixed_sum + unfixed_max[depth]) / norm < threshold():
+            return
+        if (fixed_sum + box_bound(depth)) / norm < threshold():
+            return
+
+        p = dec_ptm[depth]
+        if n_incl[p] < n_mods[p]:
+            chosen[depth] = True
+            n_incl[p] += 1
+            search(depth + 1, fixed_sum)
+            chosen[depth] = False
+            n_incl[p] -= 1
+        if n_later[depth] >= n_mods[p] - n_incl[p]:
+            search(depth + 1, fixed_sum)
+
+    search(0, 0.0)
+
+    # Rescore everything that could be in the top k exactly and break ties by hs_id
+    kth_score = top_heap[0][0] - _TIE_TOL if len(top_heap) == k else -np.inf
+    hs_ids = sorted(hs_id for score, hs_id in candidates if score >= kth_score)
+    if len(hs_ids) == 0:
+        return pd.DataFrame({'hs_id': pd.Series([], dtype = int), 'score': [], 'score_method': []})
+
+    scores_df = _score_hs_ids(hs_ids, spectra_df, ptms_df, parent_seq, N_term_mod, C_term_mod, charges,
+        proton_m, tol, N_spectra, score_method, tol_unit)
+    scores_df = scores_df.sort_values(['score', 'hs_id'], ascending = [False, True], kind = 'stable')
+
+    return scores_df.head(k).reset_index(drop = True)
@@ -0,0 +1,217 @@
+"""Decoy significance functions.
+
+Estimates how likely a hypothetical structure's score is by chance, by rescoring every
+structure against decoy spectra. Decoys are made by shifting each spectrum's peaks by a
+random m/z offset or by scattering its peaks over random m/z positions; either way the
+abundances (and so the weights) stay the same but real fragment matches are destroyed.
+
+    scores_df = scoring.score_wrapper(matched_df, frag_df_charged, N_spec, score_method = 'frac')
+    scores_df = add_pvalues(scores_df, ms_df_sn_filter, frag_df_charged, tol, N_spec, n_decoys = 500)
+
+"""
+import pandas as pd
+import numpy as np
+from msms_structure_annot import scoring
+from msms_structure_annot.incidence import IncidenceMatrix
+
+DECOY_METHODS = ('shift', 'shuffle')
+
+def _decoy_batch(spectra_df, n_decoys, rng, method = 'shift', shift_range = (10, 50)):
+    """Decoy m/z values for a batch of decoys.
+
+    Random numbers are drawn decoy by decoy, so the decoys only depend on the generator
+    state, not on how they're batched.
+
+    Parameters
+    ----------
+    spectra_df : pd.DataFrame
+        Dataframe with all the (s/n filtered) ms/ms spectra provided.
+    n_decoys : int
+        Number of decoys.
+    rng : np.random.Generator
+        Random number generator.
+    method : str, optional
+        'shift' (every peak of a spectrum moves by the same random offset) or 'shuffle' (every
+        peak moves to a random m/z within its spectrum's m/z range), by default 'shift'
+    shift_range : tuple, optional
+        Smallest and largest size of the offsets in Da (either direction), by default (10, 50)
+
+    Returns
+    -------
+    np.array
+        (n_decoys x n_peaks) array of decoy m/z values, peaks in spectra_df row order.
+    """
+    mz = spectra_df['m/z'].values.astype('float64')
+    spec_codes, spec_nums = pd.factorize(spectra_df['spec_num'])
+
+    if method == 'shift':
+        draws = rng.random((n_decoys, len(spec_nums), 2))
+        offsets = shift_range[0] + draws[..., 0]*(shift_range[1] - shift_range[0])
+        offsets = np.where(draws[..., 1] < 0.5, -offsets, offsets)
+        return mz + offsets[:, spec_codes]
+    if method == 'shuffle':
+        mz_min = pd.Series(mz).groupby(spec_codes).min().values
+        mz_max = pd.Series(mz).groupby(spec_codes).max().values
+        draws = rng.random((n_decoys, len(mz)))
+        return mz_min[spec_codes] + draws*(mz_max - mz_min)[spec_codes]
+
+    raise ValueError('{method} is not a supported decoy method'.format(method = method))
+
+def decoy_spectra(spectra_df, n_decoys, method = 'shift', seed = 0, shift_range = (10, 50)):
+    """Builds decoy spectra.
+
+    Parameters
+    ----------
+    spectra_df : pd.DataFrame
+        Dataframe with all the (s/n filtered) ms/ms spectra provided.
+    n_decoys : int
+        Number of decoys.
+    method : str, optional
+        'shift' or 'shuffle' (see _decoy_batch), by default 'shift'
+    seed : int, optional
+        Random seed, by default 0
+    shift_range : tuple, optional
+        Smallest and largest size of the 'shift' offsets in Da, by default (10, 50)
+
+    Returns
+    -------
+    pd.DataFrame
+        Copies of spectra_df (with decoy m/z values) stacked on top of each other, with a
+        "decoy" column numbering them.
+    """
+    decoy_mz = _decoy_batch(spectra_df, n_decoys, np.random.default_rng(seed), method, shift_range)
+    decoys_df = pd.concat([spectra_df.reset_index(drop = True)]*n_decoys, ignore_index = True)
+    decoys_df['m/z'] = decoy_mz.ravel()
+    decoys_df['decoy'] = np.repeat(np.arange(n_decoys), len(spectra_df))
+
+    return decoys_df
+
+def decoy_scores(incidence, spectra_df, tol, N_spectra, n_decoys = 200, score_method = 'frac', decoy_method = 'shift',
+        seed = 0, tol_unit = 'Da', shift_range = (10, 50), batch_size = 100):
+    """Scores every hypothetical structure against every decoy.
+
+    Each batch of decoys is matched against the unique fragment m/z values of the incidence
+    matrix in one pass, and all structures are scored against all of the batch's decoys with
+    one sparse matrix product.
+
+    Parameters
+    ----------
+    incidence : IncidenceMatrix
+        Incidence matrix of the fragment table.
+    spectra_df : pd.DataFrame
+        Dataframe with all the (s/n filtered) ms/ms spectra provided.
+    tol : float
+        +/- tolerance to use for matching m/z values.
+    N_spectra : int
+        Number of spectra provided.
+    n_decoys : int, optional
+        Number of decoys, by default 200
+    score_method : str, optional
+        Scoring method to be used (one that IncidenceMatrix supports), by default 'frac'
+    decoy_method : str, optional
+        'shift' or 'shuffle' (see decoy_spectra), by default 'shift'
+    seed : int, optional
+        Random seed, by default 0
+    tol_unit : str, optional
+        Either 'Da' or 'ppm', by default 'Da'
+    shift_range : tuple, optional
+        Smallest and largest size of the 'shift' offsets in Da, by default (10, 50)
+    batch_size : int, optional
+        Number of decoys matched at once, by default 100
+
+    Returns
+    -------
+    np.array
+        (n_structures x n_decoys) array of decoy scores, structures in incidence.hs_ids order.
+    """
+    if score_method not in scoring.SCORERS:
+        raise ValueError('{method} is not a supported scoring metric'.format(method = score_method))
+
+    rng = np.random.default_rng(seed)
+    spectra_df = spectra_df.reset_index(drop = True)
+    # Weights only depend on the peaks, which every decoy keeps
+    ion_weights = np.asarray(scoring.SCORERS[score_method](
+        spectra_df.assign(hyp_mw = spectra_df['m/z'])), dtype = 'float64')
+    n_mz = len(incidence.unique_mz)
+
+    scores = np.empty((len(incidence.hs_ids), n_decoys))
+    for start in range(0, n_decoys, batch_size):
+        n_batch = min(batch_size, n_decoys - start)
+        decoy_mz = _decoy_batch(spectra_df, n_batch, rng, decoy_method, shift_range)
+
+        # One match of the unique fragment m/z values against every peak of every decoy in the batch
+        mz_pos, obs_pos = scoring._match_pairs(scoring._mz_index(pd.DataFrame({'m/z': decoy_mz.ravel()})),
+            incidence.unique_mz, tol, tol_unit)
+        weights = np.bincount(mz_pos*n_batch + obs_pos // len(spectra_df),
+            weights = ion_weights[obs_pos % len(spectra_df)], minlength = n_mz*n_batch).reshape(n_mz, n_batch)
+
+        scores[:, start:start + n_batch] = incidence.spectrum_scores(weights) / (incidence.n_ions*N_spectra)[:, None]
+
+    return scores
+
+def add_pvalues(scores_df, spectra_df, all_ions_df, tol, N_spectra, n_decoys = 200, decoy_method = 'shift', seed = 0,
+        tol_unit = 'Da', shift_range = (10, 50), batch_size = 100):
+    """Adds empirical p-values from decoy spectra to score_wrapper output.
+
+    Two p-values are given for each structure: "p_value" compares its score with its own
+    decoy scores, "p_value_best" with the best score of any structure in each decoy (so it
+    also accounts for how many structures were tried). Both are (1 + number of decoys scoring
+    at least as high) / (1 + n_decoys).
+
+    Parameters
+    ----------
+    scores_df : pd.DataFrame
+        Scores from score_wrapper (any number of scoring methods stacked together).
+    spectra_df : pd.DataFrame
+        Dataframe with all the (s/n filtered) ms/ms spectra the scores came from.
+    all_ions_df : pd.DataFrame
+        Dataframe of all hypothetical fragment ions the scores came from.
+    tol : float
+        +/- tolerance to use for matching m/z values.
+    N_spectra : int
+        Number of spectra provided.
+    n_decoys : int, optional
+        Number of decoys, by default 200
+    decoy_method : str, optional
+        'shift' or 'shuffle' (see decoy_spectra), by default 'shift'
+    seed : int, optional
+        Random seed (the same decoys are used for every scoring method), by default 0
+    tol_unit : str, optional
+        Either 'Da' or 'ppm', by default 'Da'
+    shift_range : tuple, optional
+        Smallest and largest size of the 'shift' offsets in Da, by default (10, 50)
+    batch_size : int, optional
+        Number of decoys matched at once, by default 100
+
+    Returns
+    -------
+    pd.DataFrame
+        scores_df with "p_value" and "p_value_best" columns.
+
+    Raises
+    ------
+    ValueError
+        If scores_df has an hs_id that isn't in all_ions_df.
+    """
+    incidence = IncidenceMatrix(all_ions_df)
+    scores_df = scores_df.copy()
+    scores_df['p_value'] = np.nan
+    scores_df['p_value_best'] = np.nan
+
+    for score_method, method_rows in scores_df.groupby('score_method', sort = False).groups.items():
+        # Observed scores are recalculated the same way as the decoy scores so ties compare equal
+        observed = incidence.score(spectra_df, tol, N_spectra, score_method, tol_unit)['score'].values
+        null_scores = decoy_scores(incidence, spectra_df, tol, N_spectra, n_decoys, score_method, decoy_method, seed,
+            tol_unit, shift_range, batch_size)
+
+        n_higher = (null_scores >= observed[:, None]).sum(axis = 1)
+        best_null = np.sort(null_scores.max(axis = 0, initial = 0))
+        n_best_higher = n_decoys - np.searchsorted(best_null, observed, side = 'left')
+
+        hs_pos = pd.Index(incidence.hs_ids).get_indexer(scores_df.loc[method_rows, 'hs_id'])
+        if (hs_pos < 0).any():
+            raise ValueError('scores_df has hs_ids with no fragment ions in all_ions_df')
+        scores_df.loc[method_rows, 'p_value'] = (1 + n_higher[hs_pos]) / (1 + n_decoys)
+        scores_df.loc[method_rows, 'p_value_best'] = (1 + n_best_higher[hs_pos]) / (1 + n_decoys)
+
+    return scores_df
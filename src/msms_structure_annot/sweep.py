@@ -0,0 +1,139 @@
+"""Parameter sweep functions.
+
+Scores hypothetical structures for every combination of tolerance, signal-to-noise
+threshold, background sections and abundance ceiling without rerunning the pipeline
+for each one.
+
+"""
+import itertools
+import pandas as pd
+import numpy as np
+from msms_structure_annot import msprocess
+from msms_structure_annot import scoring
+
+PARAM_COLS = ['upper_lim', 'N', 'tol', 'sn_thr']
+
+def sweep_matches(spectra_df, hs_frag_df, max_tol, tol_unit = 'Da'):
+    """Matches observed ions to hypothetical ions once at the widest tolerance of a sweep.
+
+    Parameters
+    ----------
+    spectra_df : pd.DataFrame
+        Dataframe with all the (unfiltered) ms/ms spectra provided.
+    hs_frag_df : pd.DataFrame
+        Dataframe with all the fragments and masses for hypothetical structures.
+    max_tol : float
+        Widest +/- tolerance of the sweep.
+    tol_unit : str, optional
+        Either 'Da' or 'ppm', by default 'Da'
+
+    Returns
+    -------
+    pd.DataFrame
+        Matched ions like match_ions, plus the m/z error of each match ("mz_error", observed -
+        hypothetical) and, if the spectra have "abund_ceil" and "bkgd" columns, its
+        signal-to-noise ratio ("s/n").
+    np.array
+        Row position in spectra_df of the observed ion of each match.
+    """
+    hs_ion_pos, obs_ion_pos = scoring._match_pairs(
+        scoring._mz_index(spectra_df), hs_frag_df['hyp_mw'].values, max_tol, tol_unit)
+
+    matched_df = pd.concat([
+        hs_frag_df.iloc[hs_ion_pos].reset_index(drop = True),
+        spectra_df.iloc[obs_ion_pos].reset_index(drop = True),
+        ], sort = False, axis = 1)
+    matched_df['mz_error'] = matched_df['m/z'].values - matched_df['hyp_mw'].values
+    if {'abund_ceil', 'bkgd'} <= set(spectra_df.columns):
+        matched_df['s/n'] = matched_df['abund_ceil'] / matched_df['bkgd']
+
+    return matched_df, obs_ion_pos
+
+def sweep_scores(ms_df, frag_df_charged, tols, sn_thrs, Ns, upper_lims, score_methods = ('frac', 'weights'),
+        tol_unit = 'Da', bkgd_method = 'sections'):
+    """Scores every hypothetical structure for every combination of processing and matching parameters.
+
+    Observed and hypothetical ions are matched only once, at the widest tolerance. The scores
+    for each (tol, sn_thr) pair are then found by thresholding the m/z error and the
+    signal-to-noise ratio of those matches. Abundance ceilings are recalculated for each
+    upper_lim and backgrounds for each (upper_lim, N) pair. Scores are identical to running the
+    example notebook (s/n filter, match_ions, score_wrapper) with each combination.
+
+    Parameters
+    ----------
+    ms_df : pd.DataFrame
+        Dataframe with all msms data (from import_ms_files).
+    frag_df_charged : pd.DataFrame
+        Dataframe with all the charged fragments and masses for hypothetical structures.
+    tols : list
+        +/- tolerances to use for matching m/z values.
+    sn_thrs : list
+        Signal-to-noise thresholds.
+    Ns : list
+        Numbers of sections to split each spectrum into when calculating background.
+    upper_lims : list
+        Multipliers of the mean abundance value to set the ceiling at.
+    score_methods : tuple, optional
+        Scoring methods to be used, by default ('frac', 'weights')
+    tol_unit : str, optional
+        Either 'Da' or 'ppm', by default 'Da'
+    bkgd_method : str, optional
+        Background calculation method (see msprocess.bkgd_calc_ser), by default 'sections'
+
+    Returns
+    -------
+    pd.DataFrame
+        "score" indexed (and sorted) by upper_lim, N, tol, sn_thr, score_method and hs_id.
+    """
+    for score_method in score_methods:
+        if score_method not in scoring.SCORERS:
+            raise ValueError('{method} is not a supported scoring metric'.format(method = score_method))
+
+    ms_df = ms_df.sort_values(by = ['spec_num', 'm/z']).reset_index(drop = True)
+    N_spectra = ms_df['spec_num'].nunique()
+
+    # Give each hypothetical structure an integer code and count its ions
+    hs_codes, hs_ids = pd.factorize(frag_df_charged['hs_id'])
+    n_ions = np.bincount(hs_codes, minlength = len(hs_ids))
+    hs_ids = np.asarray(hs_ids).astype(int)
+
+    matched_df, obs_pos = sweep_matches(ms_df[['m/z', 'orig_abundance', 'spec_num']], frag_df_charged,
+        max(tols), tol_unit)
+    matched_codes = pd.Index(hs_ids).get_indexer(matched_df['hs_id'])
+
+    # The same inclusive windows match_ions would use for each tolerance
+    obs_mz = matched_df['m/z'].values
+    tol_masks = {}
+    for tol in tols:
+        lower, upper = scoring._tol_window(matched_df['hyp_mw'].values.astype('float64'), tol, tol_unit)
+        tol_masks[tol] = (obs_mz >= lower) & (obs_mz <= upper)
+
+    scores_dfs = []
+    for upper_lim in upper_lims:
+        ceil_df = ms_df.copy()
+        ceil_df['abund_ceil'] = ceil_df.groupby('spec_num')['orig_abundance'].transform(
+            lambda x: msprocess.abund_ceiling(x.copy(), upper_lim))
+        matched_df['abund_ceil'] = ceil_df['abund_ceil'].values[obs_pos]
+
+        for N in Ns:
+            bkgd = msprocess.bkgd_calc(ceil_df, N, method = bkgd_method).values
+            matched_df['bkgd'] = bkgd[obs_pos]
+            matched_df['s/n'] = matched_df['abund_ceil'] / matched_df['bkgd']
+            ion_weights = {method: np.asarray(scoring.SCORERS[method](matched_df), dtype = 'float64')
+                for method in score_methods}
+
+            for sn_thr, tol in itertools.product(sn_thrs, tols):
+                # Same s/n filter as the example notebook
+                keep = tol_masks[tol] & (matched_df['abund_ceil'].values > sn_thr*matched_df['bkgd'].values)
+                for method in score_methods:
+                    scores_dfs.append(pd.DataFrame({
+                        'upper_lim': upper_lim, 'N': N, 'tol': tol, 'sn_thr': sn_thr, 'score_method': method,
+                        'hs_id': hs_ids,
+                        'score': scoring._sum_scores(matched_codes[keep], ion_weights[method][keep], n_ions,
+                            N_spectra),
+                    }))
+
+    scores_df = pd.concat(scores_dfs, ignore_index = True)
+
+    # Sorted so lookups by parameter combination don't fall back to scanning the index
+    return scores_df.set_index(PARAM_COLS + ['score_method', 'hs_id']).sort_index()
@@ -10,4 +10,9 @@ setuptools.setup(
     long_description = long_description,
     license = 'MIT',
     packages=setuptools.find_packages(),
+    entry_points={
+        "console_scripts": [
+            "msms-annot = msms_structure_annot.cli:main", # headless batch runs (see cli.py)
+        ],
+    },
 )
\ No newline at end of file
@@ -0,0 +1,51 @@
+"""Shared fixtures for the msms_structure_annot tests
+
+The HalA2 example spectra and structures are built once per test session.
+"""
+
+import pytest
+import pandas as pd
+from msms_structure_annot import msprocess, hsmakers
+from msms_structure_annot.paths import data_dir
+
+@pytest.fixture(scope = 'session')
+def hala2_peptide():
+    """HalA2 core peptide and the fragmentation constants from the example notebook"""
+    return {
+        'parent_seq': 'GTTWPCATVGVSVALCPTTKCTSQC',
+        'N_term_mod': 0,
+        'C_term_mod': 18.0027,
+        'charges': [1,2,3],
+        'proton_m': 1.0078,
+    }
+
+@pytest.fixture(scope = 'session')
+def ptms_df():
+    """Point PTMs of the HalA2 example"""
+    return pd.DataFrame({
+        'ptm_id': [0, 1],
+        'name': ['dehydration', 'other'],
+        'm_shift': [-18.011, -2.016],
+        'num_mods': [3, 2],
+        'poss_mod_pos': [[23, 2, 3, 8, 12, 18], [6, 16, 21, 25]],
+        'type': ['point', 'point'],
+    })
+
+@pytest.fixture(scope = 'session')
+def hala2_ms_df():
+    """Unprocessed HalA2 example spectra"""
+    return msprocess.import_ms_files(data_dir / 'example_data' / '20210222_hala2', use_cache = False)
+
+@pytest.fixture(scope = 'session')
+def ms_df_sn_filter(hala2_ms_df):
+    """HalA2 example spectra, processed and s/n filtered like in the example notebook"""
+    ms_df = msprocess.process_spectra(hala2_ms_df, 50, 800)
+    return ms_df[ms_df['abund_ceil'] > 1.5*ms_df['bkgd']].reset_index(drop = True)
+
+@pytest.fixture(scope = 'session')
+def frag_df_charged(hala2_peptide, ptms_df):
+    """Charged fragment ions of every HalA2 example structure"""
+    pep = hala2_peptide
+    frag_df = hsmakers.frag_hs(hsmakers.gen_hss(ptms_df), ptms_df, pep['parent_seq'], pep['N_term_mod'],
+        pep['C_term_mod'])
+    return hsmakers.mk_charge_df(frag_df, pep['charges'], pep['proton_m'])
@@ -0,0 +1,40 @@
+"""Tests for the benchmarks module of msms_structure_annot
+"""
+
+import tracemalloc
+import pandas as pd
+import numpy as np
+from msms_structure_annot import benchmarks
+
+def test_run_benchmarks(tmp_path):
+    """Test to make sure every stage is benchmarked and the results survive a write / read round trip
+    """
+    grid = [{'seq_len': 10, 'n_sites': [3], 'num_mods': [1], 'n_peaks': 200, 'n_spectra': 2}]
+    results_df = benchmarks.run_benchmarks(grid, repeat = 2)
+
+    stages = ['gen_hss', 'frag_hs', 'mk_charge_df', 'abund_ceiling', 'bkgd_calc_ser', 'match_ions',
+        'score_wrapper[frac]', 'score_wrapper[weights]']
+    assert set(results_df['stage']) == set(stages)
+    assert (results_df['wall_s'] >= 0).all() and (results_df['peak_mem_mb'] >= 0).all()
+    assert results_df.loc[results_df['stage'] == 'gen_hss', 'n_out'].eq(3).all()
+
+    out_path = tmp_path / 'bench.json'
+    benchmarks.write_results(results_df, out_path)
+    compared_df = benchmarks.compare_results(out_path, out_path)
+    assert len(compared_df) == len(stages)
+    assert (compared_df['wall_ratio'] == 1).all()
+
+def test_measure_untraced():
+    """Test to make sure stages are timed without tracemalloc running and in-place stages get their own inputs
+    """
+    def stage(ser):
+        assert not tracemalloc.is_tracing() or ser is not abundances
+        ser *= 2
+        return ser
+
+    abundances = pd.Series([1.0, 2.0])
+    result, wall_s, peak_mem_mb = benchmarks._measure(stage, abundances)
+    assert result.tolist() == [2.0, 4.0] and wall_s >= 0 and peak_mem_mb >= 0
+
+    _, _, peak_mem_mb = benchmarks._measure(stage, abundances, track_memory = False)
+    assert np.isnan(peak_mem_mb)
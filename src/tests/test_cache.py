@@ -0,0 +1,90 @@
+"""Tests for the cache module of msms_structure_annot
+"""
+
+import subprocess
+import sys
+import pytest
+import pandas as pd
+from msms_structure_annot import cache, hsmakers, msprocess
+from msms_structure_annot.cache import StageCache, hash_inputs
+from msms_structure_annot.paths import test_data_dir
+
+ptms_df = pd.read_pickle(test_data_dir / 'ptms_df.pkl')
+hs_df = pd.read_pickle(test_data_dir / 'hs_df.pkl')
+frag_df = pd.read_pickle(test_data_dir / 'frag_df.pkl')
+
+def test_stage_cache(tmp_path):
+    """Test to make sure stages are only recomputed when their inputs change
+    """
+    stage_cache = StageCache(tmp_path)
+    frag_hs = stage_cache.wrap(hsmakers.frag_hs)
+
+    result = frag_hs(hs_df, ptms_df, 'GGGG', 0, 18.0027)
+    cached_result = frag_hs(hs_df.copy(), ptms_df.copy(), 'GGGG', 0, 18.0027)
+    assert frag_df.equals(result) and frag_df.equals(cached_result)
+    assert (stage_cache.hits, stage_cache.misses) == (1, 1)
+
+    frag_hs(hs_df, ptms_df, 'GGGG', 0, 18.0)
+    moved_ptms_df = ptms_df.copy()
+    moved_ptms_df.at[0, 'poss_mod_pos'] = [1, 2]
+    assert hash_inputs(moved_ptms_df) != hash_inputs(ptms_df)
+    assert stage_cache.misses == 2
+
+def test_stage_cache_eviction(tmp_path):
+    """Test to make sure the least recently used results are evicted first
+    """
+    stage_cache = StageCache(tmp_path)
+    mk_charge_df = stage_cache.wrap(hsmakers.mk_charge_df)
+    for charges in ([1], [1, 2], [1, 2, 3]):
+        mk_charge_df(frag_df, charges, 1.0078)
+    mk_charge_df(frag_df, [1], 1.0078) # Most recently used now
+    sizes = stage_cache.entries()['size']
+
+    stage_cache.max_bytes = sizes.sum() - 1
+    stage_cache.evict()
+    assert len(stage_cache.entries()) == 2
+
+    mk_charge_df(frag_df, [1], 1.0078)
+    assert stage_cache.hits == 2
+
+def test_stage_cache_package_edits(tmp_path, monkeypatch):
+    """Test to make sure editing the package (e.g. a helper a stage calls) invalidates cached results
+    """
+    stage_cache = StageCache(tmp_path)
+    mk_charge_df = stage_cache.wrap(hsmakers.mk_charge_df)
+    mk_charge_df(frag_df, [1], 1.0078)
+
+    monkeypatch.setattr(cache, '_package_source_hash', lambda: 'edited')
+    mk_charge_df(frag_df, [1], 1.0078)
+    assert (stage_cache.hits, stage_cache.misses) == (0, 2)
+
+def test_stage_cache_across_processes(tmp_path):
+    """Test to make sure results cached by another process are reused (stage code is keyed by content)
+    """
+    # mk_charge_df has comprehensions, whose code objects live at different addresses in each process
+    fill_script = (
+        'import pandas as pd\n'
+        'from msms_structure_annot import hsmakers\n'
+        'from msms_structure_annot.cache import StageCache\n'
+        'from msms_structure_annot.paths import test_data_dir\n'
+        'frag_df = pd.read_pickle(test_data_dir / "frag_df.pkl")\n'
+        'StageCache(r"{}").call(hsmakers.mk_charge_df, frag_df, [1, 2], 1.0078)\n'
+    ).format(tmp_path)
+    subprocess.run([sys.executable, '-c', fill_script], check = True)
+
+    stage_cache = StageCache(tmp_path)
+    stage_cache.call(hsmakers.mk_charge_df, frag_df, [1, 2], 1.0078)
+    assert (stage_cache.hits, stage_cache.misses) == (1, 0)
+
+def test_hash_inputs_objects():
+    """Test to make sure objects are hashed by content, including __slots__ classes, and unknown objects are rejected
+    """
+    def spectrum_set(abundance):
+        return msprocess.SpectrumSet.from_df(pd.DataFrame({
+            'm/z': [100.0, 200.0, 150.0], 'orig_abundance': [1.0, 2.0, abundance], 'spec_num': [1, 1, 2]}))
+
+    assert hash_inputs(spectrum_set(3.0)) == hash_inputs(spectrum_set(3.0))
+    assert hash_inputs(spectrum_set(3.0)) != hash_inputs(spectrum_set(4.0))
+
+    with pytest.raises(TypeError):
+        hash_inputs(object())
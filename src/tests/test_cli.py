@@ -0,0 +1,53 @@
+"""Tests for the cli module of msms_structure_annot
+"""
+
+import json
+import re
+import shutil
+import subprocess
+import sys
+import pandas as pd
+from msms_structure_annot import cli
+from msms_structure_annot.paths import root, data_dir
+
+def _rerun(config_file, out_root):
+    """Runs the CLI on one experiment in a new process and returns the stages it resumed."""
+    output = subprocess.run([sys.executable, '-m', 'msms_structure_annot.cli', str(config_file), '--out', str(out_root)],
+        check = True, capture_output = True, text = True, cwd = root).stdout
+    resumed = re.search(r'\(resumed: (.*)\)', output)
+
+    return resumed.group(1).split(', ') if resumed else []
+
+def test_run_batch_resumes(tmp_path):
+    """Test to make sure a batch writes the reports and a rerun (in a new process) only redoes the stages whose
+    parameters changed
+    """
+    exp_dir = tmp_path / 'exp1'
+    exp_dir.mkdir()
+    for ms_file in (data_dir / 'example_data' / '20210222_hala2').glob('ms*.txt'):
+        shutil.copy(ms_file, exp_dir)
+    config = json.loads((data_dir / 'example_data' / '20210222_hala2' / cli.CONFIG_NAME).read_text())
+    config_file = exp_dir / cli.CONFIG_NAME
+    config_file.write_text(json.dumps(config))
+    out_root = tmp_path / 'reports'
+
+    result, = cli.run_batch(cli.find_configs([tmp_path]), out_root)
+    assert result['error'] is None and result['resumed'] == []
+    scores_df = pd.read_csv(out_root / 'exp1' / 'report001' / 'hs_scores.csv')
+    assert len(scores_df) == 2*8 # 8 structures, 2 scoring methods
+
+    assert _rerun(config_file, out_root) == ['spectra', 'hss', 'fragments', 'matches', 'scores']
+    checkpoint_dir = out_root / 'exp1' / 'report001' / 'checkpoints'
+    assert len(list(checkpoint_dir.glob('*.pkl'))) == 5
+
+    config['tol'] = 0.02
+    config_file.write_text(json.dumps(config))
+    assert _rerun(config_file, out_root) == ['spectra', 'hss', 'fragments']
+
+def test_main_reports_failures(tmp_path, capsys):
+    """Test to make sure a bad experiment is reported without stopping the batch
+    """
+    (tmp_path / cli.CONFIG_NAME).write_text(json.dumps({'parent_seq': 'GTT'}))
+
+    assert cli.main([str(tmp_path), '--out', str(tmp_path / 'reports')]) == 1
+    assert 'missing parameters' in capsys.readouterr().err
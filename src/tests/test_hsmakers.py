@@ -1,9 +1,14 @@
 """Tests for the hsmakers module of msms_structure_annot
 """
 
+import itertools
 import pytest
 import pandas as pd
-from msms_structure_annot.hsmakers import frag_hs, mk_charge_df
+import numpy as np
+from msms_structure_annot.hsmakers import (
+    frag_hs, mk_charge_df, gen_hss, count_hss, iter_hss, gen_hss_range, frag_signatures,
+    HypotheticalStructureSet, filter_mod_counts, with_mod_counts
+)
 from msms_structure_annot.paths import test_data_dir
 
 # Import the pickled dataframes with example test data to compare against
@@ -18,6 +23,16 @@ C_term_mod = 18.0027
 proton_m = 1.0078
 charges = [1,2,3]
 
+# Multiple PTMs to exercise the structure enumeration
+multi_ptms_df = pd.DataFrame({
+    'ptm_id': [0, 1],
+    'name': ['dehydration', 'oxidation'],
+    'm_shift': [-18.011, 15.9949],
+    'num_mods': [3, 1],
+    'poss_mod_pos': [[2, 3, 8, 12, 18], [6, 16]],
+    'type': ['point', 'point'],
+})
+
 def test_frag_hs():
     """Test to make sure the fragmentation function still works
     """
@@ -32,4 +47,144 @@ def test_mk_charge_df():
     expected_result = frag_df_charged
     result = mk_charge_df(frag_df, charges, proton_m)
 
+    # Labels are categorical but render the same strings
+    assert isinstance(result['ion_name'].dtype, pd.CategoricalDtype)
+    assert expected_result.equals(result.astype({'ion_name': object, 'human_name': object}))
+
+def test_gen_hss():
+    """Test to make sure the hypothetical structures are still generated the same way
+    """
+    expected_result = hs_df
+    result = gen_hss(ptms_df)
+
     assert expected_result.equals(result)
+
+def test_iter_hss_chunks():
+    """Test to make sure chunked enumeration matches the full enumeration and can be addressed by hs_id
+    """
+    all_hss = gen_hss(multi_ptms_df)
+    chunks = list(iter_hss(multi_ptms_df, chunk_size = 7))
+
+    assert count_hss(multi_ptms_df) == all_hss['hs_id'].nunique() == 20
+    assert len(chunks) == 3
+    assert pd.concat(chunks, ignore_index = True).equals(all_hss)
+    assert gen_hss_range(multi_ptms_df, 9, 12).equals(
+        all_hss[all_hss['hs_id'].between(9, 11)].reset_index(drop = True))
+
+def test_gen_hss_limit():
+    """Test to make sure enumeration is refused above the structure limit
+    """
+    with pytest.raises(ValueError):
+        gen_hss(multi_ptms_df, max_hss = 10)
+
+def test_frag_signatures():
+    """Test to make sure fragment signatures map back onto the fragments of every structure
+    """
+    multi_parent_seq = 'GTTWPCATVGVSVALCPTTKCTSQC'
+    multi_hs_df = gen_hss(multi_ptms_df)
+    expected_result = frag_hs(multi_hs_df, multi_ptms_df, multi_parent_seq, N_term_mod, C_term_mod)
+    sig_df, hs_ids, hs_sigs = frag_signatures(multi_hs_df, multi_ptms_df, multi_parent_seq, N_term_mod, C_term_mod)
+
+    assert hs_sigs.shape == (20, 2*len(multi_parent_seq) - 1)
+    assert len(sig_df) < hs_sigs.size
+    assert sig_df[['b_y_p', 'ion_len', 'ptm0_count', 'ptm1_count']].duplicated().sum() == 0
+    assert np.array_equal(np.repeat(hs_ids, hs_sigs.shape[1]), expected_result['hs_id'].values)
+    for col in ['seq', 'hyp_mw', 'ion_name', 'human_name', 'b_y_p']:
+        assert np.array_equal(sig_df[col].values[hs_sigs].ravel(), expected_result[col].values)
+
+def test_hypothetical_structure_set():
+    """Test to make sure the array-backed structures round trip to the dataframe format and fragment the same way
+    """
+    multi_parent_seq = 'GTTWPCATVGVSVALCPTTKCTSQC'
+    all_hss = gen_hss(multi_ptms_df)
+    hss = HypotheticalStructureSet.from_ptms(multi_ptms_df)
+
+    assert len(hss) == 20 and hss.locs.shape == (20, 2, 3)
+    assert hss.to_df().equals(all_hss)
+    assert HypotheticalStructureSet.from_df(all_hss).to_df().equals(all_hss)
+    assert hss.ptm_locs(13) == list(all_hss.loc[all_hss['hs_id'] == 13, 'ptm_locs'])
+    assert frag_hs(hss, multi_ptms_df, multi_parent_seq, N_term_mod, C_term_mod).equals(
+        frag_hs(all_hss, multi_ptms_df, multi_parent_seq, N_term_mod, C_term_mod))
+
+    # hs_id ranges are views of the same locations
+    sub_hss = hss[9:12]
+    assert np.shares_memory(sub_hss.locs, hss.locs)
+    assert sub_hss.to_df().equals(gen_hss_range(multi_ptms_df, 9, 12))
+    assert np.array_equal(sub_hss[10], hss[10])
+    with pytest.raises(KeyError):
+        sub_hss[12]
+
+def test_filter_mod_counts():
+    """Test to make sure precursor filtering keeps exactly the count combinations whose parent ion matches
+    """
+    seq = 'GTTWPCATVGVSVALCPTTKCTSQCAAG'
+    range_ptms_df = multi_ptms_df.assign(num_mods = [[0, 5], [0, 2]])
+    hs_frag_df = frag_hs(gen_hss(with_mod_counts(multi_ptms_df, (3, 1))), multi_ptms_df, seq, N_term_mod, C_term_mod)
+    parent_mw = hs_frag_df.loc[hs_frag_df['b_y_p'] == 'p', 'hyp_mw'].iloc[0]
+    precursor_mz = (parent_mw + 2*proton_m) / 2 + 0.004
+
+    result = filter_mod_counts(range_ptms_df, seq, N_term_mod, C_term_mod, precursor_mz, [1, 2, 3], proton_m, 0.01)
+    assert result['num_mods'].tolist() == [(3, 1)]
+    assert result['precursor_charge'].tolist() == [2]
+    assert result['intact_mw'].iloc[0] == parent_mw
+    assert result['n_hss'].iloc[0] == count_hss(with_mod_counts(multi_ptms_df, (3, 1)))
+
+    # Brute force over the whole grid of counts and charges
+    wide_result = filter_mod_counts(range_ptms_df, seq, N_term_mod, C_term_mod, precursor_mz, [1, 2, 3], proton_m, 20)
+    expected_combos = set()
+    for n_dehyd, n_ox, charge in itertools.product(range(6), range(3), [1, 2, 3]):
+        mass = parent_mw + (n_dehyd - 3)*-18.011 + (n_ox - 1)*15.9949
+        if abs((mass + charge*proton_m) / charge - precursor_mz) <= 20 - 1e-6:
+            expected_combos.add(((n_dehyd, n_ox), charge))
+    assert set(zip(wide_result['num_mods'], wide_result['precursor_charge'])) >= expected_combos
+    assert (wide_result['mz_error'].abs() <= 20 + 1e-9).all()
+
+    with pytest.raises(ValueError):
+        gen_hss(range_ptms_df)
+
+def test_ring_ptms():
+    """Test to make sure rings are placed nested or side by side only, and fragments cutting inside a ring are left out
+    """
+    seq = 'GTTWPCATVGVSVALCPTTKCTSQCAAG'
+    ring_ptms_df = pd.DataFrame({
+        'ptm_id': [0, 1],
+        'name': ['lanthionine', 'oxidation'],
+        'm_shift': [-18.011, 15.9949],
+        'num_mods': [2, 1],
+        'poss_mod_pos': [[2, 3, 6, 16, 21, 25], [4, 10]],
+        'type': ['ring', 'point'],
+    })
+
+    # Brute force: every pair of distinct links that neither cross nor share a residue
+    links = list(itertools.combinations([2, 3, 6, 16, 21, 25], 2))
+    expected_rings = [
+        (r1, r2) for r1, r2 in itertools.combinations(links, 2)
+        if len(set(r1 + r2)) == 4 and not (r1[0] < r2[0] < r1[1] < r2[1] or r2[0] < r1[0] < r2[1] < r1[1])
+    ]
+    hss = HypotheticalStructureSet.from_ptms(ring_ptms_df)
+    assert count_hss(ring_ptms_df) == len(hss) == 2*len(expected_rings)
+    assert [hss.ptm_locs(hs_id)[0] for hs_id in range(0, len(hss), 2)] == expected_rings
+
+    # Long-form round trip
+    hs_df = gen_hss(ring_ptms_df)
+    assert hs_df['ptm_locs'].iloc[0] == ((2, 3), (6, 16))
+    assert HypotheticalStructureSet.from_df(hs_df).to_df().equals(hs_df)
+
+    frag_df = frag_hs(hs_df, ring_ptms_df, seq, N_term_mod, C_term_mod)
+    assert frag_df.equals(frag_hs(hss, ring_ptms_df, seq, N_term_mod, C_term_mod))
+    bare_frag_df = frag_hs(gen_hss(ring_ptms_df.assign(num_mods = [0, 0])), ring_ptms_df, seq, N_term_mod,
+        C_term_mod).set_index('ion_name')
+    for hs_id in [0, 17, len(hss) - 1]:
+        rings, oxidations = hss.ptm_locs(hs_id)
+        hs_frags = frag_df[frag_df['hs_id'] == hs_id].set_index('ion_name')
+        for ion_name in bare_frag_df.index:
+            # b_n and y_(len-n) come from the cut after residue n
+            cut = {'b': lambda n: n, 'y': lambda n: len(seq) - n, 'p': lambda n: 0}[ion_name[0]](int(ion_name[1:] or 0))
+            inside_ring = any(start <= cut < end for start, end in rings)
+            assert (ion_name not in hs_frags.index) == inside_ring
+        # The parent ion holds every ring
+        assert np.isclose(hs_frags.loc['p', 'hyp_mw'],
+            bare_frag_df.loc['p', 'hyp_mw'] + 2*-18.011 + len(oxidations)*15.9949)
+        # A b-ion past both rings holds both of them
+        assert np.isclose(hs_frags.loc['b26', 'hyp_mw'],
+            bare_frag_df.loc['b26', 'hyp_mw'] + 2*-18.011 + len(oxidations)*15.9949)
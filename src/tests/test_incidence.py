@@ -0,0 +1,32 @@
+"""Tests for the incidence module of msms_structure_annot
+"""
+
+import pytest
+import numpy as np
+from msms_structure_annot import scoring
+from msms_structure_annot.incidence import IncidenceMatrix
+
+@pytest.mark.parametrize('score_method', ['frac', 'weights'])
+@pytest.mark.parametrize('tol, tol_unit', [(0.01, 'Da'), (10, 'ppm')])
+def test_incidence_score(score_method, tol, tol_unit, ms_df_sn_filter, frag_df_charged):
+    """Test to make sure the sparse matrix-vector scores are the same as match_ions followed by score_wrapper
+    """
+    matched_df = scoring.match_ions(ms_df_sn_filter, frag_df_charged, tol, tol_unit)
+    expected_result = scoring.score_wrapper(matched_df, frag_df_charged, 4, score_method = score_method)
+
+    incidence = IncidenceMatrix(frag_df_charged)
+    result = incidence.score(ms_df_sn_filter, tol, 4, score_method = score_method, tol_unit = tol_unit)
+
+    assert expected_result['hs_id'].equals(result['hs_id'])
+    assert np.allclose(expected_result['score'], result['score'], rtol = 1e-12, atol = 0)
+
+    # Per-spectrum scores add up to the totals
+    weights, spec_nums = incidence.peak_weights(ms_df_sn_filter, tol, score_method, tol_unit)
+    assert spec_nums.tolist() == [1, 2, 3, 4]
+    spectrum_sums = incidence.spectrum_scores(weights)
+    assert np.allclose(spectrum_sums.sum(axis = 1) / (incidence.n_ions*4), result['score'])
+    for i, spec_num in enumerate(spec_nums):
+        spec_df = ms_df_sn_filter[ms_df_sn_filter['spec_num'] == spec_num]
+        spec_matched_df = scoring.match_ions(spec_df, frag_df_charged, tol, tol_unit)
+        spec_result = scoring.score_wrapper(spec_matched_df, frag_df_charged, 1, score_method = score_method)
+        assert np.allclose(spectrum_sums[:, i] / incidence.n_ions, spec_result['score'])
@@ -0,0 +1,33 @@
+"""Tests for the instrument module of msms_structure_annot
+"""
+
+import json
+import pandas as pd
+from msms_structure_annot import instrument, hsmakers, scoring
+from msms_structure_annot.paths import test_data_dir
+
+ptms_df = pd.read_pickle(test_data_dir / 'ptms_df.pkl')
+frag_df_charged = pd.read_pickle(test_data_dir / 'frag_df_charged.pkl')
+
+def test_recording(tmp_path):
+    """Test to make sure stage calls are only recorded when asked to, with their input and output sizes
+    """
+    spectra_df = pd.DataFrame({'m/z': [57.0214, 75.0200], 'orig_abundance': [10., 20.], 'spec_num': [1, 1]})
+    hsmakers.gen_hss(ptms_df)
+    assert instrument.records_df().empty
+
+    with instrument.recording() as records:
+        hs_df = hsmakers.gen_hss(ptms_df)
+        matched_df = scoring.match_ions(spectra_df, frag_df_charged, 0.01)
+    hsmakers.gen_hss(ptms_df)
+
+    assert [record['stage'] for record in records] == ['hsmakers.gen_hss', 'scoring.match_ions']
+    assert records[0]['out_size'] == len(hs_df) and records[0]['peak_mem_mb'] >= 0
+    assert records[1]['in_sizes'] == {'spectra_df': 2, 'hs_frag_df': len(frag_df_charged)}
+    assert records[1]['out_size'] == len(matched_df)
+
+    summary_df = instrument.summary_table()
+    assert list(summary_df['calls']) == [1, 1]
+
+    instrument.dump_json(tmp_path / 'profile.json')
+    assert len(json.loads((tmp_path / 'profile.json').read_text())) == 2
@@ -0,0 +1,128 @@
+"""Tests for the msprocess module of msms_structure_annot
+"""
+
+import pytest
+import pandas as pd
+import numpy as np
+import shutil
+from msms_structure_annot.msprocess import (
+    bkgd_calc_ser, bkgd_calc, import_ms_files, read_ms_header, process_spectra, SpectrumSet
+)
+from msms_structure_annot.paths import data_dir
+
+# Random spectra of different lengths to calculate backgrounds for
+rng = np.random.default_rng(0)
+spec_lens = [101, 250, 37]
+ms_df = pd.DataFrame({
+    'm/z': np.concatenate([np.sort(rng.uniform(100, 2000, n)) for n in spec_lens]),
+    'abund_ceil': rng.exponential(100, sum(spec_lens)).round(2),
+    'spec_num': np.repeat([1, 2, 3], spec_lens),
+})
+
+def _loop_bkgd(abundances, N):
+    """Section-by-section background (how it used to be done)"""
+    sections = np.array_split(abundances.index.values, N)
+    bkgd = pd.Series(data = None, index = abundances.index.values, dtype = 'float64')
+    for i in range(len(sections)):
+        idxs = np.concatenate(sections[max(i - 1, 0):i + 2])
+        bkgd.loc[sections[i]] = np.median(abundances.loc[idxs])
+    return bkgd
+
+@pytest.mark.parametrize('N', [2, 7, 40, 150])
+def test_bkgd_calc_ser(N):
+    """Test to make sure the vectorized section background matches the section-by-section one
+    """
+    abundances = ms_df[ms_df['spec_num'] == 1]['abund_ceil']
+    expected_result = _loop_bkgd(abundances, N)
+    result = bkgd_calc_ser(abundances, N)
+
+    assert expected_result.equals(result)
+
+@pytest.mark.parametrize('N', [2, 40, 150])
+def test_bkgd_calc(N):
+    """Test to make sure all spectra in one pass gives the same backgrounds as one at a time
+    """
+    expected_result = ms_df.groupby('spec_num')['abund_ceil'].transform(_loop_bkgd, N)
+    # Interleave the spectra; only the order within each spectrum matters
+    mixed_df = ms_df.sort_values('m/z', kind = 'stable')
+    result = bkgd_calc(mixed_df, N)
+
+    assert np.array_equal(expected_result.values, result.loc[ms_df.index].values)
+
+def test_bkgd_rolling():
+    """Test to make sure the rolling median background follows a rolling median
+    """
+    abundances = ms_df[ms_df['spec_num'] == 2]['abund_ceil']
+    result = bkgd_calc_ser(abundances, 50, method = 'rolling')
+
+    # Window of 3 sections' worth of points (15), centred
+    assert result.iloc[100] == np.median(abundances.iloc[93:108])
+    assert result.index.equals(abundances.index)
+
+    with pytest.raises(ValueError):
+        bkgd_calc_ser(abundances, 50, method = 'mean')
+
+def test_import_ms_files_cache(tmp_path):
+    """Test to make sure cached imports match parsing the text files and are refreshed when a file changes
+    """
+    for ms_file in (data_dir / 'example_data' / '20210222_hala2').glob('ms[12].txt'):
+        shutil.copy(ms_file, tmp_path)
+
+    expected_result = import_ms_files(tmp_path, use_cache = False)
+    assert not list(tmp_path.glob('.*.npz'))
+
+    parsed_result, meta_df = import_ms_files(tmp_path, return_meta = True)
+    cached_result = import_ms_files(tmp_path)
+    assert len(list(tmp_path.glob('.*.npz'))) == 2
+    assert not list(tmp_path.glob('.*.tmp'))
+    assert expected_result.equals(parsed_result)
+    assert expected_result.equals(cached_result)
+
+    # Header metadata
+    assert meta_df['spec_num'].tolist() == [1, 2]
+    assert meta_df['precursor_mz'].tolist() == [1194.54, 1194.54]
+    assert meta_df['rt'].tolist() == [4.241, 4.245]
+    assert (meta_df['source_file'] == '2021-02-22_EG_1228_9_msms.d').all()
+    assert meta_df['precursor_charge'].isna().all()
+
+    # Changing a file invalidates its cache
+    with open(tmp_path / 'ms2.txt', 'a') as f:
+        f.write('2500.0000\t1.00\t\n')
+    updated_result = import_ms_files(tmp_path)
+    assert updated_result.shape[0] == expected_result.shape[0] + 1
+    assert updated_result['m/z'].iloc[-1] == 2500.0
+
+def test_read_ms_header_charge(tmp_path):
+    """Test to make sure the precursor charge is read from the header when it's given
+    """
+    ms_file = tmp_path / 'ms1.txt'
+    ms_file.write_text('#MS Peaks One: + Product Ion (rt: 4.241 min) (1194.5400 [z=2] -> **) (run.d)\n#\n')
+    assert read_ms_header(ms_file) == {'rt': 4.241, 'precursor_mz': 1194.54, 'precursor_charge': 2,
+        'source_file': 'run.d'}
+
+def test_spectrum_set():
+    """Test to make sure the SpectrumSet gives the same processed and S/N filtered spectra as the dataframe functions
+    """
+    raw_df = import_ms_files(data_dir / 'example_data' / '20210222_hala2', use_cache = False)
+    expected_result = process_spectra(raw_df, 50, 800).reset_index(drop = True)
+
+    spectra = SpectrumSet.from_df(raw_df.sample(frac = 1, random_state = 0)).process(50, 800)
+    assert len(spectra) == 4 and spectra.n_peaks == len(raw_df)
+    assert spectra.to_df().equals(expected_result)
+    assert SpectrumSet.from_df(expected_result).to_df().equals(expected_result)
+
+    # Per-spectrum views share the set's arrays
+    spectrum = spectra[2]
+    assert np.shares_memory(spectrum.mz, spectra.mz)
+    assert spectrum.to_df().equals(expected_result[expected_result['spec_num'] == 2].reset_index(drop = True))
+    with pytest.raises(KeyError):
+        spectra[5]
+
+    # The S/N filtered set keeps the arrays and only picks peaks
+    filtered = spectra.sn_filter(1.5)
+    assert filtered.mz is spectra.mz
+    expected_filtered = expected_result[expected_result['abund_ceil'] > 1.5*expected_result['bkgd']]
+    assert filtered.to_df().equals(expected_filtered.reset_index(drop = True))
+    assert filtered[3].to_df().equals(
+        expected_filtered[expected_filtered['spec_num'] == 3].reset_index(drop = True))
+    assert filtered.sn_filter(3).to_df().equals(spectra.sn_filter(3).to_df())
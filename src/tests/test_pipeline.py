@@ -0,0 +1,77 @@
+"""Tests for the pipeline module of msms_structure_annot
+"""
+
+import pytest
+import pandas as pd
+from msms_structure_annot import scoring
+from msms_structure_annot.cache import StageCache
+from msms_structure_annot.pipeline import run_pipeline, score_library
+
+tol = 0.01
+N_spectra = 4
+
+@pytest.fixture
+def pipeline_args(ms_df_sn_filter, ptms_df, hala2_peptide):
+    pep = hala2_peptide
+    return (ms_df_sn_filter, ptms_df, pep['parent_seq'], pep['N_term_mod'], pep['C_term_mod'], pep['charges'],
+        pep['proton_m'], tol, N_spectra)
+
+def test_run_pipeline_serial(pipeline_args, ms_df_sn_filter, frag_df_charged):
+    """Test to make sure scoring chunk by chunk gives the same scores as running every stage on everything
+    """
+    matched_df = scoring.match_ions(ms_df_sn_filter, frag_df_charged, tol)
+    expected_result = pd.concat([
+        scoring.score_wrapper(matched_df, frag_df_charged, N_spectra, score_method = method)
+        for method in ['frac', 'weights']
+        ], ignore_index = True)
+
+    result = run_pipeline(*pipeline_args, chunk_size = 7)
+
+    assert expected_result.equals(result)
+
+@pytest.mark.parametrize('n_workers', [2, 3])
+def test_run_pipeline_parallel(n_workers, pipeline_args):
+    """Test to make sure the worker count doesn't change the scores
+    """
+    expected_result = run_pipeline(*pipeline_args, chunk_size = 50)
+    result = run_pipeline(*pipeline_args, chunk_size = 50, n_workers = n_workers)
+
+    assert expected_result.equals(result)
+
+def test_run_pipeline_stage_cache(tmp_path, pipeline_args):
+    """Test to make sure cached chunk fragments are reused when only the tolerance changes
+    """
+    stage_cache = StageCache(tmp_path)
+    expected_result = run_pipeline(*pipeline_args, chunk_size = 50)
+    assert expected_result.equals(run_pipeline(*pipeline_args, chunk_size = 50, stage_cache = stage_cache))
+    assert (stage_cache.hits, stage_cache.misses) == (0, 3)
+
+    new_tol_args = pipeline_args[:-2] + (0.02, N_spectra)
+    result = run_pipeline(*new_tol_args, chunk_size = 50, stage_cache = stage_cache)
+    assert result.equals(run_pipeline(*new_tol_args, chunk_size = 50))
+    assert (stage_cache.hits, stage_cache.misses) == (3, 3)
+
+def test_score_library(monkeypatch, ms_df_sn_filter, ptms_df, hala2_peptide):
+    """Test to make sure scoring several candidate peptides together gives each the same scores as scoring it alone
+    """
+    # Registered scorers see the same matched ion columns as with score_wrapper
+    monkeypatch.setitem(scoring.SCORERS, 'y_only',
+        lambda matched_df: matched_df['ion_name'].astype(str).str.startswith('$y').values.astype(float))
+    score_methods = ('frac', 'weights', 'y_only')
+    pep = hala2_peptide
+    variant_seq = 'TTWPCATVGVSVALCPTTKCTSQC' # Different leader cleavage
+    variant_ptms_df = ptms_df.assign(num_mods = [2, 1], poss_mod_pos = [[1, 2, 7, 11], [5, 15, 20]])
+    peptides = {'core': (pep['parent_seq'], ptms_df), 'variant': (variant_seq, variant_ptms_df)}
+
+    result = score_library(ms_df_sn_filter, peptides, pep['N_term_mod'], pep['C_term_mod'], pep['charges'],
+        pep['proton_m'], tol, N_spectra, score_methods = score_methods)
+
+    for peptide_id, (seq, peptide_ptms_df) in peptides.items():
+        expected_result = run_pipeline(ms_df_sn_filter, peptide_ptms_df, seq, pep['N_term_mod'], pep['C_term_mod'],
+            pep['charges'], pep['proton_m'], tol, N_spectra, score_methods = score_methods)
+        peptide_result = result[result['peptide_id'] == peptide_id].merge(expected_result,
+            on = ['score_method', 'hs_id'], suffixes = ('', '_expected'))
+        assert len(peptide_result) == len(expected_result)
+        assert (peptide_result['score'] == peptide_result['score_expected']).all()
+    assert result.groupby('score_method')['rank'].max().eq(120 + 18).all()
+    assert result.groupby('score_method')['score'].apply(lambda s: s.is_monotonic_decreasing).all()
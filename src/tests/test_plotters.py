@@ -0,0 +1,50 @@
+"""Tests for the plotters module of msms_structure_annot
+"""
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import pandas as pd
+import numpy as np
+from msms_structure_annot.plotters import label_spectra_plot, export_top_spectra_plots
+
+# Random spectra with a few matched ions for two structures
+rng = np.random.default_rng(0)
+ms_df = pd.DataFrame({
+    'm/z': np.concatenate([np.sort(rng.uniform(100, 2000, 400)) for _ in range(2)]),
+    'orig_abundance': rng.uniform(0, 1e4, 800),
+    'spec_num': np.repeat([1, 2], 400),
+})
+matched_df = ms_df.sample(60, random_state = 0).assign(
+    hs_id = np.repeat([0, 1], 30), ion_name = ['$b_{{{}}}^{{+1}}$'.format(i) for i in range(60)])
+scores_df = pd.DataFrame({'hs_id': [0, 1], 'score': [0.1, 0.3], 'score_method': 'frac'})
+
+def test_fast_label_layout():
+    """Test to make sure the fast layout is deterministic, keeps labels apart and respects max_labels
+    """
+    fig, axs = label_spectra_plot(ms_df, matched_df, [1, 2], 0, label_layout = 'fast')
+    fig.canvas.draw()
+    for ax in axs:
+        boxes = [text.get_window_extent() for text in ax.texts]
+        assert len(boxes) > 0
+        for i, box in enumerate(boxes):
+            assert not any(box.overlaps(other) for other in boxes[i + 1:])
+    positions = [[text.get_position() for text in ax.texts] for ax in axs]
+    plt.close(fig)
+
+    fig, axs = label_spectra_plot(ms_df, matched_df, [1, 2], 0, label_layout = 'fast')
+    assert [[text.get_position() for text in ax.texts] for ax in axs] == positions
+    plt.close(fig)
+
+    fig, axs = label_spectra_plot(ms_df, matched_df, [1, 2], 0, label_layout = 'fast', max_labels = 3)
+    assert all(len(ax.texts) <= 3 for ax in axs)
+    plt.close(fig)
+
+def test_export_top_spectra_plots(tmp_path):
+    """Test to make sure the top structures' figures are saved, best first
+    """
+    paths = export_top_spectra_plots(ms_df, matched_df, scores_df, tmp_path, top_n = 2, n_workers = 1,
+        file_format = 'png', dpi = 50)
+
+    assert paths == [tmp_path / 'hs1_matched_ions.png', tmp_path / 'hs0_matched_ions.png']
+    assert all(path.stat().st_size > 0 for path in paths)
@@ -0,0 +1,155 @@
+"""Tests for the scoring module of msms_structure_annot
+"""
+
+import pytest
+import pandas as pd
+import numpy as np
+from msms_structure_annot.scoring import (
+    match_ions, score_wrapper, register_scorer, SCORERS, score_signatures, expand_signature_matches,
+    ScoreState
+)
+from msms_structure_annot.hsmakers import frag_signatures, mk_charge_df, frag_hs, gen_hss
+from msms_structure_annot.paths import test_data_dir
+
+# Import the pickled dataframes with example test data to compare against
+frag_df_charged = pd.read_pickle(test_data_dir / 'frag_df_charged.pkl')
+ptms_df = pd.read_pickle(test_data_dir / 'ptms_df.pkl')
+hs_df = pd.read_pickle(test_data_dir / 'hs_df.pkl')
+
+# Small set of observed peaks; two of them fall within the same window around the y1 ion
+spectra_df = pd.DataFrame({
+    'm/z': [57.0214, 75.0200, 75.0280, 96.0318, 153.0449, 153.0532, 400.0],
+    'orig_abundance': [10., 20., 30., 40., 50., 60., 70.],
+    'spec_num': [1, 1, 1, 1, 2, 2, 2],
+})
+spectra_df['abund_ceil'] = spectra_df['orig_abundance']
+spectra_df['bkgd'] = 5.
+
+def _brute_force_match(spectra_df, hs_frag_df, lower, upper):
+    """Matches every ion against every peak (how it used to be done)"""
+    hs_ion_idxs = []
+    obs_ion_idxs = []
+    for hs_ion_idx, row in hs_frag_df.iterrows():
+        mw = row['hyp_mw']
+        matched_ions = spectra_df[(spectra_df['m/z'] >= lower(mw)) & (spectra_df['m/z'] <= upper(mw))]
+        for obs_ion_idx in matched_ions.index.values:
+            hs_ion_idxs.append(hs_ion_idx)
+            obs_ion_idxs.append(obs_ion_idx)
+    return pd.concat([
+        hs_frag_df.loc[hs_ion_idxs].reset_index(drop = True),
+        spectra_df.loc[obs_ion_idxs].reset_index(drop = True)
+        ], sort = False, axis = 1)
+
+def test_match_ions():
+    """Test to make sure the binary search matcher finds the same matches as a full scan
+    """
+    tol = 0.005
+    expected_result = _brute_force_match(spectra_df, frag_df_charged, lambda mw: mw - tol, lambda mw: mw + tol)
+    result = match_ions(spectra_df, frag_df_charged, tol)
+
+    assert expected_result.equals(result)
+    # Both peaks around the unmodified y1 ion are matched
+    assert (result[result['human_name'] == 'y1']['m/z'].values == [75.0200, 75.0280]).all()
+
+def test_match_ions_ppm():
+    """Test to make sure ppm tolerances scale with the hypothetical m/z
+    """
+    tol = 50
+    expected_result = _brute_force_match(spectra_df, frag_df_charged,
+        lambda mw: mw - mw*tol*1e-6, lambda mw: mw + mw*tol*1e-6)
+    result = match_ions(spectra_df, frag_df_charged, tol, tol_unit = 'ppm')
+
+    assert expected_result.equals(result)
+
+    with pytest.raises(ValueError):
+        match_ions(spectra_df, frag_df_charged, tol, tol_unit = 'mDa')
+
+def test_score_wrapper():
+    """Test to make sure all structures are scored at once the same way as one at a time
+    """
+    N_spectra = 2
+    matched_df = match_ions(spectra_df, frag_df_charged, 0.005)
+
+    for method in ['frac', 'weights']:
+        result = score_wrapper(matched_df, frag_df_charged, N_spectra, score_method = method)
+
+        for hs_id, score in zip(result['hs_id'], result['score']):
+            hs_matched_df = matched_df[matched_df['hs_id'] == hs_id]
+            n_ions = (frag_df_charged['hs_id'] == hs_id).sum()
+            assert score == pytest.approx(SCORERS[method](hs_matched_df).sum() / (n_ions*N_spectra))
+
+    assert list(result.columns) == ['hs_id', 'score', 'score_method']
+    assert (result['score_method'] == 'weights').all()
+
+    with pytest.raises(ValueError):
+        score_wrapper(matched_df, frag_df_charged, N_spectra, score_method = 'not_a_method')
+
+def test_register_scorer():
+    """Test to make sure new scoring methods can be registered
+    """
+    @register_scorer('test_abund')
+    def _abund_scorer(matched_ions_df):
+        return matched_ions_df['orig_abundance'].values
+
+    matched_df = match_ions(spectra_df, frag_df_charged, 0.005)
+    result = score_wrapper(matched_df, frag_df_charged, 1, score_method = 'test_abund')
+    del SCORERS['test_abund']
+
+    # Summed abundances of the matched ions over the 28 hypothetical ions of each structure
+    assert np.allclose(result['score'].values, np.array([150., 160., 120.]) / 28)
+
+def test_score_signatures():
+    """Test to make sure scoring unique signatures gives the same scores as scoring every fragment
+    """
+    matched_df = match_ions(spectra_df, frag_df_charged, 0.005)
+    sig_df, hs_ids, hs_sigs = frag_signatures(hs_df, ptms_df, 'GGGG', 0, 18.0027)
+    sig_df_charged = mk_charge_df(sig_df, [1,2,3], 1.0078)
+    matched_sig_df = match_ions(spectra_df, sig_df_charged, 0.005)
+
+    for method in ['frac', 'weights']:
+        expected_result = score_wrapper(matched_df, frag_df_charged, 2, score_method = method)
+        result = score_signatures(matched_sig_df, sig_df_charged, hs_ids, hs_sigs, 2, score_method = method)
+
+        assert expected_result['hs_id'].equals(result['hs_id'])
+        assert np.allclose(expected_result['score'], result['score'])
+
+    # Expanded matches for a structure are the same observed ions as matching its own fragments
+    expanded_df = expand_signature_matches(matched_sig_df, hs_ids, hs_sigs, [1])
+    hs_matched_df = matched_df[matched_df['hs_id'] == 1]
+    assert (expanded_df['hs_id'] == 1).all()
+    assert sorted(expanded_df['m/z']) == sorted(hs_matched_df['m/z'])
+
+    # Fragments that aren't formed (-1) don't count towards the scores
+    ring_ptms_df = ptms_df.assign(type = 'ring', num_mods = 1, poss_mod_pos = [[1, 3]])
+    ring_frag_df_charged = mk_charge_df(frag_hs(gen_hss(ring_ptms_df), ring_ptms_df, 'GGGG', 0, 18.0027),
+        [1,2,3], 1.0078)
+    sig_df, hs_ids, hs_sigs = frag_signatures(gen_hss(ring_ptms_df), ring_ptms_df, 'GGGG', 0, 18.0027)
+    assert (hs_sigs == -1).sum() == 4 # b1, b2, y3 and y2
+    sig_df_charged = mk_charge_df(sig_df, [1,2,3], 1.0078)
+    result = score_signatures(match_ions(spectra_df, sig_df_charged, 0.005), sig_df_charged, hs_ids, hs_sigs, 2)
+    expected_result = score_wrapper(match_ions(spectra_df, ring_frag_df_charged, 0.005), ring_frag_df_charged, 2)
+    assert np.allclose(expected_result['score'], result['score'])
+
+def test_score_state():
+    """Test to make sure adding and removing spectra one by one gives the same scores as scoring them all together
+    """
+    state = ScoreState(frag_df_charged, 0.01)
+    for spec_num, spectrum_df in spectra_df.groupby('spec_num'):
+        matched_spec_df = state.add_spectrum(spec_num, spectrum_df.reset_index(drop = True))
+        assert matched_spec_df.equals(match_ions(spectrum_df.reset_index(drop = True), frag_df_charged, 0.01))
+
+    matched_df = match_ions(spectra_df, frag_df_charged, 0.01)
+    for method in ['frac', 'weights']:
+        expected_result = score_wrapper(matched_df, frag_df_charged, 2, score_method = method)
+        result = state.scores(method)
+        assert (result['hs_id'] == expected_result['hs_id']).all()
+        assert np.allclose(result['score'], expected_result['score'])
+
+    state.remove_spectrum(1)
+    spec2_df = spectra_df[spectra_df['spec_num'] == 2].reset_index(drop = True)
+    expected_result = score_wrapper(match_ions(spec2_df, frag_df_charged, 0.01), frag_df_charged, 1)
+    assert state.spec_nums == [2]
+    assert np.allclose(state.scores('frac')['score'], expected_result['score'])
+
+    with pytest.raises(ValueError):
+        state.add_spectrum(2, spec2_df)
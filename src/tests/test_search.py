@@ -0,0 +1,89 @@
+"""Tests for the search module of msms_structure_annot
+"""
+
+import pytest
+import pandas as pd
+from msms_structure_annot import hsmakers, scoring
+from msms_structure_annot.search import topk_hss, stream_topk_hss, match_hs_ids
+
+tol = 0.01
+N_spectra = 4
+
+@pytest.mark.parametrize('score_method', ['frac', 'weights'])
+def test_topk_hss(score_method, ms_df_sn_filter, ptms_df, frag_df_charged, hala2_peptide):
+    """Test to make sure the branch-and-bound search finds the same top structures as scoring all of them
+    """
+    matched_df = scoring.match_ions(ms_df_sn_filter, frag_df_charged, tol)
+    scores_df = scoring.score_wrapper(matched_df, frag_df_charged, N_spectra, score_method = score_method)
+    expected_result = scores_df.sort_values(
+        ['score', 'hs_id'], ascending = [False, True]).head(5).reset_index(drop = True)
+
+    result = topk_hss(ms_df_sn_filter, ptms_df, **hala2_peptide, tol = tol, N_spectra = N_spectra, k = 5,
+        score_method = score_method)
+
+    assert expected_result.equals(result)
+
+@pytest.mark.parametrize('score_method', ['frac', 'weights'])
+def test_stream_topk_hss(score_method, ms_df_sn_filter, ptms_df, frag_df_charged, hala2_peptide):
+    """Test to make sure streaming over chunks keeps the same top structures and scores as scoring all of them
+    """
+    matched_df = scoring.match_ions(ms_df_sn_filter, frag_df_charged, tol)
+    scores_df = scoring.score_wrapper(matched_df, frag_df_charged, N_spectra, score_method = score_method)
+    expected_result = scores_df.sort_values(
+        ['score', 'hs_id'], ascending = [False, True], kind = 'stable').head(7).reset_index(drop = True)
+
+    result = stream_topk_hss(ms_df_sn_filter, ptms_df, **hala2_peptide, tol = tol, N_spectra = N_spectra, k = 7,
+        score_method = score_method, chunk_size = 23)
+
+    assert expected_result.equals(result)
+
+    # Matched ions for just the reported structures
+    top_matched_df = match_hs_ids(result['hs_id'], ms_df_sn_filter, ptms_df, **hala2_peptide, tol = tol)
+    expected_matched_df = matched_df[matched_df['hs_id'].isin(result['hs_id'])].reset_index(drop = True)
+    assert set(top_matched_df['hs_id']) <= set(result['hs_id'])
+    for hs_id in result['hs_id']:
+        cols = ['hs_id', 'hyp_mw', 'm/z', 'spec_num', 'charge']
+        assert (top_matched_df.loc[top_matched_df['hs_id'] == hs_id, cols].reset_index(drop = True).equals(
+            expected_matched_df.loc[expected_matched_df['hs_id'] == hs_id, cols].reset_index(drop = True)))
+
+def test_stream_topk_hss_custom_scorer(monkeypatch, ms_df_sn_filter, ptms_df, frag_df_charged, hala2_peptide):
+    """Test to make sure registered scorers see the same matched ion columns as with score_wrapper
+    """
+    monkeypatch.setitem(scoring.SCORERS, 'y_only',
+        lambda matched_df: matched_df['ion_name'].astype(str).str.startswith('$y').values.astype(float))
+    matched_df = scoring.match_ions(ms_df_sn_filter, frag_df_charged, tol)
+    scores_df = scoring.score_wrapper(matched_df, frag_df_charged, N_spectra, score_method = 'y_only')
+    expected_result = scores_df.sort_values(
+        ['score', 'hs_id'], ascending = [False, True], kind = 'stable').head(5).reset_index(drop = True)
+
+    result = stream_topk_hss(ms_df_sn_filter, ptms_df, **hala2_peptide, tol = tol, N_spectra = N_spectra, k = 5,
+        score_method = 'y_only', chunk_size = 23)
+
+    assert expected_result.equals(result)
+
+def test_stream_topk_hss_rings(ms_df_sn_filter, hala2_peptide):
+    """Test to make sure ring PTMs (with fragments missing inside rings) stream to the same scores as scoring all of them
+    """
+    pep = hala2_peptide
+    ring_ptms_df = pd.DataFrame({
+        'ptm_id': [0, 1],
+        'name': ['lanthionine', 'dehydration'],
+        'm_shift': [-18.011, -18.011],
+        'num_mods': [2, 1],
+        'poss_mod_pos': [[[2, 6], [3, 16], [8, 21], [12, 25], [18, 21], [23, 25]], [2, 3, 8, 12, 18, 23]],
+        'type': ['ring', 'point'],
+    })
+    frag_df_charged = hsmakers.mk_charge_df(hsmakers.frag_hs(hsmakers.gen_hss(ring_ptms_df), ring_ptms_df,
+        pep['parent_seq'], pep['N_term_mod'], pep['C_term_mod']), pep['charges'], pep['proton_m'])
+    matched_df = scoring.match_ions(ms_df_sn_filter, frag_df_charged, tol)
+    scores_df = scoring.score_wrapper(matched_df, frag_df_charged, N_spectra)
+    expected_result = scores_df.sort_values(
+        ['score', 'hs_id'], ascending = [False, True], kind = 'stable').head(5).reset_index(drop = True)
+
+    result = stream_topk_hss(ms_df_sn_filter, ring_ptms_df, **pep, tol = tol, N_spectra = N_spectra, k = 5,
+        chunk_size = 11)
+    assert expected_result.equals(result)
+
+    # The branch-and-bound search only handles point PTMs
+    with pytest.raises(ValueError):
+        topk_hss(ms_df_sn_filter, ring_ptms_df, **pep, tol = tol, N_spectra = N_spectra)
@@ -0,0 +1,53 @@
+"""Tests for the significance module of msms_structure_annot
+"""
+
+import pytest
+import pandas as pd
+import numpy as np
+from msms_structure_annot import scoring
+from msms_structure_annot.incidence import IncidenceMatrix
+from msms_structure_annot.significance import decoy_spectra, decoy_scores, add_pvalues
+
+@pytest.mark.parametrize('decoy_method', ['shift', 'shuffle'])
+def test_decoy_scores(decoy_method, ms_df_sn_filter, frag_df_charged):
+    """Test to make sure batched decoy scores are the same as scoring each decoy spectrum on its own
+    """
+    incidence = IncidenceMatrix(frag_df_charged)
+    result = decoy_scores(incidence, ms_df_sn_filter, 0.01, 4, n_decoys = 7, score_method = 'weights',
+        decoy_method = decoy_method, seed = 3, batch_size = 3)
+    assert result.shape == (len(incidence.hs_ids), 7)
+
+    # Same decoys for any batch size and seed reproducibility
+    assert np.array_equal(result, decoy_scores(incidence, ms_df_sn_filter, 0.01, 4, n_decoys = 7,
+        score_method = 'weights', decoy_method = decoy_method, seed = 3, batch_size = 100))
+
+    decoys_df = decoy_spectra(ms_df_sn_filter, 7, method = decoy_method, seed = 3)
+    assert (decoys_df['decoy'].value_counts() == len(ms_df_sn_filter)).all()
+    for decoy in [0, 6]:
+        decoy_df = decoys_df[decoys_df['decoy'] == decoy].reset_index(drop = True)
+        matched_df = scoring.match_ions(decoy_df, frag_df_charged, 0.01)
+        expected_result = scoring.score_wrapper(matched_df, frag_df_charged, 4, score_method = 'weights')
+        assert np.allclose(expected_result['score'], result[:, decoy])
+
+def test_add_pvalues(ms_df_sn_filter, frag_df_charged):
+    """Test to make sure p-values are added for every scoring method and follow the decoy scores
+    """
+    matched_df = scoring.match_ions(ms_df_sn_filter, frag_df_charged, 0.01)
+    scores_df = pd.concat([scoring.score_wrapper(matched_df, frag_df_charged, 4, score_method = method)
+        for method in ['frac', 'weights']], ignore_index = True)
+
+    result = add_pvalues(scores_df, ms_df_sn_filter, frag_df_charged, 0.01, 4, n_decoys = 50, seed = 1)
+    assert result[scores_df.columns].equals(scores_df)
+    assert result['p_value'].between(1/51, 1).all()
+    assert (result['p_value_best'] >= result['p_value']).all()
+    assert result.equals(add_pvalues(scores_df, ms_df_sn_filter, frag_df_charged, 0.01, 4, n_decoys = 50, seed = 1))
+
+    # Higher scores never get larger p-values against the best decoy scores
+    for _, method_df in result.groupby('score_method'):
+        method_df = method_df.sort_values('score')
+        assert method_df['p_value_best'].is_monotonic_decreasing
+
+    # Scores for structures without fragment ions have no decoy scores to compare with
+    with pytest.raises(ValueError, match = 'hs_ids'):
+        add_pvalues(scores_df, ms_df_sn_filter, frag_df_charged[frag_df_charged['hs_id'] != 0], 0.01, 4,
+            n_decoys = 5)
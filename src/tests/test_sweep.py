@@ -0,0 +1,23 @@
+"""Tests for the sweep module of msms_structure_annot
+"""
+
+from msms_structure_annot import msprocess, scoring
+from msms_structure_annot.sweep import sweep_scores
+
+def test_sweep_scores(hala2_ms_df, frag_df_charged):
+    """Test to make sure the sweep gives the same scores as running the notebook steps for each combination
+    """
+    tols, sn_thrs, Ns, upper_lims = [0.005, 0.01, 0.02], [1.5, 3], [500, 800], [20, 50]
+    result = sweep_scores(hala2_ms_df, frag_df_charged, tols, sn_thrs, Ns, upper_lims)
+
+    assert len(result) == 3*2*2*2*2*120
+    assert result.index.is_monotonic_increasing
+    for upper_lim, N, tol, sn_thr in [(50, 800, 0.01, 1.5), (20, 500, 0.02, 3), (20, 800, 0.005, 1.5)]:
+        processed_df = msprocess.process_spectra(hala2_ms_df, upper_lim, N)
+        sn_filter_df = processed_df[processed_df['abund_ceil'] > sn_thr*processed_df['bkgd']].reset_index(drop = True)
+        matched_df = scoring.match_ions(sn_filter_df, frag_df_charged, tol)
+        for method in ['frac', 'weights']:
+            expected_result = scoring.score_wrapper(matched_df, frag_df_charged, 4, score_method = method)
+            scores = result.loc[(upper_lim, N, tol, sn_thr, method), 'score']
+            assert (scores.index == expected_result['hs_id']).all()
+            assert (scores.values == expected_result['score'].values).all()